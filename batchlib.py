@@ -0,0 +1,216 @@
+from llmlib import LLM, LLMException
+import os, json, time, hashlib, threading, uuid
+from urllib.parse import urlsplit, urlunsplit
+import httpx
+
+class BatchPending(Exception):
+    """
+    Raised from an LLM call while a batch session collects the requests instead of sending them
+    """
+    pass
+
+
+class BatchSession:
+    """
+    Collects the chat completion requests issued through `LLM` and serves their batch results
+
+    While a session is installed as `LLM.batch`, every LLM call either returns the result
+    that a batch job already produced for the same request, or records the request
+    and raises `BatchPending`.  Requests are matched to results by `custom_id`,
+    a content hash of the request body.
+    """
+    def __init__(self):
+        self.results = {}  # custom_id -> response text, or LLMException
+        self.pending = {}  # custom_id -> (llm, request body)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def custom_id(body):
+        canonical = json.dumps(body, sort_keys = True, ensure_ascii = False, separators = (",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def resolve(self, llm, body):
+        custom_id = self.custom_id(body)
+        with self.lock:
+            if custom_id in self.results:
+                result = self.results[custom_id]
+                if isinstance(result, LLMException):
+                    raise result
+                return result
+            self.pending[custom_id] = (llm, body)
+        raise BatchPending(custom_id)
+
+    def run(self, backend):
+        """
+        Submits the pending requests as one batch job per LLM and waits for the results
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        by_llm = {}
+        for custom_id, (llm, body) in pending.items():
+            by_llm.setdefault(llm, []).append({
+                "custom_id" : custom_id,
+                "method" : "POST",
+                "url" : urlsplit(llm.url).path,
+                "body" : body
+            })
+        for llm, requests in by_llm.items():
+            print(f"    Submit a batch of {len(requests)} requests to {llm}")
+            outputs = backend.run(llm, requests)
+            with self.lock:
+                for request in requests:
+                    custom_id = request["custom_id"]
+                    output = outputs.get(custom_id)
+                    self.results[custom_id] = parse_batch_output(llm, output)
+
+
+def parse_batch_output(llm, output):
+    """
+    Converts one line of batch output (OpenAI format) into the response text or an LLMException
+    """
+    if output is None:
+        return LLMException(f"Model = {llm.model}, no batch output for the request")
+    response = output.get("response") or {}
+    if output.get("error") or response.get("status_code") != 200:
+        return LLMException(
+            f"Model = {llm.model}, Status Code = {response.get('status_code')}\n" +
+            f"Error: {output.get('error')}\nResponse: {response.get('body')}"
+        )
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+def map_batched(func, items, backend, max_rounds = 10):
+    """
+    Apply `func` to every item, sending the LLM calls it makes as batch jobs.
+    All items are run, their calls collected and submitted together, and the items
+    are re-run with the results; a function that makes several dependent calls
+    takes several rounds.  The results are returned in the same order as `items`.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    todo = list(range(len(items)))
+    session = BatchSession()
+    previous_session, LLM.batch = LLM.batch, session
+    try:
+        for round_id in range(1, max_rounds + 1):
+            waiting = []
+            for i in todo:
+                try:
+                    results[i] = func(items[i])
+                except BatchPending:
+                    waiting.append(i)
+            todo = waiting
+            if not todo:
+                return results
+            print(f"    Batch round {round_id}: {len(todo)} items wait for LLM results")
+            session.run(backend)
+        raise LLMException(f"Items still wait for LLM results after {max_rounds} batch rounds")
+    finally:
+        LLM.batch = previous_session
+
+
+class OpenAIBatchBackend:
+    """
+    Runs batch jobs through the OpenAI Batch API: upload the JSONL input file, create the batch,
+    poll until it ends, then download the output (and error) files
+    """
+    def __init__(self, completion_window = "24h", poll_interval = 30.0, timeout = 120.0):
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def run(self, llm, requests):
+        scheme, netloc, path, _, _ = urlsplit(llm.url)
+        api_base = urlunsplit((scheme, netloc, path.rsplit("/chat/completions", 1)[0], "", ""))
+        headers = {k : v for k, v in llm.headers.items() if k.lower() != "content-type"}
+        input_jsonl = "".join(json.dumps(request, ensure_ascii = False) + "\n" for request in requests)
+        with httpx.Client(base_url = api_base, headers = headers, timeout = self.timeout) as client:
+            response = client.post(
+                "/files", data = {"purpose" : "batch"},
+                files = {"file" : ("batch_input.jsonl", input_jsonl.encode("utf-8"), "application/jsonl")}
+            )
+            self.check(response)
+            input_file_id = response.json()["id"]
+            response = client.post("/batches", json = {
+                "input_file_id" : input_file_id,
+                "endpoint" : requests[0]["url"],
+                "completion_window" : self.completion_window
+            })
+            self.check(response)
+            batch = response.json()
+            print(f"    Batch {batch['id']} is {batch['status']}")
+            while batch["status"] not in ["completed", "failed", "expired", "cancelled"]:
+                time.sleep(self.poll_interval)
+                response = client.get(f"/batches/{batch['id']}")
+                self.check(response)
+                batch = response.json()
+            counts = batch.get("request_counts") or {}
+            print(f"    Batch {batch['id']} is {batch['status']}: {counts}")
+            outputs = {}
+            for file_id in [batch.get("output_file_id"), batch.get("error_file_id")]:
+                if file_id:
+                    response = client.get(f"/files/{file_id}/content")
+                    self.check(response)
+                    outputs.update(read_batch_output(response.text))
+            return outputs
+
+    @staticmethod
+    def check(response):
+        if response.status_code != 200:
+            raise LLMException(
+                f"Batch API call {response.request.method} {response.request.url} failed, " +
+                f"Status Code = {response.status_code}\nResponse: {response.text}"
+            )
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API, for testing without network
+
+    Each job writes its input JSONL into `folder`, answers every request with
+    `responder(body)` (by default, echoes the last message), and writes the output
+    JSONL in the same format as the OpenAI Batch API.
+    """
+    def __init__(self, folder, responder = None):
+        self.folder = folder
+        self.responder = responder or (lambda body: "Echo: " + body["messages"][-1]["content"])
+        os.makedirs(folder, exist_ok = True)
+
+    def run(self, llm, requests):
+        batch_id = "batch_" + uuid.uuid4().hex
+        input_path = os.path.join(self.folder, batch_id + "_input.jsonl")
+        output_path = os.path.join(self.folder, batch_id + "_output.jsonl")
+        with open(input_path, "w", encoding = "utf-8") as f:
+            for request in requests:
+                f.write(json.dumps(request, ensure_ascii = False) + "\n")
+        with open(input_path, "r", encoding = "utf-8") as f_in, open(output_path, "w", encoding = "utf-8") as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    response = {
+                        "status_code" : 200,
+                        "body" : {
+                            "model" : request["body"]["model"],
+                            "choices" : [{"index" : 0, "message" : {"role" : "assistant", "content" : content}}]
+                        }
+                    }
+                    error = None
+                except Exception as e:
+                    response, error = {"status_code" : 500, "body" : None}, {"message" : repr(e)}
+                output = {"id" : uuid.uuid4().hex, "custom_id" : request["custom_id"], "response" : response, "error" : error}
+                f_out.write(json.dumps(output, ensure_ascii = False) + "\n")
+        with open(output_path, "r", encoding = "utf-8") as f:
+            return read_batch_output(f.read())
+
+
+def read_batch_output(text):
+    """
+    Parses batch output JSONL into a dictionary keyed by `custom_id`
+    """
+    outputs = {}
+    for line in text.splitlines():
+        if line.strip():
+            output = json.loads(line)
+            outputs[output["custom_id"]] = output
+    return outputs
@@ -0,0 +1,284 @@
+import pandas as pd
+import os, sys, json, time, random, resource, subprocess, tempfile, argparse
+import promptlib, tablelib, telemetrylib, mocklib
+import datagen, datagen2
+from llmlib import LLM
+
+doc_schema = {
+    "doc_id" : "doc_id",
+    "source" : "source",
+    "document" : "document",
+    "LLM_q" : "LLM_q",
+    "doc_prompt" : "doc_prompt",
+    "reduce_doc" : "reduce_doc",
+    "modify_doc" : "modify_doc",
+    "expand_doc" : "expand_doc",
+    "orig_qs" : "orig_questions",
+    "conf_qs" : "conf_questions"
+}
+qr_schema = {
+    "doc_id" : "doc_id",
+    "q_id" : "q_id",
+    "is_conf" : "is_confusing",
+    "question" : "question",
+    "LLM_r" : "LLM_r",
+    "response" : "response",
+    "confusion" : "confusion",
+    "defusion" : "defusion",
+    "is_defused" : "is_defused"
+}
+llm_name = "gpt-3.5"
+vocabulary = (
+    "market company government river festival museum council engine harvest orchestra village satellite " +
+    "bridge library election factory vaccine glacier stadium railway treaty harbour telescope reservoir"
+).split()
+names = "Mitsubishi Peugeot Weywot Eldorado Avalon Corvina Brightwater Kestrel Halden Marlow Osprey Tamsin".split()
+
+def synthetic_corpus(num_docs, words_per_doc = 300, seed = 0):
+    """
+    Table of `num_docs` made-up news documents of about `words_per_doc` words
+    (columns doc_id, source, document), the same for the same seed
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_docs):
+        sentences, num_words = [], 0
+        while num_words < words_per_doc:
+            sentence = (
+                f"The {rng.choice(vocabulary)} of {rng.choice(names)} " +
+                f"{rng.choice(['opened', 'closed', 'sold', 'built', 'moved', 'renamed'])} " +
+                f"{rng.randint(2, 900)} {rng.choice(vocabulary)}s in {rng.randint(1950, 2024)}."
+            )
+            sentences.append(sentence)
+            num_words += len(sentence.split())
+        paragraphs = [" ".join(sentences[j : j + 4]) for j in range(0, len(sentences), 4)]
+        rows.append({"doc_id" : f"doc_{i}.txt", "source" : f"synthetic/{seed}/{i}", "document" : "\n\n".join(paragraphs)})
+    return pd.DataFrame(rows, dtype = str)
+
+def count_rows(path):
+    return len(tablelib.read_table(path, "Count the rows of the table", [tablelib.read_columns(path)[0]]))
+
+def stage(func, rows_path, *args):
+    """
+    Stage function that runs `func(*args)` and returns the number of rows of the table at `rows_path`
+    """
+    def run():
+        func(*args)
+        return count_rows(rows_path)
+    return run
+
+def datagen2_stages(folder, workers = 1, num_q_orig = 6, num_q_conf = 12, doc_prompt = "dt03"):
+    """
+    The stages of `datagen2.py` (as in its main), each a (name, function) pair;
+    the function runs the stage and returns the number of rows it produced
+    """
+    doc = lambda k: os.path.join(folder, f"docs_{k}.csv")
+    qrc = lambda k: os.path.join(folder, f"qrc_{k}.csv")
+    return [
+        ("STEP 0", stage(datagen2.record_llm_and_prompts, doc(0), llm_name, doc_prompt, doc_schema, doc("in"), doc(0))),
+        ("STEP 1", stage(datagen2.reduce_original_documents, doc(1), doc_schema, doc(0), doc(1), workers)),
+        ("STEP 2", stage(datagen2.modify_reduced_documents, doc(2), doc_schema, doc(1), doc(2), workers)),
+        ("STEP 3", stage(datagen2.expand_modified_documents, doc(3), doc_schema, doc(2), doc(3), workers)),
+        ("STEP 4", stage(datagen2.generate_questions_for_documents, doc(4), num_q_orig, doc_schema,
+                         ["document", "orig_qs"], doc(3), doc(4), workers)),
+        ("STEP 5", stage(datagen2.generate_questions_for_documents, doc("out"), num_q_conf, doc_schema,
+                         ["expand_doc", "conf_qs"], doc(4), doc("out"), workers)),
+        ("STEP 6", stage(datagen2.generate_RAG_responses, qrc(1), llm_name, doc_schema, doc("out"), qr_schema,
+                         qrc(1), workers)),
+        ("STEP 7", stage(datagen2.find_false_assumptions_in_questions, qrc(2), doc_schema, doc("out"), qr_schema,
+                         qrc(1), qrc(2), workers)),
+        ("STEP 8", stage(datagen2.check_if_response_defused_confusion, qrc("out"), doc_schema, doc("out"), qr_schema,
+                         qrc(2), qrc("out"), workers)),
+        ("STEP 9", stage(datagen2.filter_undefused_confusions_and_compute_metrics, qrc("out"), qr_schema,
+                         qrc("out"), qrc("filter")))
+    ]
+
+def datagen_stages(folder, num_q = 10):
+    """
+    The stages of `datagen.py` (as in its main), which run one row at a time
+    """
+    doc = lambda k: os.path.join(folder, f"docs_{k}.csv")
+    qrc = lambda k: os.path.join(folder, f"qrc_{k}.csv")
+    return [
+        ("STEP 1", stage(datagen.generate_questions_for_documents, doc(1), llm_name, num_q, doc_schema, doc("in"), doc(1))),
+        ("STEP 2", stage(datagen.infuse_questions_with_false_assumptions, doc(2), doc_schema, doc(1), doc(2))),
+        ("STEP 3", stage(datagen.generate_RAG_responses, qrc(1), llm_name, doc_schema, doc(2), qr_schema, qrc(1))),
+        ("STEP 4", stage(datagen.find_false_assumptions_in_questions, qrc(2), doc_schema, doc(2), qr_schema, qrc(1), qrc(2))),
+        ("STEP 5", stage(datagen.check_if_response_defused_confusion, qrc(3), doc_schema, doc(2), qr_schema, qrc(2), qrc(3))),
+        ("STEP 6", stage(datagen.filter_undefused_confusions_and_compute_metrics, qrc(3), qr_schema, qrc(3), qrc("filter")))
+    ]
+
+def reset_peak_rss():
+    """
+    Restarts the peak RSS count of this process (Linux only, elsewhere the peak is since the start)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure_stages(stages, info):
+    """
+    Runs the stages in order and measures each one
+
+    Returns
+    -------
+        list of dict : one record per stage, with `info` and the measurements: rows produced,
+        wall seconds, rows/sec, CPU seconds of this process per row (the LLM server runs elsewhere,
+        so this is the pipeline's own overhead), p50/p99 latency of its LLM calls, and peak RSS
+    """
+    records = []
+    for name, run in stages:
+        reset_peak_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        with telemetrylib.labels(stage = name):
+            rows = run()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        latencies = pd.Series(LLM.metrics.latencies(name), dtype = float)
+        records.append({
+            **info,
+            "stage" : name,
+            "rows" : rows,
+            "seconds" : round(wall, 4),
+            "rows_per_sec" : round(rows / wall, 2) if wall > 0 else None,
+            "llm_calls" : len(latencies),
+            "llm_p50_latency" : round(latencies.quantile(0.5), 4) if len(latencies) else None,
+            "llm_p99_latency" : round(latencies.quantile(0.99), 4) if len(latencies) else None,
+            "cpu_seconds" : round(cpu, 4),
+            "cpu_ms_per_row" : round(1000 * cpu / rows, 4) if rows else None,
+            "peak_rss_mb" : round(peak_rss_mb(), 1)
+        })
+    return records
+
+def run_benchmark(pipeline, num_docs, folder, url, workers = 1, words_per_doc = 300):
+    """
+    Runs all the stages of `pipeline` ("datagen2" or "datagen") over a synthetic corpus
+    of `num_docs` documents in `folder`, with the LLMs pointed to the mock server at `url`
+    """
+    os.makedirs(folder, exist_ok = True)
+    docs_in = os.path.join(folder, "docs_in.csv")
+    if not os.path.exists(docs_in):
+        synthetic_corpus(num_docs, words_per_doc).to_csv(docs_in, index = False)
+    mocklib.register(url, max_concurrency = max(8, workers))
+    promptlib.read_prompts("prompts")
+    info = {
+        "commit" : git_commit(),
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pipeline" : pipeline,
+        "num_docs" : num_docs,
+        "workers" : workers if pipeline == "datagen2" else 1,
+        "words_per_doc" : words_per_doc
+    }
+    stages = datagen2_stages(folder, workers) if pipeline == "datagen2" else datagen_stages(folder)
+    return measure_stages(stages, info)
+
+def start_mock_server(latency, port = 0):
+    """
+    Starts `mocklib.py` with a fixed latency in a separate process (so that its work is not
+    counted as the pipeline's), returns the process and the URL of the server
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mocklib.py"), "--latency", str(latency), "--responder", "synthetic", "--port", str(port)],
+        stdout = subprocess.PIPE, text = True
+    )
+    line = process.stdout.readline()
+    if not line.startswith("Mock LLM server at "):
+        process.kill()
+        raise RuntimeError(f"The mock LLM server did not start: {line}")
+    return process, line.split(" at ", 1)[1].strip()
+
+def read_results(path):
+    with open(path, encoding = "utf-8") as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def compare_results(base_path, new_path):
+    """
+    Relative change of throughput and per-row overhead for each stage, between the latest
+    runs of two results files (for example, of two commits)
+    """
+    key = ["pipeline", "num_docs", "stage"]
+    base, new = [read_results(path).groupby(key).last() for path in [base_path, new_path]]
+    df = base[["rows_per_sec", "cpu_ms_per_row", "peak_rss_mb"]].join(
+        new[["rows_per_sec", "cpu_ms_per_row", "peak_rss_mb"]], lsuffix = "_base", rsuffix = "_new", how = "inner"
+    )
+    for column in ["rows_per_sec", "cpu_ms_per_row", "peak_rss_mb"]:
+        df[column + "_change"] = df[column + "_new"] / df[column + "_base"] - 1
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description = "Benchmark the stages of datagen2.py and datagen.py against a mock LLM with fixed latency"
+    )
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10, 1000, 100000],
+                        help = "Numbers of documents of the synthetic corpora")
+    parser.add_argument("--pipelines", nargs = "+", choices = ["datagen2", "datagen"], default = ["datagen2", "datagen"])
+    parser.add_argument("--latency", type = float, default = 0.05,
+                        help = "Fixed latency of the mock LLM, in seconds")
+    parser.add_argument("--workers", type = int, default = 32,
+                        help = "Concurrent LLM calls per stage of datagen2.py")
+    parser.add_argument("--words-per-doc", type = int, default = 300)
+    parser.add_argument("--folder",
+                        help = "Folder for the corpora and the stage tables (by default, a temporary one)")
+    parser.add_argument("--output", default = "bench_results.jsonl",
+                        help = "JSONL file to append the results to, one record per stage")
+    parser.add_argument("--compare", metavar = "BASE_JSONL",
+                        help = "Only compare the results in --output to those in this file")
+    parser.add_argument("--child", nargs = 3, metavar = ("PIPELINE", "NUM_DOCS", "URL"), help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        with pd.option_context("display.max_columns", None, "display.width", 200, "display.precision", 3):
+            print(compare_results(args.compare, args.output))
+        sys.exit()
+
+    if args.child:  # One run in its own process, so that its memory use is measured alone
+        pipeline, num_docs, url = args.child[0], int(args.child[1]), args.child[2]
+        records = run_benchmark(pipeline, num_docs, os.path.join(args.folder, f"{pipeline}-{num_docs}"),
+                                url, args.workers, args.words_per_doc)
+        with open(args.output, "a", encoding = "utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        sys.exit()
+
+    folder = args.folder or tempfile.mkdtemp(prefix = "bench-")
+    os.makedirs(folder, exist_ok = True)
+    server, url = start_mock_server(args.latency)
+    print(f"Mock LLM server at {url} with latency {args.latency} s, tables in {folder}")
+    try:
+        for num_docs in args.sizes:
+            for pipeline in args.pipelines:
+                log_path = os.path.join(folder, f"{pipeline}-{num_docs}.log")
+                print(f"Run {pipeline} on {num_docs} documents, log in {log_path}", flush = True)
+                with open(log_path, "w", encoding = "utf-8") as log:
+                    subprocess.run([
+                        sys.executable, __file__, "--child", pipeline, str(num_docs), url, "--folder", folder,
+                        "--output", args.output, "--workers", str(args.workers), "--words-per-doc", str(args.words_per_doc)
+                    ], stdout = log, stderr = subprocess.STDOUT, check = True)
+    finally:
+        server.terminate()
+
+    results = read_results(args.output)
+    results = results[results["time"] >= results.groupby(["pipeline", "num_docs"])["time"].transform("max")]
+    columns = ["rows", "seconds", "rows_per_sec", "llm_p50_latency", "llm_p99_latency", "cpu_ms_per_row", "peak_rss_mb"]
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(results.set_index(["pipeline", "num_docs", "stage"])[columns])
@@ -0,0 +1,190 @@
+from llmlib import LLM
+import numpy as np
+import re, math
+from sklearn.feature_extraction.text import CountVectorizer
+
+# Context window (prompt + completion) of each model, in tokens, by its official name
+context_windows = {
+    "gpt-3.5-turbo" : 16385,
+    "gpt-4o" : 128000,
+    "meta-llama/Meta-Llama-3-8B-Instruct" : 8192
+}
+default_context_window = 8192  # For the models not in `context_windows`
+completion_reserve = 1024  # Tokens kept free for the completion, if the LLM's parameters have no "max_tokens"
+max_document_tokens = None  # If set, documents longer than this are chunked too, to bound the latency of a call
+_encodings = {}  # Model name -> tiktoken encoding (`None` if tiktoken is not installed)
+
+def encoding(model):
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model or "")
+            except KeyError:  # Not an OpenAI model: its tokenizer is similar enough for budgeting
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            if None not in _encodings.values():
+                print("    tiktoken is not installed: prompt sizes are estimated at ~4 characters per token")
+            _encodings[model] = None
+    return _encodings[model]
+
+def count_tokens(text, model = None):
+    """
+    Number of tokens in the text, with the model's tokenizer if `tiktoken` is installed,
+    and by the rule of thumb of ~4 characters per token otherwise
+    """
+    enc = encoding(model)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special = ()))
+
+def count_message_tokens(messages, model = None):
+    """
+    Number of tokens in the chat messages, with the few tokens of overhead per message
+    """
+    return sum(count_tokens(message.get("content") or "", model) + 4 for message in messages)
+
+def count_prompt_tokens(messages, model = None):
+    """
+    Number of tokens in a prompt made of the chat messages
+    """
+    return count_message_tokens(messages, model) + 3
+
+def context_window(llm):
+    return context_windows.get(LLM.get(llm).model, default_context_window)
+
+def document_budget(llm, messages, prefix_tokens = 0):
+    """
+    Number of tokens left for the document in a prompt whose other parts are `messages`
+    (formatted with an empty document), after the completion's share of the context window;
+    `prefix_tokens` counts the static messages before `messages` (see `count_message_tokens`),
+    so that a caller can count those once
+    """
+    model = LLM.get(llm)
+    reserve = model.parameters.get("max_tokens", completion_reserve)
+    budget = context_window(llm) - reserve - prefix_tokens - count_prompt_tokens(messages, model.model)
+    if max_document_tokens is not None:
+        budget = min(budget, max_document_tokens)
+    return max(budget, 1)
+
+
+def split_pieces(text, pattern):
+    return [piece for piece in re.split(pattern, text) if piece]
+
+def chunk_document(document, max_tokens, model = None):
+    """
+    Splits the document into chunks of at most `max_tokens` tokens (where possible), along the lines
+    (facts or paragraphs), or along the sentences of a longer line, or along the words of a longer sentence;
+    the chunks put back together give the document
+    """
+    pieces = []
+    for line in split_pieces(document, r"(?<=\n)"):
+        if count_tokens(line, model) <= max_tokens:
+            pieces.append(line)
+            continue
+        for sentence in split_pieces(line, r"(?<=[.!?])(?=\s)"):
+            if count_tokens(sentence, model) <= max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces.extend(re.findall(r"\s*\S+", sentence))
+    chunks, current, current_tokens = [], "", 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece, model)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += piece
+        current_tokens += piece_tokens
+    if current.strip():
+        chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+def split_to_fit(llm, document, messages, prefix_tokens = 0):
+    """
+    The document as one chunk if it fits in the prompt whose other parts are `messages`
+    (after `prefix_tokens`, see `document_budget`), otherwise as several chunks that each fit
+    """
+    model = LLM.get(llm).model
+    budget = document_budget(llm, messages, prefix_tokens)
+    if count_tokens(document, model) <= budget:
+        return [document]
+    return chunk_document(document, budget, model)
+
+def share(total, weights):
+    """
+    Splits `total` into integers proportional to `weights` (largest remainders first)
+    """
+    exact = [total * weight / sum(weights) for weight in weights]
+    counts = [math.floor(x) for x in exact]
+    by_remainder = sorted(range(len(weights)), key = lambda i: exact[i] - counts[i], reverse = True)
+    for i in by_remainder[: total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def passage_vectorizer():
+    """
+    Term counter of the passages and the queries ranked by BM25, here and in `retrievallib`
+    """
+    return CountVectorizer()
+
+def bm25_weights(counts, k1 = 1.5, b = 0.75):
+    """
+    BM25 weight of each term in each passage, from the term counts (a sparse matrix), so that the
+    score of a passage for a query is the sum of the weights of the query's terms
+    """
+    counts = counts.astype(np.float64).tocsr()
+    lengths = np.asarray(counts.sum(axis = 1)).ravel()
+    mean_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+    with_term = np.bincount(counts.indices, minlength = counts.shape[1])
+    idf = np.log(1 + (counts.shape[0] - with_term + 0.5) / (with_term + 0.5))
+    row_lengths = np.repeat(lengths, np.diff(counts.indptr))
+    tf = counts.data
+    counts.data = tf * (k1 + 1) / (tf + k1 * (1 - b + b * row_lengths / mean_length)) * idf[counts.indices]
+    return counts
+
+def bm25_scores(vectorizer, weights, query):
+    """
+    BM25 scores for the query of the passages whose `bm25_weights` are `weights`
+    """
+    query_vector = vectorizer.transform([query])
+    query_vector.data[:] = 1.0  # Each query term counts once
+    return (weights @ query_vector.T).toarray().ravel()
+
+def rank_passages(query, passages, k1 = 1.5, b = 0.75):
+    """
+    BM25 scores of the passages for the query
+    """
+    vectorizer = passage_vectorizer()
+    try:
+        counts = vectorizer.fit_transform(passages)
+    except ValueError:  # No terms in any passage
+        return [0.0] * len(passages)
+    return bm25_scores(vectorizer, bm25_weights(counts, k1, b), query).tolist()
+
+def select_passages(query, passages, budget, model = None):
+    """
+    The passages most relevant to the query (see `rank_passages`) that fit in `budget` tokens together,
+    in their original order
+    """
+    scores = rank_passages(query, passages)
+    chosen, used = [], 0
+    for i in sorted(range(len(passages)), key = lambda i: scores[i], reverse = True):
+        tokens = count_tokens(passages[i], model) + 1
+        if chosen and used + tokens > budget:
+            continue
+        chosen.append(i)
+        used += tokens
+    return [passages[i] for i in sorted(chosen)]
+
+def fit_document(llm, document, query, messages, chunk_tokens = 256):
+    """
+    The document if it fits in the prompt whose other parts are `messages`, otherwise its chunks
+    of about `chunk_tokens` tokens that are most relevant to the query, as many as fit
+    """
+    model = LLM.get(llm).model
+    budget = document_budget(llm, messages)
+    if count_tokens(document, model) <= budget:
+        return document
+    chunks = chunk_document(document, min(chunk_tokens, budget), model)
+    return "\n".join(select_passages(query, chunks, budget, model))
@@ -0,0 +1,106 @@
+import sqlite3, threading, hashlib, json, time
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses stored in a SQLite file
+
+    A response is keyed by a content hash of the request: model, url, inference
+    parameters and the canonical JSON of the chat messages.  When the total size
+    of cached responses exceeds `max_bytes`, the least recently used ones are evicted.
+    """
+    def __init__(self, path, max_bytes = 1 << 30, cache_sampled = False):
+        """
+        Opens (or creates) the cache file
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite file, typically inside the experiment folder
+        max_bytes : int
+            Size bound for the cached response texts, in bytes (UTF-8)
+        cache_sampled : bool
+            If `True`, also cache responses sampled with `temperature > 0`;
+            a re-run then replays the earlier sample instead of drawing a new one
+
+        Returns
+        -------
+        A new ResponseCache instance
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (" +
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, " +
+                "size INTEGER, created REAL, last_used REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used)")
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __str__(self):
+        calls = self.hits + self.misses
+        hit_rate = (self.hits / calls) if calls else 0.0
+        return (
+            f"Response cache {self.path}: hits = {self.hits}, misses = {self.misses} " +
+            f"(hit rate {hit_rate:.1%}), size = {self.total_bytes} bytes"
+        )
+
+    @staticmethod
+    def make_key(model, url, parameters, messages):
+        canonical = json.dumps(
+            {"model" : model, "url" : url, "parameters" : parameters, "messages" : messages},
+            sort_keys = True, ensure_ascii = False, separators = (",", ":")
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, parameters):
+        """
+        Responses are deterministic only at zero temperature (OpenAI's default is 1)
+        """
+        return self.cache_sampled or parameters.get("temperature", 1.0) == 0
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, model, response):
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now)
+            )
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        evicted = []
+        excess = self.total_bytes - self.max_bytes
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,119 @@
+import os, json, threading
+
+class Checkpoint:
+    """
+    Append-only JSONL log of the rows completed by a pipeline stage
+
+    Each line records the key of a row, such as `doc_id` or `(doc_id, q_id, is_conf)`,
+    and the JSON-serializable result computed for it.  If the stage fails midway,
+    a restart reads the log back and skips the rows whose keys are already done.
+    The stage removes its checkpoint after the output table is written: from then on,
+    re-runs are served by the response cache, which notices changed prompts or inputs.
+    With a `version` (such as the hash of the prompts), a checkpoint written under
+    another version is discarded rather than resumed.
+    """
+    flush_every = 10  # Default number of completed rows between flushes to disk
+    version = None  # Default version of the results, see above
+
+    def __init__(self, path, flush_every = None, version = None):
+        """
+        Opens the checkpoint file for appending, loading the rows completed earlier
+
+        Parameters
+        ----------
+        path : str
+            Path to the JSONL file, usually the stage's output path + ".ckpt.jsonl"
+        flush_every : int
+            Number of completed rows between flushes to disk (default: `Checkpoint.flush_every`)
+        version : str
+            Version of the results (default: `Checkpoint.version`)
+
+        Returns
+        -------
+        A new Checkpoint instance
+        """
+        self.path = path
+        self.flush_every = flush_every or Checkpoint.flush_every
+        self.version = version or Checkpoint.version
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding = "utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # The last line may be cut short by a crash
+                    if "version" in entry:
+                        if self.version is not None and entry["version"] != self.version:
+                            print(f"    Discard checkpoint {path}: it was written with other prompts or settings")
+                            self.done = {}
+                            os.remove(path)
+                            break
+                        continue
+                    self.done[self.make_key(entry["key"])] = entry["result"]
+            if self.done:
+                print(f"    Resume from checkpoint {path}: {len(self.done)} rows are already done")
+        is_new = not os.path.exists(path)
+        self.file = open(path, "a", encoding = "utf-8")
+        if is_new and self.version is not None:
+            self.file.write(json.dumps({"version" : self.version}) + "\n")
+        self.unflushed = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.done)
+
+    def __contains__(self, key):
+        return self.make_key(key) in self.done
+
+    @staticmethod
+    def make_key(key):
+        """
+        The key as a string that is the same before and after a JSON round trip, which turns
+        tuples (such as the keys of the questions answered in one call) into lists
+        """
+        def normalize(key):
+            if isinstance(key, (list, tuple)):
+                return [normalize(k) for k in key]
+            return str(key)
+        return json.dumps(normalize(key))
+
+    def add(self, key, result):
+        line = json.dumps({"key" : key, "result" : result}, ensure_ascii = False) + "\n"
+        with self.lock:
+            self.done[self.make_key(key)] = result
+            self.file.write(line)
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self.file.flush()
+                self.unflushed = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the checkpointed result for `key`, or calls `compute()` and records its result
+        """
+        with self.lock:
+            if self.make_key(key) in self.done:
+                return self.done[self.make_key(key)]
+        result = compute()
+        self.add(key, result)
+        return result
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def remove(self):
+        """
+        Deletes the checkpoint file once the stage output has been written
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
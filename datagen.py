@@ -1,5 +1,5 @@
 import pandas as pd
-import utils, promptlib
+import utils, promptlib, checkpointlib
 from tqdm import tqdm
 
 def generate_questions_for_documents(llm, num_q, schema, path_in, path_out):
@@ -15,82 +15,96 @@ def generate_questions_for_documents(llm, num_q, schema, path_in, path_out):
 
     print(f"Generate {num_q} questions for each document")
     rows_out = []
-    for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
-        doc_id = row[schema["doc_id"]]
-        doc_source = row[schema["source"]]
-        raw_document = row[schema["document"]]
-        document = utils.prepare_document(raw_document)
-        questions = promptlib.generate_questions(llm, document, num_q)
-        row_out = {
-            schema["doc_id"] : doc_id,
-            schema["source"] : doc_source,
-            schema["document"] : document,
-            schema["LLM_q"] : llm,
-            schema["orig_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(questions, start = 1)])
-        }
-        rows_out.append(row_out)
+    with checkpointlib.Checkpoint(path_out + ".ckpt.jsonl") as checkpoint:
+        for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
+            doc_id = row[schema["doc_id"]]
+            doc_source = row[schema["source"]]
+            raw_document = row[schema["document"]]
+            document = utils.prepare_document(raw_document)
+            questions = checkpoint.get_or_compute(
+                doc_id, lambda: promptlib.generate_questions(llm, document, num_q)
+            )
+            row_out = {
+                schema["doc_id"] : doc_id,
+                schema["source"] : doc_source,
+                schema["document"] : document,
+                schema["LLM_q"] : llm,
+                schema["orig_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(questions, start = 1)])
+            }
+            rows_out.append(row_out)
 
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
     utils.write_csv(df_out, path_out, "Write the table with questions to CSV file")
+    checkpoint.remove()
 
 def infuse_questions_with_false_assumptions(schema, path_in, path_out):
     df_in = utils.read_csv(path_in, "Read the document-and-questions table from CSV file")
     print("Modify each question by adding confusing (false) assumptions")
     rows_out = []
-    for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
-        doc_id = row[schema["doc_id"]]
-        doc_source = row[schema["source"]]
-        document = row[schema["document"]]
-        llm = row[schema["LLM_q"]]
-        orig_questions = utils.parse_numbered_questions(row[schema["orig_qs"]])
-        conf_questions = promptlib.confuse_questions(llm, document, orig_questions)
-        row_out = {
-            schema["doc_id"] : doc_id,
-            schema["source"] : doc_source,
-            schema["document"] : document,
-            schema["LLM_q"] : llm,
-            schema["orig_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(orig_questions, start = 1)]),
-            schema["conf_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(conf_questions, start = 1)])
-        }
-        rows_out.append(row_out)
+    with checkpointlib.Checkpoint(path_out + ".ckpt.jsonl") as checkpoint:
+        for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
+            doc_id = row[schema["doc_id"]]
+            doc_source = row[schema["source"]]
+            document = row[schema["document"]]
+            llm = row[schema["LLM_q"]]
+            orig_questions = utils.parse_numbered_questions(row[schema["orig_qs"]])
+            conf_questions = checkpoint.get_or_compute(
+                doc_id, lambda: promptlib.confuse_questions(llm, document, orig_questions)
+            )
+            row_out = {
+                schema["doc_id"] : doc_id,
+                schema["source"] : doc_source,
+                schema["document"] : document,
+                schema["LLM_q"] : llm,
+                schema["orig_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(orig_questions, start = 1)]),
+                schema["conf_qs"] : "\n".join([f"{i}. {q}" for i, q in enumerate(conf_questions, start = 1)])
+            }
+            rows_out.append(row_out)
 
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
     utils.write_csv(df_out, path_out, "Write the table with confusing questions to CSV file")
+    checkpoint.remove()
 
 def generate_RAG_responses(llm, doc_schema, doc_path, qr_schema, qr_path):
     df_in = utils.read_csv(doc_path, "Read the document-and-questions table from CSV file")
     print("Generate RAG response for each question, both original and confusing")
     rows_out = []
-    for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
-        doc_id = row[doc_schema["doc_id"]]
-        document = row[doc_schema["document"]]
-        orig_questions = utils.parse_numbered_questions(row[doc_schema["orig_qs"]])
-        conf_questions = utils.parse_numbered_questions(row[doc_schema["conf_qs"]])
-        assert len(orig_questions) == len(conf_questions)
-        for q_id, (orig_q, conf_q) in enumerate(zip(orig_questions, conf_questions), start = 1):
-            response_orig_q = promptlib.generate_response(llm, document, orig_q)
-            row_out = {
-                qr_schema["doc_id"] : doc_id,
-                qr_schema["q_id"] : q_id,
-                qr_schema["is_conf"] : "no",
-                qr_schema["question"] : orig_q,
-                qr_schema["LLM_r"] : llm,
-                qr_schema["response"] : response_orig_q
-            }
-            rows_out.append(row_out)
-            response_conf_q = promptlib.generate_response(llm, document, conf_q)
-            row_out = {
-                qr_schema["doc_id"] : doc_id,
-                qr_schema["q_id"] : q_id,
-                qr_schema["is_conf"] : "yes",
-                qr_schema["question"] : conf_q,
-                qr_schema["LLM_r"] : llm,
-                qr_schema["response"] : response_conf_q
-            }
-            rows_out.append(row_out)
+    with checkpointlib.Checkpoint(qr_path + ".ckpt.jsonl") as checkpoint:
+        for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
+            doc_id = row[doc_schema["doc_id"]]
+            document = row[doc_schema["document"]]
+            orig_questions = utils.parse_numbered_questions(row[doc_schema["orig_qs"]])
+            conf_questions = utils.parse_numbered_questions(row[doc_schema["conf_qs"]])
+            assert len(orig_questions) == len(conf_questions)
+            for q_id, (orig_q, conf_q) in enumerate(zip(orig_questions, conf_questions), start = 1):
+                response_orig_q = checkpoint.get_or_compute(
+                    (doc_id, q_id, "no"), lambda: promptlib.generate_response(llm, document, orig_q)
+                )
+                row_out = {
+                    qr_schema["doc_id"] : doc_id,
+                    qr_schema["q_id"] : q_id,
+                    qr_schema["is_conf"] : "no",
+                    qr_schema["question"] : orig_q,
+                    qr_schema["LLM_r"] : llm,
+                    qr_schema["response"] : response_orig_q
+                }
+                rows_out.append(row_out)
+                response_conf_q = checkpoint.get_or_compute(
+                    (doc_id, q_id, "yes"), lambda: promptlib.generate_response(llm, document, conf_q)
+                )
+                row_out = {
+                    qr_schema["doc_id"] : doc_id,
+                    qr_schema["q_id"] : q_id,
+                    qr_schema["is_conf"] : "yes",
+                    qr_schema["question"] : conf_q,
+                    qr_schema["LLM_r"] : llm,
+                    qr_schema["response"] : response_conf_q
+                }
+                rows_out.append(row_out)
 
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
     utils.write_csv(df_out, qr_path, "Write the question-response table to CSV file")
+    checkpoint.remove()
 
 def create_dictionary_of_indexed_documents(doc_schema, doc_path):
     df_doc = utils.read_csv(doc_path, "Read the document table from CSV file")
@@ -106,40 +120,50 @@ def find_false_assumptions_in_questions(doc_schema, doc_path, qr_schema, qr_path
     df_qr = utils.read_csv(qr_path_in, "Read the question-response table from CSV file")    
     print("Ask LLM to find a false assumption in each question, or say 'none'")
     rows_out = []
-    for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
-        doc_id = row[qr_schema["doc_id"]]
-        document = documents[doc_id]
-        question = row[qr_schema["question"]]
-        llm = row[qr_schema["LLM_r"]]
-        confusion = promptlib.find_false_assumption(llm, document, question)
-        row_out = dict(row)
-        row_out[qr_schema["confusion"]] = confusion
-        rows_out.append(row_out)
+    with checkpointlib.Checkpoint(qr_path_out + ".ckpt.jsonl") as checkpoint:
+        for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
+            doc_id = row[qr_schema["doc_id"]]
+            document = documents[doc_id]
+            question = row[qr_schema["question"]]
+            llm = row[qr_schema["LLM_r"]]
+            confusion = checkpoint.get_or_compute(
+                (doc_id, row[qr_schema["q_id"]], row[qr_schema["is_conf"]]),
+                lambda: promptlib.find_false_assumption(llm, document, question)
+            )
+            row_out = dict(row)
+            row_out[qr_schema["confusion"]] = confusion
+            rows_out.append(row_out)
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
     utils.write_csv(df_out, qr_path_out, "Write the question-response table to CSV file")
+    checkpoint.remove()
 
 def check_if_response_defused_confusion(doc_schema, doc_path, qr_schema, qr_path_in, qr_path_out):
     documents = create_dictionary_of_indexed_documents(doc_schema, doc_path)
     df_qr = utils.read_csv(qr_path_in, "Read the question-response table from CSV file")
     print("Ask LLM to check if its own response defused the confusion")
     rows_out = []
-    for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
-        doc_id = row[qr_schema["doc_id"]]
-        document = documents[doc_id]
-        question = row[qr_schema["question"]]
-        llm = row[qr_schema["LLM_r"]]
-        response = row[qr_schema["response"]]
-        confusion = row[qr_schema["confusion"]]
-        if confusion == "none":
-            defusion, is_defused = "n/a", "n/a"
-        else:
-            defusion, is_defused = promptlib.check_response_for_defusion(llm, document, question, response, confusion)
-        row_out = dict(row)
-        row_out[qr_schema["defusion"]] = defusion
-        row_out[qr_schema["is_defused"]] = is_defused
-        rows_out.append(row_out)
+    with checkpointlib.Checkpoint(qr_path_out + ".ckpt.jsonl") as checkpoint:
+        for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
+            doc_id = row[qr_schema["doc_id"]]
+            document = documents[doc_id]
+            question = row[qr_schema["question"]]
+            llm = row[qr_schema["LLM_r"]]
+            response = row[qr_schema["response"]]
+            confusion = row[qr_schema["confusion"]]
+            if confusion == "none":
+                defusion, is_defused = "n/a", "n/a"
+            else:
+                defusion, is_defused = checkpoint.get_or_compute(
+                    (doc_id, row[qr_schema["q_id"]], row[qr_schema["is_conf"]]),
+                    lambda: promptlib.check_response_for_defusion(llm, document, question, response, confusion)
+                )
+            row_out = dict(row)
+            row_out[qr_schema["defusion"]] = defusion
+            row_out[qr_schema["is_defused"]] = is_defused
+            rows_out.append(row_out)
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
     utils.write_csv(df_out, qr_path_out, "Write the question-response table to CSV file")
+    checkpoint.remove()
 
 def filter_undefused_confusions_and_compute_metrics(qr_schema, qr_path, filter_path):
     df_qr = utils.read_csv(qr_path, "Read the question-response table from CSV file")
@@ -225,7 +249,7 @@ if __name__ == "__main__":
     qrc_path_3 = "qrc_3.csv"
     filter_qrc_path = "filter_qrc.csv"
 
-    promptlib.read_prompts("prompts")
+    checkpointlib.Checkpoint.version = promptlib.read_prompts("prompts").sha256
     
     print(f"\nSTEP 1: For each document, ask LLM to write {num_q} questions answered in the document\n")
 
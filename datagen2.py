@@ -1,114 +1,113 @@
 import pandas as pd
-import os
-import utils, promptlib
+import os, argparse
+import utils, promptlib, cachelib, checkpointlib, batchlib, tablelib, metricslib, docstorelib, telemetrylib, routerlib, locallib, budgetlib, retrievallib
+from llmlib import LLM
 from tqdm import tqdm
 
 def record_llm_and_prompts(llm, doc_prompt, schema, path_in, path_out):
     """
-    Record LLM(s) and prompt(s) into the CSV table to use for generating confusing questions
+    Record LLM(s) and prompt(s) into the table to use for generating confusing questions
     """
-    df = utils.read_csv(path_in, "Read the input document table from CSV file")
-    # Check that the correct columns are present in the CSV
+    df = tablelib.read_table(path_in, "Read the input document table")
+    # Check that the correct columns are present in the table
     assert schema["document"] in set(df.columns)
     assert schema["LLM_q"] not in set(df.columns)
     assert schema["doc_prompt"] not in set(df.columns)
-    df = df.reindex(columns = df.columns.tolist() + [schema["LLM_q"], schema["doc_prompt"]])
-    df = df.astype({schema["LLM_q"]: str, schema["doc_prompt"]: str}, copy = False)
-    for row_id, row in tqdm(df.copy().iterrows(), total = df.shape[0]):
-        df.loc[row_id, schema["LLM_q"]] = llm
-        df.loc[row_id, schema["doc_prompt"]] = doc_prompt
-    utils.write_csv(df, path_out, "Write the document table with LLM names and prompt keys to CSV file")
-
-def reduce_original_documents(schema, path_in, path_out):
+    df[schema["LLM_q"]] = llm
+    df[schema["doc_prompt"]] = doc_prompt
+    tablelib.write_table(df, path_out, "Write the document table with LLM names and prompt keys")
+
+def add_document_column(schema, in_refs, out_ref, row_func, path_in, path_out, workers = 1, comments = None):
+    """
+    Stage of the document table: read the `in_refs` columns, compute the `out_ref` column by calling
+    `row_func` on every row (a dictionary of the columns read, and doc ID), and add it to the table
+    all at once.  The rows done are checkpointed next to `path_out` in case the stage fails midway.
+    `comments` are the messages to print for reading, computing, and writing.
+    """
+    comment_read, comment_compute, comment_write = comments
+    columns = tablelib.read_columns(path_in)
+    # Check that the correct columns are present in the table
+    for ref in in_refs:
+        assert schema[ref] in set(columns)
+    assert schema[out_ref] not in set(columns)
+
+    df = tablelib.read_table(path_in, comment_read, [schema["doc_id"]] + [schema[ref] for ref in in_refs])
+    print(comment_compute)
+    with checkpointlib.Checkpoint(path_out + ".ckpt.jsonl") as checkpoint:
+        values = utils.map_concurrently(row_func, df.to_dict("records"), workers,
+                                        checkpoint, key = lambda row: row[schema["doc_id"]])
+    del df
+    tablelib.append_columns(path_in, path_out, {schema[out_ref] : values}, comment_write)
+    checkpoint.remove()
+
+def reduce_row(schema, row):
+    llm = row[schema["LLM_q"]]
+    prompt_key = row[schema["doc_prompt"]]
+    document = utils.prepare_document(row[schema["document"]])
+    return promptlib.reduce_document(llm, document, prompt_key)
+
+def reduce_original_documents(schema, path_in, path_out, workers = 1):
     """
     Use LLM (or other means) to create a reduced version for each document
     """
-    df = utils.read_csv(path_in, "Read the input document table from CSV file")
-    # Check that the correct columns are present in the CSV
-    assert schema["document"] in set(df.columns)
-    assert schema["LLM_q"] in set(df.columns)
-    assert schema["doc_prompt"] in set(df.columns)
-    assert schema["reduce_doc"] not in set(df.columns)
-
-    df = df.reindex(columns = df.columns.tolist() + [schema["reduce_doc"]])
-    df = df.astype({schema["reduce_doc"]: str}, copy = False)
-    print(f"Use LLM to create a reduced version for each document from column {schema["document"]}")
-    for row_id, row in tqdm(df.copy().iterrows(), total = df.shape[0]):
-        llm = row[schema["LLM_q"]]
-        prompt_key = row[schema["doc_prompt"]]
-        document = utils.prepare_document(row[schema["document"]])
-        reduce_doc = promptlib.reduce_document(llm, document, prompt_key)
-        df.loc[row_id, schema["reduce_doc"]] = reduce_doc
-    utils.write_csv(df, path_out, "Write the document table with the reduced versions to CSV file")
-
-
-def modify_reduced_documents(schema, path_in, path_out):
+    add_document_column(schema, ["LLM_q", "doc_prompt", "document"], "reduce_doc",
+                        lambda row: reduce_row(schema, row), path_in, path_out, workers, comments = [
+        "Read the input document table",
+        f"Use LLM to create a reduced version for each document from column {schema["document"]}",
+        "Write the document table with the reduced versions"
+    ])
+
+def modify_row(schema, row):
+    llm = row[schema["LLM_q"]]
+    prompt_key = row[schema["doc_prompt"]]
+    reduce_doc = utils.prepare_document(row[schema["reduce_doc"]])
+    return promptlib.modify_reduced_document(llm, reduce_doc, prompt_key)
+
+def modify_reduced_documents(schema, path_in, path_out, workers = 1):
     """
     Ask LLM to modify or impute information into each reduced document
     """
-    df = utils.read_csv(path_in, "Read the reduced document table from CSV file")
-    # Check that the correct columns are present in the CSV
-    assert schema["LLM_q"] in set(df.columns)
-    assert schema["doc_prompt"] in set(df.columns)
-    assert schema["reduce_doc"] in set(df.columns)
-    assert schema["modify_doc"] not in set(df.columns)
-
-    df = df.reindex(columns = df.columns.tolist() + [schema["modify_doc"]])
-    df = df.astype({schema["modify_doc"]: str}, copy = False)
-    print(f"Use LLM to modify or impute information into each reduced document from column {schema["reduce_doc"]}")
-    for row_id, row in tqdm(df.copy().iterrows(), total = df.shape[0]):
-        llm = row[schema["LLM_q"]]
-        prompt_key = row[schema["doc_prompt"]]
-        reduce_doc = utils.prepare_document(row[schema["reduce_doc"]])
-        modify_doc = promptlib.modify_reduced_document(llm, reduce_doc, prompt_key)
-        df.loc[row_id, schema["modify_doc"]] = modify_doc
-    utils.write_csv(df, path_out, "Write the document table with the modified versions of reduced docs to CSV file")
-
-def expand_modified_documents(schema, path_in, path_out):
+    add_document_column(schema, ["LLM_q", "doc_prompt", "reduce_doc"], "modify_doc",
+                        lambda row: modify_row(schema, row), path_in, path_out, workers, comments = [
+        "Read the reduced document table",
+        f"Use LLM to modify or impute information into each reduced document from column {schema["reduce_doc"]}",
+        "Write the document table with the modified versions of reduced docs"
+    ])
+
+def expand_row(schema, row):
+    llm = row[schema["LLM_q"]]
+    prompt_key = row[schema["doc_prompt"]]
+    modify_doc = utils.prepare_document(row[schema["modify_doc"]])
+    return promptlib.expand_document(llm, modify_doc, prompt_key)
+
+def expand_modified_documents(schema, path_in, path_out, workers = 1):
     """
     Ask LLM to expand the modified/reduced version to the detailed document
     """
-    df = utils.read_csv(path_in, "Read the modified/reduced document table from CSV file")
-    # Check that the correct columns are present in the CSV
-    assert schema["LLM_q"] in set(df.columns)
-    assert schema["doc_prompt"] in set(df.columns)
-    # assert schema["reduce_doc"] in set(df.columns)
-    assert schema["modify_doc"] in set(df.columns)
-    assert schema["expand_doc"] not in set(df.columns)
-
-    df = df.reindex(columns = df.columns.tolist() + [schema["expand_doc"]])
-    df = df.astype({schema["expand_doc"]: str}, copy = False)
-    print(f"Use LLM to expand the modified/reduced version of the document from column {schema["modify_doc"]}")
-    for row_id, row in tqdm(df.copy().iterrows(), total = df.shape[0]):
-        llm = row[schema["LLM_q"]]
-        prompt_key = row[schema["doc_prompt"]]
-        modify_doc = utils.prepare_document(row[schema["modify_doc"]])
-        expand_doc = promptlib.expand_document(llm, modify_doc, prompt_key)
-        df.loc[row_id, schema["expand_doc"]] = expand_doc
-    utils.write_csv(df, path_out, "Write the document table with the expanded versions of reduced docs to CSV file")
-
-def generate_questions_for_documents(num_q, schema, col_refs, path_in, path_out):
+    add_document_column(schema, ["LLM_q", "doc_prompt", "modify_doc"], "expand_doc",
+                        lambda row: expand_row(schema, row), path_in, path_out, workers, comments = [
+        "Read the modified/reduced document table",
+        f"Use LLM to expand the modified/reduced version of the document from column {schema["modify_doc"]}",
+        "Write the document table with the expanded versions of reduced docs"
+    ])
+
+def questions_row(num_q, schema, doc_ref, row):
+    llm = row[schema["LLM_q"]]
+    document = utils.prepare_document(row[schema[doc_ref]])
+    return utils.enum_list(promptlib.generate_questions(llm, document, num_q))
+
+def generate_questions_for_documents(num_q, schema, col_refs, path_in, path_out, workers = 1):
     """
     For each original document, ask LLM to write `num_q` questions answered in the document
     """
     doc_ref = col_refs[0]
     que_ref = col_refs[1]
-    df = utils.read_csv(path_in, "Read the document table from CSV file")
-    # Check that the correct columns are present in the CSV
-    assert schema["LLM_q"] in set(df.columns)
-    assert schema[doc_ref] in set(df.columns)
-    assert schema[que_ref] not in set(df.columns)
-
-    df = df.reindex(columns = df.columns.tolist() + [schema[que_ref]])
-    df = df.astype({schema[que_ref]: str}, copy = False)
-    print(f"Generate {num_q} questions for each document from column {schema[doc_ref]}")
-    for row_id, row in tqdm(df.copy().iterrows(), total = df.shape[0]):
-        llm = row[schema["LLM_q"]]
-        document = utils.prepare_document(row[schema[doc_ref]])
-        questions = promptlib.generate_questions(llm, document, num_q)
-        df.loc[row_id, schema[que_ref]] = "\n".join([f"{i}. {q}" for i, q in enumerate(questions, start = 1)])
-    utils.write_csv(df, path_out, "Write the document table with questions to CSV file")
-
+    add_document_column(schema, ["LLM_q", doc_ref], que_ref,
+                        lambda row: questions_row(num_q, schema, doc_ref, row), path_in, path_out, workers, comments = [
+        "Read the document table",
+        f"Generate {num_q} questions for each document from column {schema[doc_ref]}",
+        "Write the document table with questions"
+    ])
 
 """
 def infuse_questions_with_false_assumptions(schema, path_in, path_out):
@@ -138,131 +137,306 @@ def infuse_questions_with_false_assumptions(schema, path_in, path_out):
 
 
 
-def generate_RAG_responses(llm, doc_schema, doc_path, qr_schema, qr_path):
-    df_in = utils.read_csv(doc_path, "Read the document-and-questions table from CSV file")
+def question_task_groups(doc_schema, row, questions_per_call = 1):
+    """
+    List the (doc_id, q_id, is_conf, question) tasks for the questions of one document row,
+    split into groups of up to `questions_per_call` questions of the same kind
+    """
+    doc_id = row[doc_schema["doc_id"]]
+    orig_questions = utils.parse_numbered_questions(row[doc_schema["orig_qs"]])
+    conf_questions = utils.parse_numbered_questions(row[doc_schema["conf_qs"]])
+    task_groups = []
+    for is_conf, questions in [("no", orig_questions), ("yes", conf_questions)]:
+        doc_tasks = [(doc_id, q_id, is_conf, q) for q_id, q in enumerate(questions, start = 1)]
+        for i in range(0, len(doc_tasks), questions_per_call):
+            task_groups.append(doc_tasks[i : i + questions_per_call])
+    return task_groups
+
+def respond_task_group(llm, document, task_group, index = None, top_k = None):
+    if index is not None:  # Only the passages relevant to the questions
+        document = index.context(task_group[0][0], [q for _, _, _, q in task_group], top_k)
+    if len(task_group) == 1:
+        return [promptlib.generate_response(llm, document, task_group[0][3])]
+    return promptlib.generate_responses(llm, document, [q for _, _, _, q in task_group])
+
+def question_response_row(llm, qr_schema, task, response_q):
+    doc_id, q_id, is_conf, q = task
+    return {
+        qr_schema["doc_id"] : doc_id,
+        qr_schema["q_id"] : q_id,
+        qr_schema["is_conf"] : is_conf,
+        qr_schema["question"] : q,
+        qr_schema["LLM_r"] : llm,
+        qr_schema["response"] : response_q
+    }
+
+def generate_RAG_responses(llm, doc_schema, doc_path, qr_schema, qr_path, workers = 1, batch = None,
+                           questions_per_call = 1, top_k = None, scoring = "bm25"):
+    """
+    Ask LLM to answer each question, original or confusing, given the document.
+    With `questions_per_call > 1`, several questions of the same kind about the same
+    document are answered in one call (see `promptlib.generate_responses`).
+    With `top_k`, the LLM is given only the `top_k` passages of the document most relevant
+    to each question instead of the whole document (see `retrievallib.PassageIndex`).
+    """
+    df_in = tablelib.read_table(doc_path, "Read the questions of the document table",
+                                [doc_schema["doc_id"], doc_schema["orig_qs"], doc_schema["conf_qs"]])
+    documents = docstorelib.open_store(doc_schema, doc_path)
+    index = retrievallib.open_index(doc_schema, doc_path, scoring = scoring) if top_k else None
     print("Generate RAG response for each question, both original and confusing")
-    rows_out = []
-    for _, row in tqdm(df_in.iterrows(), total = df_in.shape[0]):
-        doc_id = row[doc_schema["doc_id"]]
-        document = row[doc_schema["document"]]
-        orig_questions = utils.parse_numbered_questions(row[doc_schema["orig_qs"]])
-        conf_questions = utils.parse_numbered_questions(row[doc_schema["conf_qs"]])
-        qs = (
-            [(q_id, "no" , q) for q_id, q in enumerate(orig_questions, start = 1)] +
-            [(q_id, "yes", q) for q_id, q in enumerate(conf_questions, start = 1)]
+    task_groups = []
+    for row in df_in.to_dict("records"):
+        task_groups.extend(question_task_groups(doc_schema, row, questions_per_call))
+    # Responses from passages and from whole documents must not be mixed in one table
+    retrieval = f"top_k = {top_k}, scoring = {scoring}" if top_k else "whole documents"
+    version = f"{checkpointlib.Checkpoint.version}, {retrieval}"
+    with checkpointlib.Checkpoint(qr_path + ".ckpt.jsonl", version = version) as checkpoint:
+        response_groups = utils.map_concurrently(
+            lambda task_group: respond_task_group(llm, documents[task_group[0][0]], task_group, index, top_k),
+            task_groups, workers, checkpoint,
+            key = lambda task_group: [task[:3] for task in task_group], batch = batch
         )
-        for q_id, is_conf, q in qs:
-            response_q = promptlib.generate_response(llm, document, q)
-            row_out = {
-                qr_schema["doc_id"] : doc_id,
-                qr_schema["q_id"] : q_id,
-                qr_schema["is_conf"] : is_conf,
-                qr_schema["question"] : q,
-                qr_schema["LLM_r"] : llm,
-                qr_schema["response"] : response_q
-            }
-            rows_out.append(row_out)
+    tasks = [task for task_group in task_groups for task in task_group]
+    responses = [response for response_group in response_groups for response in response_group]
+    rows_out = [
+        question_response_row(llm, qr_schema, task, response_q) for task, response_q in zip(tasks, responses)
+    ]
 
     df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
-    utils.write_csv(df_out, qr_path, "Write the question-response table to CSV file")
-
-def create_dictionary_of_indexed_documents(doc_schema, doc_path):
-    df_doc = utils.read_csv(doc_path, "Read the document table from CSV file")
-    print("Create a dictionary of indexed documents")
-    documents = {
-        row[doc_schema["doc_id"]] : row[doc_schema["document"]]
-            for _, row in tqdm(df_doc.iterrows(), total = df_doc.shape[0])
-    }
-    return documents
-
-def find_false_assumptions_in_questions(doc_schema, doc_path, qr_schema, qr_path_in, qr_path_out):
-    documents = create_dictionary_of_indexed_documents(doc_schema, doc_path)
-    df_qr = utils.read_csv(qr_path_in, "Read the question-response table from CSV file")    
+    tablelib.write_table(df_out, qr_path, "Write the question-response table")
+    checkpoint.remove()
+
+def confusion_row(qr_schema, document, row):
+    question = row[qr_schema["question"]]
+    llm = row[qr_schema["LLM_r"]]
+    return promptlib.find_false_assumption(llm, document, question)
+
+def find_false_assumptions_in_questions(doc_schema, doc_path, qr_schema, qr_path_in, qr_path_out,
+                                        workers = 1, batch = None):
+    documents = docstorelib.open_store(doc_schema, doc_path)
+    df_qr = tablelib.read_table(qr_path_in, "Read the question-response table",
+                                [qr_schema["doc_id"], qr_schema["q_id"], qr_schema["is_conf"], qr_schema["question"], qr_schema["LLM_r"]])
     print("Ask LLM to find a false assumption in each question, or say 'none'")
-    rows_out = []
-    for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
-        doc_id = row[qr_schema["doc_id"]]
-        document = documents[doc_id]
-        question = row[qr_schema["question"]]
-        llm = row[qr_schema["LLM_r"]]
-        confusion = promptlib.find_false_assumption(llm, document, question)
-        row_out = dict(row)
-        row_out[qr_schema["confusion"]] = confusion
-        rows_out.append(row_out)
-    df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
-    utils.write_csv(df_out, qr_path_out, "Write the question-response table to CSV file")
-
-def check_if_response_defused_confusion(doc_schema, doc_path, qr_schema, qr_path_in, qr_path_out):
-    documents = create_dictionary_of_indexed_documents(doc_schema, doc_path)
-    df_qr = utils.read_csv(qr_path_in, "Read the question-response table from CSV file")
+    rows_in = df_qr.to_dict("records")
+    with checkpointlib.Checkpoint(qr_path_out + ".ckpt.jsonl") as checkpoint:
+        confusions = utils.map_concurrently(
+            lambda row: confusion_row(qr_schema, documents[row[qr_schema["doc_id"]]], row),
+            rows_in, workers, checkpoint,
+            key = lambda row: (row[qr_schema["doc_id"]], row[qr_schema["q_id"]], row[qr_schema["is_conf"]]),
+            batch = batch
+        )
+    tablelib.append_columns(qr_path_in, qr_path_out, {qr_schema["confusion"] : confusions},
+                            "Write the question-response table with confusions")
+    checkpoint.remove()
+
+def defusion_row(qr_schema, document, row):
+    question = row[qr_schema["question"]]
+    llm = row[qr_schema["LLM_r"]]
+    response = row[qr_schema["response"]]
+    confusion = row[qr_schema["confusion"]]
+    if confusion == "none":
+        return "n/a", "n/a"
+    return promptlib.check_response_for_defusion(llm, document, question, response, confusion)
+
+def check_if_response_defused_confusion(doc_schema, doc_path, qr_schema, qr_path_in, qr_path_out,
+                                        workers = 1, batch = None):
+    documents = docstorelib.open_store(doc_schema, doc_path)
+    df_qr = tablelib.read_table(qr_path_in, "Read the question-response table",
+                                [qr_schema["doc_id"], qr_schema["q_id"], qr_schema["is_conf"], qr_schema["question"], qr_schema["LLM_r"],
+                                 qr_schema["response"], qr_schema["confusion"]])
     print("Ask LLM to check if its own response defused the confusion")
-    rows_out = []
-    for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
-        doc_id = row[qr_schema["doc_id"]]
-        document = documents[doc_id]
-        question = row[qr_schema["question"]]
-        llm = row[qr_schema["LLM_r"]]
-        response = row[qr_schema["response"]]
-        confusion = row[qr_schema["confusion"]]
-        if confusion == "none":
-            defusion, is_defused = "n/a", "n/a"
-        else:
-            defusion, is_defused = promptlib.check_response_for_defusion(llm, document, question, response, confusion)
-        row_out = dict(row)
-        row_out[qr_schema["defusion"]] = defusion
-        row_out[qr_schema["is_defused"]] = is_defused
-        rows_out.append(row_out)
-    df_out = pd.DataFrame.from_dict(rows_out, dtype = str)
-    utils.write_csv(df_out, qr_path_out, "Write the question-response table to CSV file")
+    rows_in = df_qr.to_dict("records")
+    with checkpointlib.Checkpoint(qr_path_out + ".ckpt.jsonl") as checkpoint:
+        defusions = utils.map_concurrently(
+            lambda row: defusion_row(qr_schema, documents[row[qr_schema["doc_id"]]], row),
+            rows_in, workers, checkpoint,
+            key = lambda row: (row[qr_schema["doc_id"]], row[qr_schema["q_id"]], row[qr_schema["is_conf"]]),
+            batch = batch
+        )
+    tablelib.append_columns(qr_path_in, qr_path_out, {
+        qr_schema["defusion"] : [defusion for defusion, _ in defusions],
+        qr_schema["is_defused"] : [is_defused for _, is_defused in defusions]
+    }, "Write the question-response table with defusion checks")
+    checkpoint.remove()
 
 def filter_undefused_confusions_and_compute_metrics(qr_schema, qr_path, filter_path):
-    df_qr = utils.read_csv(qr_path, "Read the question-response table from CSV file")
-
-    num_orig_questions = 0
-    num_conf_questions = 0
-    num_orig_questions_with_confusion_detected = 0
-    num_conf_questions_with_confusion_detected = 0
-    num_orig_questions_with_conf_detected_and_defused = 0
-    num_conf_questions_with_conf_detected_and_defused = 0
-
-    filter_rows = []
-    for _, row in tqdm(df_qr.iterrows(), total = df_qr.shape[0]):
-        is_conf = row[qr_schema["is_conf"]]
-        confusion = row[qr_schema["confusion"]]
-        is_defused = row[qr_schema["is_defused"]]
-        if is_conf == "yes":
-            num_conf_questions += 1
-            if confusion != "none":
-                num_conf_questions_with_confusion_detected += 1
-                if is_defused == "yes":
-                    num_conf_questions_with_conf_detected_and_defused += 1
-                else:
-                    filter_rows.append(dict(row))
-        elif is_conf == "no":
-            num_orig_questions += 1
-            if confusion != "none":
-                num_orig_questions_with_confusion_detected += 1
-                if is_defused == "yes":
-                    num_orig_questions_with_conf_detected_and_defused += 1
-    print("Original (non-confusing) questions:")
-    print(f"    Total questions = {num_orig_questions}")
-    print(f"    With confusion detected = {num_orig_questions_with_confusion_detected}")
-    print(f"    With confusion detected and defused = {num_orig_questions_with_conf_detected_and_defused}")
-    print("Confusing questions:")
-    num_conf_questions_with_conf_detected_but_undefused = \
-        num_conf_questions_with_confusion_detected - num_conf_questions_with_conf_detected_and_defused
-    print(f"    Total questions = {num_conf_questions}")
-    print(f"    With confusion detected = {num_conf_questions_with_confusion_detected}")
-    print(f"    With confusion detected and defused = {num_conf_questions_with_conf_detected_and_defused}")
-    print(f"    With confusion detected, but not defused = {num_conf_questions_with_conf_detected_but_undefused}")
-
-    df_filter = pd.DataFrame.from_dict(filter_rows, dtype = str)
-    utils.write_csv(df_filter, filter_path, "Write the filtered question-response table to CSV file")
+    """
+    Count the questions with confusion detected and defused (see `metricslib`), and write
+    the confusing questions whose confusion was detected, but not defused, to the filter table
+    """
+    df_qr = tablelib.read_table(qr_path, "Read the question-response table")
+    metrics = metricslib.count_metrics(df_qr, qr_schema)
+    metricslib.print_metrics(metrics)
+    intervals = metricslib.bootstrap_intervals(metrics)
+    row = intervals.iloc[0]
+    for kind, name in [("orig", "Original"), ("conf", "Confusing")]:
+        for rate, title in [("detected_rate", "confusion detected"), ("defused_given_detected", "defused if detected")]:
+            value, low, high = row[kind + "_" + rate], row[kind + "_" + rate + "_low"], row[kind + "_" + rate + "_high"]
+            print(f"{name} questions, rate of {title} = {value:.3f}  (95% CI {low:.3f} - {high:.3f})")
+
+    df_filter = metricslib.filter_undefused_confusions(df_qr, qr_schema)
+    tablelib.write_table(df_filter, filter_path, "Write the filtered question-response table")
+    return intervals
+
+
+def stream_column(func, rows, column, workers = 1):
+    """
+    Streaming stage: yields each row dictionary with `column` set to `func(row)`, as soon as it is done
+    """
+    def add_column(row):
+        return {**row, column : func(row)}
+    yield from utils.imap_concurrently(add_column, rows, workers)
 
+def stream_documents(llm, doc_prompt, num_q_orig, num_q_conf, schema, rows, workers = 1, tees = None):
+    """
+    Streaming version of STEPS 0-5: every document row flows through all the stages without
+    waiting for the other documents.  If `tees` maps a step number to a `utils.CSVWriter`,
+    the rows are also written out after that step.
+    """
+    tees = tees or {}
+    rows = ({**row, schema["LLM_q"] : llm, schema["doc_prompt"] : doc_prompt} for row in rows)
+    rows = utils.tee_rows(rows, tees.get(0))
+    rows = stream_column(lambda row: reduce_row(schema, row), rows, schema["reduce_doc"], workers)
+    rows = utils.tee_rows(rows, tees.get(1))
+    rows = stream_column(lambda row: modify_row(schema, row), rows, schema["modify_doc"], workers)
+    rows = utils.tee_rows(rows, tees.get(2))
+    rows = stream_column(lambda row: expand_row(schema, row), rows, schema["expand_doc"], workers)
+    rows = utils.tee_rows(rows, tees.get(3))
+    rows = stream_column(lambda row: questions_row(num_q_orig, schema, "document", row),
+                         rows, schema["orig_qs"], workers)
+    rows = utils.tee_rows(rows, tees.get(4))
+    rows = stream_column(lambda row: questions_row(num_q_conf, schema, "expand_doc", row),
+                         rows, schema["conf_qs"], workers)
+    return utils.tee_rows(rows, tees.get(5))
+
+def stream_question_responses(llm, doc_schema, qr_schema, doc_rows, workers = 1, questions_per_call = 1,
+                              tees = None):
+    """
+    Streaming version of STEPS 6-8: yields the question-response rows of each document
+    as soon as its responses are generated and checked.  If `tees` maps a step number
+    to a `utils.CSVWriter`, the rows are also written out after that step.
+    """
+    tees = tees or {}
+    def document_task_groups():
+        for row in doc_rows:
+            document = row[doc_schema["document"]]
+            for task_group in question_task_groups(doc_schema, row, questions_per_call):
+                yield document, task_group
+    def respond(item):
+        document, task_group = item
+        responses = respond_task_group(llm, document, task_group)
+        return document, [
+            question_response_row(llm, qr_schema, task, response_q) for task, response_q in zip(task_group, responses)
+        ]
+    def tee(items, writer):
+        for document, row in items:
+            if writer is not None:
+                writer.write(row)
+            yield document, row
+    def confuse(item):
+        document, row = item
+        return document, {**row, qr_schema["confusion"] : confusion_row(qr_schema, document, row)}
+    def defuse(item):
+        document, row = item
+        defusion, is_defused = defusion_row(qr_schema, document, row)
+        return {**row, qr_schema["defusion"] : defusion, qr_schema["is_defused"] : is_defused}
+    items = (
+        (document, row) for document, rows in utils.imap_concurrently(respond, document_task_groups(), workers)
+            for row in rows
+    )
+    items = tee(items, tees.get(6))
+    items = utils.imap_concurrently(confuse, items, workers)
+    items = tee(items, tees.get(7))
+    return utils.imap_concurrently(defuse, items, workers)
+
+def stream_pipeline(llm_q, llm_r, doc_prompt, num_q_orig, num_q_conf, doc_schema, doc_paths,
+                    qr_schema, qr_paths, workers = 1, questions_per_call = 1, write_intermediate = False):
+    """
+    Run STEPS 0-8 as one stream of rows: documents are read in chunks, and each one goes through
+    all the LLM stages while the next ones are in flight.  Only the final tables are written,
+    unless `write_intermediate` is set.
+    """
+    doc_steps = {0 : 0, 1 : 1, 2 : 2, 3 : 3, 4 : 4, 5 : "out"}
+    qr_steps = {6 : 1, 7 : 2}
+    tees = {}
+    try:
+        tees[5] = utils.CSVWriter(doc_paths["out"], "Write the document table with questions to CSV file")
+        if write_intermediate:
+            for step, k in doc_steps.items():
+                if k != "out":
+                    tees[step] = utils.CSVWriter(doc_paths[k], f"Write the document table after STEP {step} to CSV file")
+            for step, k in qr_steps.items():
+                tees[step] = utils.CSVWriter(qr_paths[k], f"Write the question-response table after STEP {step} to CSV file")
+        doc_rows = utils.iter_csv(doc_paths["in"], "Stream the input document table from CSV file")
+        doc_rows = stream_documents(llm_q, doc_prompt, num_q_orig, num_q_conf, doc_schema, doc_rows, workers, tees)
+        qr_rows = stream_question_responses(llm_r, doc_schema, qr_schema, doc_rows, workers, questions_per_call, tees)
+        with utils.CSVWriter(qr_paths["out"], "Write the question-response table to CSV file") as qr_writer:
+            for row in tqdm(qr_rows, desc = "Question-response rows"):
+                qr_writer.write(row)
+    finally:
+        for writer in tees.values():
+            writer.close()
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description = "Generate confusing questions and check LLM's RAG responses")
+    parser.add_argument("--workers", type = int, default = 1,
+                        help = "Number of rows (LLM calls) to process concurrently in each stage")
+    parser.add_argument("--checkpoint-every", type = int, default = checkpointlib.Checkpoint.flush_every,
+                        help = "Number of completed rows between flushes of a stage's checkpoint file")
+    parser.add_argument("--questions-per-call", type = int, default = 1,
+                        help = "Number of questions about the same document to answer in one LLM call in STEP 6")
+    parser.add_argument("--modify-strategy", choices = ["sequential", "parallel"], default = "sequential",
+                        help = "Impute the suppressed facts of STEP 2 in three dependent rounds, or in three concurrent calls")
+    parser.add_argument("--early-verdicts", choices = ["off", "keep-text", "cut-text"], default = "off",
+                        help = "Stream the replies to the yes/no checks of STEPS 7-8 and stop reading once the verdict " +
+                               "is clear; with keep-text, the defusion replies are still read in full, since they are stored")
+    parser.add_argument("--structured-verdicts", action = "store_true",
+                        help = "Ask for the replies to the yes/no checks of STEPS 7-8 as JSON {\"verdict\", \"reason\"}, " +
+                               "with a JSON schema or JSON mode where the LLM supports it")
+    parser.add_argument("--batch", choices = ["openai", "local"],
+                        help = "Submit the LLM calls of STEPS 6-8 as batch jobs (\"local\" is an offline stand-in)")
+    parser.add_argument("--stream", action = "store_true",
+                        help = "Stream each document through STEPS 0-8 instead of running the steps one table at a time")
+    parser.add_argument("--write-intermediate", action = "store_true",
+                        help = "With --stream, also write the intermediate tables of every step")
+    parser.add_argument("--table-format", choices = ["csv", "parquet"], default = "csv",
+                        help = "File format of the tables written by the steps (parquet requires pyarrow)")
+    parser.add_argument("--prompts", nargs = "+", default = ["prompts"],
+                        help = "Folders with the prompt templates, read side by side")
+    parser.add_argument("--max-document-tokens", type = int,
+                        help = "Split the documents longer than this into chunks (as for those too long for the context " +
+                               "window), to bound the latency of a call")
+    parser.add_argument("--rag-top-k", type = int,
+                        help = "In STEP 6, give LLM only the K passages of the document most relevant to each question")
+    parser.add_argument("--rag-scoring", choices = ["bm25", "tfidf"], default = "bm25",
+                        help = "Lexical scoring of the passages for --rag-top-k")
+    parser.add_argument("--routes",
+                        help = "JSON file that spreads the calls to an LLM over several endpoints or API keys, see routerlib.read_routes")
+    parser.add_argument("--local-llm", nargs = 2, action = "append", default = [], metavar = ("NAME", "MODEL_PATH"),
+                        help = "Run the LLM called NAME (such as llama3-8B-in) in this process, from the model at MODEL_PATH " +
+                               "(requires torch and transformers)")
+    parser.add_argument("--metrics-jsonl",
+                        help = "File to append a record of every LLM call to (latency, tokens, status, retries)")
+    parser.add_argument("--metrics-prometheus",
+                        help = "File to write the LLM call metrics to, in Prometheus text format, after every step")
+    parser.add_argument("--cache", default = "llm_cache.sqlite",
+                        help = "File (in the data folder) to cache LLM responses across runs")
+    parser.add_argument("--no-cache", action = "store_true",
+                        help = "Do not read or write the LLM response cache")
+    parser.add_argument("--cache-deterministic-only", action = "store_true",
+                        help = "Cache only the responses generated with temperature = 0")
+    parser.add_argument("--cache-max-mb", type = int, default = 1024,
+                        help = "Evict least recently used cached responses beyond this size")
+    args = parser.parse_args()
+    if args.stream and args.batch:
+        parser.error("--stream cannot be combined with --batch")
+    if args.stream and args.rag_top_k:
+        parser.error("--stream cannot be combined with --rag-top-k, which indexes the document table")
+    if args.stream and args.table_format != "csv":
+        parser.error("--stream writes its tables row by row, in CSV format only")
+
     doc_csv_schema = {
         "doc_id" : "doc_id",           # Column with a unique document ID
         "source" : "source",           # Column with document source (e.g. URL)
@@ -315,55 +489,117 @@ if __name__ == "__main__":
         2 : "qrc_2.csv"
     }
 
-    doc_paths = {k : os.path.join(data_folder, v) for k, v in doc_files.items()}
-    qrc_paths = {k : os.path.join(data_folder, v) for k, v in qrc_files.items()}
+    table_files = lambda files: {
+        k : (v if k == "in" else os.path.splitext(v)[0] + "." + args.table_format) for k, v in files.items()
+    }
+    doc_paths = {k : os.path.join(data_folder, v) for k, v in table_files(doc_files).items()}
+    qrc_paths = {k : os.path.join(data_folder, v) for k, v in table_files(qrc_files).items()}
+
+    prompt_book = promptlib.read_prompts(*args.prompts)
+    for name, model_path in args.local_llm:
+        remote = LLM.get(name)
+        locallib.LocalLLM(name, model_path, dict(remote.parameters) if remote else {"temperature" : 0.7})
+    if args.routes:
+        for routed in routerlib.read_routes(args.routes):
+            print(f"Routing {routed.name} over {len(routed.endpoints)} endpoints ({routed.policy})")
+    promptlib.modify_strategy = args.modify_strategy
+    budgetlib.max_document_tokens = args.max_document_tokens
+    promptlib.early_verdicts = args.early_verdicts != "off"
+    promptlib.keep_verdict_text = args.early_verdicts != "cut-text"
+    promptlib.structured_verdicts = args.structured_verdicts
+
+    checkpointlib.Checkpoint.flush_every = args.checkpoint_every
+    checkpointlib.Checkpoint.version = prompt_book.sha256
+
+    batch = None
+    if args.batch == "openai":
+        batch = batchlib.OpenAIBatchBackend()
+    elif args.batch == "local":
+        batch = batchlib.LocalBatchBackend(os.path.join(data_folder, "batches"))
+
+    LLM.metrics = telemetrylib.CallMetrics(args.metrics_jsonl, args.metrics_prometheus)
+
+    if not args.no_cache:
+        LLM.cache = cachelib.ResponseCache(
+            os.path.join(data_folder, args.cache),
+            max_bytes = args.cache_max_mb << 20,
+            cache_sampled = not args.cache_deterministic_only
+        )
 
-    promptlib.read_prompts("prompts")
+    if args.stream:
 
-    print(f"\nSTEP 0: Record LLM(s) and prompt(s) to use for generating confusing questions\n")
+        print(f"\nSTEPS 0-8: Stream each document through all the LLM stages\n")
 
-    record_llm_and_prompts(llm_q, doc_prompt, doc_csv_schema, doc_paths["in"], doc_paths[0])
-    
-    print(f"\nSTEP 1: Use LLM (or other means) to create a reduced version for each document\n")
-    
-    reduce_original_documents(doc_csv_schema, doc_paths[0], doc_paths[1])
+        with LLM.metrics.stage("STEPS 0-8"):
+            stream_pipeline(llm_q, llm_r, doc_prompt, num_q_orig, num_q_conf, doc_csv_schema, doc_paths,
+                            qrc_csv_schema, qrc_paths, args.workers, args.questions_per_call, args.write_intermediate)
 
-    print(f"\nSTEP 2: Ask LLM to modify or impute information into each reduced document\n")
+        promptlib.print_prompt_cache_report()
 
-    modify_reduced_documents(doc_csv_schema, doc_paths[1], doc_paths[2])
+    else:
 
-    print(f"\nSTEP 3: Ask LLM to expand the modified/reduced version to the detailed document\n")
+        print(f"\nSTEP 0: Record LLM(s) and prompt(s) to use for generating confusing questions\n")
 
-    expand_modified_documents(doc_csv_schema, doc_paths[2], doc_paths[3])
+        record_llm_and_prompts(llm_q, doc_prompt, doc_csv_schema, doc_paths["in"], doc_paths[0])
 
-    print(f"\nSTEP 4: For each original document, ask LLM to write " +
-          f"{num_q_orig} questions answered in the document\n")
+        print(f"\nSTEP 1: Use LLM (or other means) to create a reduced version for each document\n")
 
-    generate_questions_for_documents(num_q_orig, doc_csv_schema, ["document", "orig_qs"],
-                                     doc_paths[3], doc_paths[4])
+        with LLM.metrics.stage("STEP 1"):
+            reduce_original_documents(doc_csv_schema, doc_paths[0], doc_paths[1], args.workers)
 
-    print(f"\nSTEP 5: For each expanded document, ask LLM to write " +
-          f"{num_q_conf} questions answered in the document\n")
+        print(f"\nSTEP 2: Ask LLM to modify or impute information into each reduced document\n")
 
-    generate_questions_for_documents(num_q_conf, doc_csv_schema, ["expand_doc", "conf_qs"],
-                                     doc_paths[4], doc_paths["out"])
+        with LLM.metrics.stage("STEP 2"):
+            modify_reduced_documents(doc_csv_schema, doc_paths[1], doc_paths[2], args.workers)
 
-    print("\nSTEP 6: Give LLM the document and the question and record LLM's response\n")
+        print(f"\nSTEP 3: Ask LLM to expand the modified/reduced version to the detailed document\n")
 
-    generate_RAG_responses(llm_r, doc_csv_schema, doc_paths["out"], qrc_csv_schema, qrc_paths[1])
-    
-    
-    print("\nSTEP 7: Ask LLM to find the false assumption in each question\n")
+        with LLM.metrics.stage("STEP 3"):
+            expand_modified_documents(doc_csv_schema, doc_paths[2], doc_paths[3], args.workers)
 
-    find_false_assumptions_in_questions(doc_csv_schema, doc_paths["out"],
-                                        qrc_csv_schema, qrc_paths[1], qrc_paths[2])
-    
-    print("\nSTEP 8: Ask LLM if its initial response pointed out the false assumption\n")
+        print(f"\nSTEP 4: For each original document, ask LLM to write " +
+              f"{num_q_orig} questions answered in the document\n")
+
+        with LLM.metrics.stage("STEP 4"):
+            generate_questions_for_documents(num_q_orig, doc_csv_schema, ["document", "orig_qs"],
+                                             doc_paths[3], doc_paths[4], args.workers)
+
+        print(f"\nSTEP 5: For each expanded document, ask LLM to write " +
+              f"{num_q_conf} questions answered in the document\n")
+
+        with LLM.metrics.stage("STEP 5"):
+            generate_questions_for_documents(num_q_conf, doc_csv_schema, ["expand_doc", "conf_qs"],
+                                             doc_paths[4], doc_paths["out"], args.workers)
+
+        promptlib.print_prompt_cache_report()
+
+        print("\nSTEP 6: Give LLM the document and the question and record LLM's response\n")
+
+        with LLM.metrics.stage("STEP 6"):
+            generate_RAG_responses(llm_r, doc_csv_schema, doc_paths["out"], qrc_csv_schema, qrc_paths[1],
+                                   args.workers, batch, args.questions_per_call, args.rag_top_k, args.rag_scoring)
+
+
+        print("\nSTEP 7: Ask LLM to find the false assumption in each question\n")
+
+        with LLM.metrics.stage("STEP 7"):
+            find_false_assumptions_in_questions(doc_csv_schema, doc_paths["out"],
+                                                qrc_csv_schema, qrc_paths[1], qrc_paths[2], args.workers, batch)
+
+        print("\nSTEP 8: Ask LLM if its initial response pointed out the false assumption\n")
+
+        with LLM.metrics.stage("STEP 8"):
+            check_if_response_defused_confusion(doc_csv_schema, doc_paths["out"],
+                                                qrc_csv_schema, qrc_paths[2], qrc_paths["out"], args.workers, batch)
 
-    check_if_response_defused_confusion(doc_csv_schema, doc_paths["out"],
-                                        qrc_csv_schema, qrc_paths[2], qrc_paths["out"])
-    
     print("\nSTEP 9: Compute performance metrics across all original and modified questions")
 
     filter_undefused_confusions_and_compute_metrics(qrc_csv_schema, qrc_paths["out"], qrc_paths["filter"])
-    
\ No newline at end of file
+    
+
+    print()
+    LLM.metrics.print_summary()
+    LLM.metrics.close()
+
+    if LLM.cache is not None:
+        print(f"\n{LLM.cache}")
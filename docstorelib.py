@@ -0,0 +1,116 @@
+import os, sqlite3, threading
+from collections import OrderedDict
+import tablelib
+
+class DocumentStore:
+    """
+    Persistent `doc_id -> document` index of a document table, stored in a SQLite file next to it
+
+    The index is built once from the table, and rebuilt only when the table changes
+    (by size or modification time), so the stages that look up documents by ID neither
+    re-parse the document table nor hold all the documents in memory.  The most recently
+    used documents are kept in a small in-memory cache, since question rows come grouped
+    by document.  Lookups are thread-safe.
+    """
+    def __init__(self, doc_path, doc_schema, cache_size = 64):
+        """
+        Opens the index of the document table, building it if needed
+
+        Parameters
+        ----------
+        doc_path : str
+            Path to the document table (any format supported by `tablelib`)
+        doc_schema : dict
+            Column names of the document table, the store uses "doc_id" and "document"
+        cache_size : int
+            Number of recently used documents to keep in memory
+
+        Returns
+        -------
+        A new DocumentStore instance
+        """
+        self.doc_path = doc_path
+        self.path = doc_path + ".docs.sqlite"
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread = False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS source (path TEXT, size INTEGER, mtime REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, document TEXT)")
+        self.refresh(doc_schema)
+
+    def refresh(self, doc_schema):
+        """
+        Rebuilds the index if the document table changed since it was built
+        """
+        with self.lock:
+            source = self.conn.execute("SELECT path, size, mtime FROM source").fetchone()
+        if source != self.source_stat():
+            self.build(doc_schema)
+
+    def source_stat(self):
+        paths = [self.doc_path] if os.path.isfile(self.doc_path) else [
+            os.path.join(self.doc_path, name) for name in os.listdir(self.doc_path)
+        ]
+        stats = [os.stat(path) for path in paths]
+        return (os.path.abspath(self.doc_path), sum(s.st_size for s in stats), max(s.st_mtime for s in stats))
+
+    def build(self, doc_schema):
+        df_doc = tablelib.read_table(self.doc_path, "Index the documents of the document table",
+                                     [doc_schema["doc_id"], doc_schema["document"]])
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM documents")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?)",
+                zip(df_doc[doc_schema["doc_id"]], df_doc[doc_schema["document"]])
+            )
+            self.conn.execute("DELETE FROM source")
+            self.conn.execute("INSERT INTO source VALUES (?, ?, ?)", self.source_stat())
+            self.cache.clear()
+        print(f"    Indexed {len(df_doc)} documents in {self.path}")
+
+    def __getitem__(self, doc_id):
+        with self.lock:
+            if doc_id in self.cache:
+                self.cache.move_to_end(doc_id)
+                return self.cache[doc_id]
+            row = self.conn.execute("SELECT document FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                raise KeyError(doc_id)
+            self.cache[doc_id] = row[0]
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+            return row[0]
+
+    def __contains__(self, doc_id):
+        try:
+            self[doc_id]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+stores = {}  # Document table path -> DocumentStore, shared by the stages of a run
+stores_lock = threading.Lock()
+
+def open_store(doc_schema, doc_path):
+    """
+    The shared document store of the document table at `doc_path`, opened on first use
+    """
+    with stores_lock:
+        key = os.path.abspath(doc_path)
+        if key in stores:
+            stores[key].refresh(doc_schema)
+        else:
+            stores[key] = DocumentStore(doc_path, doc_schema)
+        return stores[key]
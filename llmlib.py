@@ -1,12 +1,88 @@
 from openai import OpenAI
-import os, time, requests, json, re
+import os, time, json, re, asyncio, threading, atexit, queue
+import httpx
 from collections import defaultdict
+from ratelimitlib import RateLimiter, AdaptiveLimit, RETRY_STATUS_CODES, parse_retry_after, backoff_delay
+import telemetrylib
 
 class LLMException(Exception):
-    pass
+    def __init__(self, message, status = None):
+        super().__init__(message)
+        self.status = status  # HTTP status of the last attempt, `None` if there was no response
+
+
+class _Engine:
+    """
+    Background asyncio event loop shared by all LLM instances.
+
+    The loop runs in a daemon thread and owns one keep-alive connection pool
+    (`httpx.AsyncClient`) per server, so every call to the same `url` reuses
+    open TCP+TLS connections.  Coroutines are submitted from any thread (or any
+    other event loop) with `submit()`, which returns a `concurrent.futures.Future`.
+    """
+    def __init__(self, timeout = 600.0, max_connections = 100):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.loop = None
+        self.thread = None
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target = self.loop.run_forever, name = "llmlib-engine", daemon = True
+                )
+                self.thread.start()
+        return self.loop
+
+    def in_engine_thread(self):
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def client(self, url):
+        """
+        Get the connection pool for the server of `url` (must be called on the engine loop)
+        """
+        key = httpx.URL(url).copy_with(path = "/", query = None, fragment = None)
+        client = self.clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout = self.timeout,
+                limits = httpx.Limits(
+                    max_connections = self.max_connections,
+                    max_keepalive_connections = self.max_connections
+                )
+            )
+            self.clients[key] = client
+        return client
+
+    def close(self):
+        if self.loop is None or not self.loop.is_running():
+            return
+        async def close_clients():
+            for client in self.clients.values():
+                await client.aclose()
+            self.clients.clear()
+        try:
+            self.submit(close_clients()).result(timeout = 5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+_engine = _Engine()
+atexit.register(_engine.close)
+
 
 class LLM:
     registry = defaultdict(lambda: None)
+    cache = None  # Optional `cachelib.ResponseCache` consulted by all LLM calls
+    batch = None  # Optional `batchlib.BatchSession` that collects LLM calls into batch jobs
+    metrics = telemetrylib.CallMetrics()  # Latency and token usage of all LLM calls
     @classmethod
     def get(cls, name):
         """
@@ -14,7 +90,8 @@ class LLM:
         """
         return cls.registry[name]
 
-    def __init__(self, name, model, url, headers, parameters):
+    def __init__(self, name, model, url, headers, parameters, max_concurrency = 8,
+                 requests_per_minute = None, tokens_per_minute = None, max_retries = 6, structured_output = None):
         """
         Creates a new LLM instance that connects to actual remote LLM using REST API
 
@@ -30,6 +107,19 @@ class LLM:
             Provided at REST API calls, in particular contains the secret API key
         parameters : dict
             LLM inference (hyper-)parameters, provided at calls
+        max_concurrency : int
+            Maximum number of requests to this model that may be in flight at once;
+            the actual limit adapts to the rate-limit headroom reported by the server
+        requests_per_minute : int
+            Initial requests/min budget (if `None`, learned from `x-ratelimit-*` headers)
+        tokens_per_minute : int
+            Initial tokens/min budget (if `None`, learned from `x-ratelimit-*` headers)
+        max_retries : int
+            Number of retries, with jittered exponential backoff, after status 429, 5xx,
+            or a connection error
+        structured_output : str
+            The kind of `response_format` the model supports: "json_schema", "json_object" (any JSON),
+            or `None` if it does not support one
 
         Returns
         -------
@@ -42,6 +132,12 @@ class LLM:
         self.url = url
         self.headers = headers
         self.parameters = parameters
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.structured_output = structured_output
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self._thread_local = threading.local()
 
     def __repr__(self):
         return (
@@ -53,9 +149,90 @@ class LLM:
     def __str__(self):
         return self.name
 
-    def __call__(self, prompt):
+    @property
+    def last_usage(self):
+        """
+        The `usage` block (prompt, completion and cached tokens) of the last call this thread
+        made through `__call__`, or `None` if that call was served without the model (e.g. from cache)
+        """
+        return getattr(self._thread_local, "usage", None)
+
+    def __call__(self, prompt, on_text = None, parameters = None):
+        """
+        Performs LLM inference and waits for the result (thin wrapper over `acall`)
+
+        Parameters
+        ----------
+        prompt : str | list | dict
+            See `acall`
+        on_text : callable
+            See `acall`
+        parameters : dict
+            See `acall`
+
+        Returns
+        -------
+            str
+        """
+        if _engine.in_engine_thread():
+            raise LLMException("Synchronous LLM call from inside the engine loop, use `await acall()`")
+        labels = telemetrylib.current_labels()
+        text_output, self._thread_local.usage = _engine.submit(self._post(prompt, labels, on_text, parameters)).result()
+        return text_output
+
+    def stream(self, prompt):
+        """
+        Performs LLM inference with a streamed response, yielding the pieces of text as they arrive;
+        closing the iterator early (e.g. `break` out of the loop) cancels the rest of the generation.
+        If the call is retried (or fails over to another endpoint) after some text was yielded, and the
+        new response does not repeat that text, the stream raises `LLMException`, since the pieces
+        already yielded cannot be taken back.
+
+        Parameters
+        ----------
+        prompt : str | list | dict
+            See `acall`
+
+        Returns
+        -------
+            iterator of str
         """
-        Issues a POST call to perform LLM inference
+        if _engine.in_engine_thread():
+            raise LLMException("Synchronous LLM call from inside the engine loop, use `await acall()`")
+        pieces = queue.Queue()
+        done = object()
+        restarted = object()
+        read_text = ""
+        def on_text(text):
+            nonlocal read_text
+            if text.startswith(read_text):
+                pieces.put(text[len(read_text):])
+                read_text = text
+                return False
+            if read_text.startswith(text):  # A retry, repeating so far the text already yielded
+                return False
+            pieces.put(restarted)
+            return True  # Stop the generation, its text no longer continues the pieces yielded
+        future = _engine.submit(self._post(prompt, telemetrylib.current_labels(), on_text))
+        future.add_done_callback(lambda _: pieces.put(done))
+        try:
+            while (piece := pieces.get()) is not done:
+                if piece is restarted:
+                    raise LLMException(
+                        f"Model = {self.model}, Error = the response was retried after {len(read_text)} characters " +
+                        f"were streamed, and the new one differs from them\nPrompt: {prompt}"
+                    )
+                yield piece
+            future.result()  # Raises the error of the call, if any
+        finally:
+            future.cancel()
+
+    async def acall(self, prompt, on_text = None, parameters = None):
+        """
+        Issues a POST call to perform LLM inference, without blocking the event loop
+
+        The request runs on the shared engine loop, using a keep-alive connection
+        pool per server and at most `max_concurrency` requests in flight for this model.
 
         Parameters
         ----------
@@ -65,12 +242,55 @@ class LLM:
             - If `list` of `str`, this is a multi-turn conversation between user and assistant,
               the last turn must be user's
             - If `list` of `dict`, this is a multi-turn and should be given to the LLM as-is
+        on_text : callable
+            If given, the response is streamed, and `on_text` is called with the text received
+            so far each time more arrives (on the engine loop, or on the model's thread for a
+            `locallib.LocalLLM`, so it must be quick).  If it returns
+            `True`, the rest of the generation is cancelled and the call returns the text so far.
+        parameters : dict
+            Inference parameters for this call only, such as `max_tokens` or `response_format`,
+            on top of the LLM's `parameters`
 
         Returns
         -------
             str
         """
-        messages = None
+        labels = telemetrylib.current_labels()
+        if _engine.in_engine_thread():
+            text_output, _ = await self._post(prompt, labels, on_text, parameters)
+        else:
+            text_output, _ = await asyncio.wrap_future(_engine.submit(self._post(prompt, labels, on_text, parameters)))
+        return text_output
+
+    def call_all(self, prompts):
+        """
+        Performs several independent LLM inferences concurrently and waits for all the results
+
+        Parameters
+        ----------
+        prompts : list
+            Prompts in any of the forms accepted by `acall`
+
+        Returns
+        -------
+            list of str, in the same order as `prompts`
+        """
+        if _engine.in_engine_thread():
+            raise LLMException("Synchronous LLM call from inside the engine loop, use `await acall()`")
+        labels = telemetrylib.current_labels()
+        async def gather():
+            # Let every call finish, so that none is left running (or unrecorded in a batch session)
+            return await asyncio.gather(*[self._post(prompt, labels) for prompt in prompts], return_exceptions = True)
+        results = _engine.submit(gather()).result()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return [text_output for text_output, _ in results]
+
+    def messages(self, prompt):
+        """
+        Converts the prompt into the list of chat messages (see `acall`)
+        """
         if isinstance(prompt, str):
             messages = [
                 {
@@ -89,6 +309,51 @@ class LLM:
             ]
         else:
             raise LLMException(f"Incompatible prompt: {prompt}")
+        return messages
+
+    def estimate_tokens(self, messages, parameters = None):
+        """
+        Rough token count of a request for rate limiting: ~4 characters per prompt token,
+        plus the completion budget
+        """
+        prompt_chars = sum(len(message.get("content") or "") for message in messages)
+        return prompt_chars // 4 + (parameters or self.parameters).get("max_tokens", 256)
+
+    async def read_stream(self, response, on_text):
+        """
+        Reads the server-sent events of a streamed response, calling `on_text` with the text so far
+        after each piece, until the end or until `on_text` returns `True`
+
+        Returns
+        -------
+            (str, dict, bool) : the text, the `usage` block (if the stream got to it), and whether it was stopped
+        """
+        text_output, usage = "", None
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices") or []:
+                piece = (choice.get("delta") or {}).get("content")
+                if piece:
+                    text_output += piece
+                    if on_text(text_output):
+                        return text_output, usage, True
+        return text_output, usage, False
+
+    async def _post(self, prompt, labels, on_text = None, parameters = None):
+        """
+        Sends the request (or serves it from the cache or a batch job), and records it in `LLM.metrics`
+        under `labels` (taken in the calling thread, since the engine thread has its own context);
+        with `on_text`, the response is streamed, and `parameters` are added to the LLM's (see `acall`)
+        """
+        call_start_time = time.time()
+        messages = self.messages(prompt)
+        parameters = {**self.parameters, **(parameters or {})}
 
         # print(f"\nMessages:\n{messages}\n\n")
 
@@ -96,20 +361,107 @@ class LLM:
             "model" : self.model,
             "messages" : messages
         }
-        json_data.update(self.parameters)
-        start_time = time.time()
-        response = requests.post(self.url, headers = self.headers, json = json_data)
-        end_time = time.time()
-        duration = end_time - start_time
+        json_data.update(parameters)
+        cache_key = None
+        if LLM.cache is not None and LLM.cache.is_cacheable(parameters):
+            cache_key = LLM.cache.make_key(self.model, self.url, parameters, messages)
+            text_output = LLM.cache.get(cache_key)
+            if text_output is not None:
+                LLM.metrics.record(self.name, labels, "cache", time.time() - call_start_time)
+                if on_text is not None:
+                    on_text(text_output)
+                return text_output, None
+        if LLM.batch is not None:
+            text_output = LLM.batch.resolve(self, json_data)
+            LLM.metrics.record(self.name, labels, "batch", time.time() - call_start_time)
+            if on_text is not None:
+                on_text(text_output)
+            if cache_key is not None:
+                LLM.cache.put(cache_key, self.model, text_output)
+            return text_output, None
+        text_output, usage, stopped = await self._send(json_data, messages, parameters, prompt, labels, call_start_time, on_text)
+        if cache_key is not None and not stopped:  # A stopped stream has only the start of the response
+            LLM.cache.put(cache_key, self.model, text_output)
+        return text_output, usage
+
+    async def _send(self, json_data, messages, parameters, prompt, labels, call_start_time, on_text = None):
+        """
+        Sends the request to the server, with rate limiting and retries, and records it in `LLM.metrics`
+
+        Returns
+        -------
+            (str, dict, bool) : the text, the `usage` block, and whether the stream was stopped by `on_text`
+        """
+        estimated_tokens = self.estimate_tokens(messages, parameters)
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            async with self.concurrency:
+                start_time = time.time()
+                try:
+                    if on_text is None:
+                        response = await _engine.client(self.url).post(self.url, headers = self.headers, json = json_data)
+                    else:
+                        client = _engine.client(self.url)
+                        stream_data = {**json_data, "stream" : True, "stream_options" : {"include_usage" : True}}
+                        response = await client.send(
+                            client.build_request("POST", self.url, headers = self.headers, json = stream_data), stream = True
+                        )
+                        try:
+                            if response.status_code == 200:
+                                text_output, usage, stopped = await self.read_stream(response, on_text)
+                            else:
+                                await response.aread()
+                        finally:
+                            await response.aclose()  # Before the end of the stream, this cancels the generation
+                    error = None
+                except httpx.TransportError as e:
+                    response, error = None, e
+                end_time = time.time()
+            duration = end_time - start_time
+            if response is not None:
+                headroom = self.rate_limiter.observe(response.headers)
+                if response.status_code == 200:
+                    self.concurrency.observe(headroom)
+                    break
+                if response.status_code == 429:
+                    self.concurrency.throttled()
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+            if attempt < self.max_retries:
+                retry_after = None if response is None else parse_retry_after(response.headers)
+                if retry_after is not None:
+                    self.rate_limiter.pause(retry_after + backoff_delay(0, base = 0.5))
+                else:
+                    await asyncio.sleep(backoff_delay(attempt))
+        status = None if response is None else response.status_code
+        if status != 200:
+            LLM.metrics.record(
+                self.name, labels, "api", time.time() - call_start_time, status, attempt + 1,
+                error = repr(error) if response is None else f"Status Code = {status}"
+            )
+        if response is None:
+            raise LLMException(
+                f"Model = {self.model}, Error = {error!r}, Duration = {duration}, Attempts = {attempt + 1}\n" +
+                f"Prompt: {prompt}"
+            )
         if response.status_code != 200:
             raise LLMException(
-                f"Model = {self.model}, Status Code = {response.status_code}, Duration = {duration}\n" +
-                f"Prompt: {prompt}\nResponse: {response.json()}" # {json.dumps(response)}"
+                f"Model = {self.model}, Status Code = {response.status_code}, Duration = {duration}, " +
+                f"Attempts = {attempt + 1}\nPrompt: {prompt}\nResponse: {response.text}",
+                status = response.status_code
             )
         # print("text_output = " + str(response.json()))
-        text_output = response.json()["choices"][0]["message"]["content"]
+        if on_text is None:
+            response_json = response.json()
+            usage = response_json.get("usage") or {}
+            text_output = response_json["choices"][0]["message"]["content"]
+            stopped = False
+        usage = usage or {}
+        if "total_tokens" in usage:
+            self.rate_limiter.settle(estimated_tokens, usage["total_tokens"])
+        LLM.metrics.record(self.name, labels, "api", time.time() - call_start_time, status, attempt + 1, usage)
         # print(f"Response from OpenAI: {response.json()}\n")
-        return text_output
+        return text_output, usage, stopped
 
 
 
@@ -136,7 +488,8 @@ gpt_3_dot_5 = LLM(
     headers = openai_headers_1,
     parameters = {
         "temperature": 0.7
-    }
+    },
+    structured_output = "json_object"
 )
 gpt_4o = LLM(
     name = "gpt-4o",
@@ -145,7 +498,8 @@ gpt_4o = LLM(
     headers = openai_headers_2,
     parameters = {
         "temperature": 0.7
-    }
+    },
+    structured_output = "json_schema"
 )
 
 llama3_8B_in = LLM(
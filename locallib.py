@@ -0,0 +1,352 @@
+from llmlib import LLM, LLMException
+import os, time, asyncio, threading, queue, argparse
+from collections import OrderedDict
+
+class LocalRequest:
+    """
+    One call to a local LLM, from the prompt tokens to the finished text
+    """
+    def __init__(self, messages, parameters, on_text, loop, future):
+        self.messages = messages
+        self.ids = None  # Prompt token IDs, once tokenized
+        self.temperature = parameters.get("temperature", 1.0)
+        self.top_p = parameters.get("top_p", 1.0)
+        self.max_tokens = parameters.get("max_tokens")
+        self.on_text = on_text
+        self.loop = loop
+        self.future = future
+        self.cancelled = False
+        self.past = None  # KV cache of this sequence alone (legacy format: per layer, (keys, values))
+        self.length = 0  # Number of tokens in `past`
+        self.next_id = None  # Sampled token, not yet fed to the model
+        self.generated = []
+        self.text = ""
+        self.cached_tokens = 0
+
+    def finish(self, stopped = False, error = None):
+        prompt_tokens = len(self.ids or [])
+        usage = {
+            "prompt_tokens" : prompt_tokens,
+            "completion_tokens" : len(self.generated),
+            "total_tokens" : prompt_tokens + len(self.generated),
+            "prompt_tokens_details" : {"cached_tokens" : self.cached_tokens}
+        }
+        def resolve():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result((self.text, usage, stopped))
+        self.loop.call_soon_threadsafe(resolve)
+
+
+class LocalLLM(LLM):
+    """
+    LLM that runs an open instruct model (such as Llama-3-8B-Instruct) in this process, with
+    `torch` and `transformers` (imported on first use, like the model itself)
+
+    The model runs in its own thread, with continuous batching: the calls in flight decode together,
+    one token per step for all of them, and a new call joins the batch at the next step instead of
+    waiting for the batch to finish (each new call is prefilled on its own).  The KV caches of the
+    latest prompts are kept, and a new prompt reuses the longest prefix it shares with one of them
+    (the system prompt, the few-shot examples, the same document), so that only the rest is prefilled;
+    the reused tokens are reported as `cached_tokens`.  Response formats are not supported.
+    """
+    def __init__(self, name, model_path, parameters, max_batch_size = 8, max_new_tokens = 512,
+                 prefix_cache_size = 4, device = None, dtype = None):
+        """
+        Creates a new local LLM instance (also available through the registry), loaded on first call
+
+        Parameters
+        ----------
+        name : str
+            Short name, to use in CSV tables and as key in the registry
+        model_path : str
+            Folder (or Hugging Face name) of the model and its tokenizer, with a chat template
+        parameters : dict
+            LLM inference parameters, provided at calls ("temperature", "top_p", "max_tokens")
+        max_batch_size : int
+            Maximum number of calls decoded together; the others wait for a free slot
+        max_new_tokens : int
+            Completion budget of a call without "max_tokens"
+        prefix_cache_size : int
+            Number of recent prompts whose KV caches are kept for prefix reuse
+        device : str
+            Torch device, such as "cpu" or "cuda" (by default, "cuda" if available)
+        dtype : str
+            Torch dtype of the weights, such as "bfloat16" (by default, the model's own)
+
+        Returns
+        -------
+        A new LocalLLM instance
+        """
+        super().__init__(
+            name = name,
+            model = os.path.basename(os.path.normpath(model_path)),
+            url = "local://" + model_path,
+            headers = {},
+            parameters = parameters,
+            max_concurrency = max_batch_size
+        )
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.prefix_cache_size = prefix_cache_size
+        self.device = device
+        self.dtype = dtype
+        self.requests = queue.Queue()
+        self.prefix_cache = OrderedDict()  # Prompt token IDs (tuple) -> KV cache
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        self.stats = {"calls" : 0, "prompt_tokens" : 0, "cached_tokens" : 0, "completion_tokens" : 0,
+                      "steps" : 0, "batched_tokens" : 0, "busy_seconds" : 0.0}
+
+    def __repr__(self):
+        return f"LocalLLM(name = '{self.name}', model_path = {self.model_path}, parameters = {self.parameters})"
+
+    def load(self):
+        """
+        Loads the tokenizer and the model (called in the worker thread)
+        """
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        self.torch = torch
+        self.device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        self.lm = AutoModelForCausalLM.from_pretrained(
+            self.model_path, torch_dtype = getattr(torch, self.dtype) if self.dtype else "auto"
+        ).to(self.device).eval()
+        eos = self.lm.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos if eos is not None else self.tokenizer.eos_token_id])
+
+    def start(self):
+        with self.worker_lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target = self.run, name = f"locallib-{self.name}", daemon = True)
+                self.worker.start()
+
+    async def _send(self, json_data, messages, parameters, prompt, labels, call_start_time, on_text = None):
+        """
+        Queues the call for the model's thread and waits for its text (see `LLM._send`);
+        `on_text` is called from the model's thread
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        request = LocalRequest(messages, parameters, on_text, loop, loop.create_future())
+        self.requests.put(request)
+        try:
+            text_output, usage, stopped = await request.future
+        except asyncio.CancelledError:
+            request.cancelled = True
+            raise
+        except Exception as e:
+            LLM.metrics.record(self.name, labels, "api", time.time() - call_start_time, error = repr(e))
+            raise LLMException(f"Model = {self.model}, Error = {e!r}\nPrompt: {prompt}")
+        LLM.metrics.record(self.name, labels, "api", time.time() - call_start_time, 200, 1, usage)
+        return text_output, usage, stopped
+
+    def run(self):
+        """
+        The model's thread: admits the queued calls into the batch and decodes the batch step by step
+        """
+        try:
+            self.load()
+        except Exception as e:
+            while True:  # Fail every call, since the model is not there
+                self.requests.get().finish(error = e)
+        active = []
+        with self.torch.inference_mode():
+            while True:
+                waiting = []
+                if not active:
+                    waiting.append(self.requests.get())  # Idle until a call comes
+                while len(active) + len(waiting) < self.max_batch_size:
+                    try:
+                        waiting.append(self.requests.get_nowait())
+                    except queue.Empty:
+                        break
+                start_time = time.time()
+                for request in waiting:
+                    try:
+                        self.prefill(request)
+                    except Exception as e:
+                        request.finish(error = e)
+                        continue
+                    if not self.emit(request):
+                        active.append(request)
+                if active:
+                    try:
+                        self.decode(active)
+                    except Exception as e:
+                        for request in active:
+                            request.finish(error = e)
+                        active = []
+                    active = [request for request in active if not self.emit(request)]
+                self.stats["busy_seconds"] += time.time() - start_time
+
+    def prefill(self, request):
+        """
+        Runs the prompt of a new call through the model, reusing the longest cached prefix,
+        and samples its first token
+        """
+        torch = self.torch
+        request.ids = list(self.tokenizer.apply_chat_template(request.messages, add_generation_prompt = True))
+        past, reused = None, 0
+        for ids, cached in self.prefix_cache.items():
+            common = min(len(os.path.commonprefix([ids, request.ids])), len(request.ids) - 1)
+            if common > reused:
+                past, reused = cached, common
+        if past is not None:
+            past = tuple((keys[:, :, :reused], values[:, :, :reused]) for keys, values in past)
+        ids = torch.tensor([request.ids[reused:]], device = self.device)
+        output = self.lm(
+            input_ids = ids,
+            attention_mask = torch.ones(1, len(request.ids), dtype = torch.long, device = self.device),
+            position_ids = torch.arange(reused, len(request.ids), device = self.device).unsqueeze(0),
+            past_key_values = to_model_cache(past),
+            use_cache = True
+        )
+        request.past = from_model_cache(output.past_key_values)
+        request.length = len(request.ids)
+        request.cached_tokens = reused
+        request.next_id = self.sample(output.logits[0, -1], request)
+        self.prefix_cache[tuple(request.ids)] = request.past
+        self.prefix_cache.move_to_end(tuple(request.ids))
+        while len(self.prefix_cache) > self.prefix_cache_size:
+            self.prefix_cache.popitem(last = False)
+        self.stats["calls"] += 1
+        self.stats["prompt_tokens"] += len(request.ids)
+        self.stats["cached_tokens"] += reused
+
+    def decode(self, active):
+        """
+        Feeds the last sampled token of every call in the batch, in one forward pass
+        over their KV caches left-padded to the same length, and samples the next ones
+        """
+        torch = self.torch
+        functional = torch.nn.functional
+        width = max(request.length for request in active)
+        past = tuple(
+            tuple(
+                torch.cat([functional.pad(layer[i][kind], (0, 0, width - request.length, 0)) for i, request in enumerate(active)])
+                    for kind in range(2)
+            ) for layer in zip(*[request.past for request in active])
+        )
+        mask = torch.zeros(len(active), width + 1, dtype = torch.long, device = self.device)
+        for i, request in enumerate(active):
+            mask[i, width - request.length:] = 1
+        output = self.lm(
+            input_ids = torch.tensor([[request.next_id] for request in active], device = self.device),
+            attention_mask = mask,
+            position_ids = torch.tensor([[request.length] for request in active], device = self.device),
+            past_key_values = to_model_cache(past),
+            use_cache = True
+        )
+        past = from_model_cache(output.past_key_values)
+        for i, request in enumerate(active):
+            request.generated.append(request.next_id)
+            request.past = tuple(
+                (keys[i : i + 1, :, width - request.length:], values[i : i + 1, :, width - request.length:])
+                    for keys, values in past
+            )
+            request.length += 1
+            request.next_id = self.sample(output.logits[i, -1], request)
+        self.stats["steps"] += 1
+        self.stats["batched_tokens"] += len(active)
+        self.stats["completion_tokens"] += len(active)
+
+    def sample(self, logits, request):
+        torch = self.torch
+        if request.temperature == 0:
+            return int(logits.argmax())
+        probs = torch.softmax(logits.float() / request.temperature, dim = -1)
+        if request.top_p < 1.0:
+            sorted_probs, order = probs.sort(descending = True)
+            keep = sorted_probs.cumsum(-1) - sorted_probs < request.top_p
+            probs = torch.zeros_like(probs).scatter(0, order[keep], sorted_probs[keep])
+        return int(torch.multinomial(probs, 1))
+
+    def emit(self, request):
+        """
+        Passes the new text of the call to its `on_text`, and finishes the call if it is done
+
+        Returns
+        -------
+            bool : whether the call is done (an error in decoding or in `on_text` fails the call)
+        """
+        if request.cancelled:
+            request.finish()
+            return True
+        max_tokens = request.max_tokens or self.max_new_tokens
+        if request.generated:
+            try:
+                request.text = self.tokenizer.decode(request.generated, skip_special_tokens = True)
+                stop = request.on_text is not None and request.on_text(request.text)
+            except Exception as e:  # Fail the call rather than the model's thread, which all the calls wait on
+                request.finish(error = e)
+                return True
+            if stop:
+                request.finish(stopped = True)
+                return True
+        if request.next_id in self.eos_ids or len(request.generated) >= max_tokens:
+            request.finish()
+            return True
+        return False
+
+    def tokens_per_second(self):
+        """
+        Completion tokens generated per second while the model was busy (prefill included)
+        """
+        return self.stats["completion_tokens"] / max(self.stats["busy_seconds"], 1e-9)
+
+
+def to_model_cache(past):
+    """
+    The KV cache in the form the model takes (`DynamicCache` in recent `transformers`)
+    """
+    if past is None:
+        return None
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past
+    return DynamicCache.from_legacy_cache(past)
+
+def from_model_cache(past):
+    """
+    The KV cache as a tuple of (keys, values) per layer, each of shape (batch, heads, tokens, head size)
+    """
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Measure the tokens/sec of a local LLM on this machine")
+    parser.add_argument("model_path",
+                        help = "Folder (or Hugging Face name) of the instruct model")
+    parser.add_argument("--calls", type = int, default = 16,
+                        help = "Number of calls, all sent at once")
+    parser.add_argument("--max-batch-size", type = int, default = 8,
+                        help = "Maximum number of calls decoded together")
+    parser.add_argument("--max-tokens", type = int, default = 64,
+                        help = "Completion budget of each call")
+    parser.add_argument("--dtype",
+                        help = "Torch dtype of the weights, such as bfloat16")
+    args = parser.parse_args()
+
+    llm = LocalLLM("local", args.model_path, {"temperature" : 0, "max_tokens" : args.max_tokens},
+                   max_batch_size = args.max_batch_size, dtype = args.dtype)
+    system = {"role" : "system", "content" : "You are a helpful assistant. Answer in one or two sentences."}
+    prompts = [[system, {"role" : "user", "content" : f"Name an interesting fact about the number {i}."}]
+               for i in range(args.calls)]
+    llm([system, {"role" : "user", "content" : "Hello!"}])  # Load the model and warm up
+    for key in llm.stats:
+        llm.stats[key] = 0
+    start_time = time.time()
+    llm.call_all(prompts)
+    seconds = time.time() - start_time
+    stats = llm.stats
+    print(f"{stats['calls']} calls in {seconds:.2f} s: {stats['completion_tokens'] / seconds:.1f} tokens/sec, " +
+          f"{stats['batched_tokens'] / max(stats['steps'], 1):.1f} calls per decoding step, " +
+          f"{stats['cached_tokens']} of {stats['prompt_tokens']} prompt tokens reused from the prefix cache")
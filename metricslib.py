@@ -0,0 +1,166 @@
+import pandas as pd
+import numpy as np
+import os
+import tablelib
+
+count_columns = [
+    "orig_questions",                 # Original (non-confusing) questions
+    "orig_detected",                  # ... with confusion detected
+    "orig_detected_defused",          # ... with confusion detected and defused
+    "conf_questions",                 # Confusing questions
+    "conf_detected",                  # ... with confusion detected
+    "conf_detected_defused",          # ... with confusion detected and defused
+    "conf_detected_undefused"         # ... with confusion detected, but not defused
+]
+
+def question_masks(df, qr_schema):
+    """
+    Boolean masks over the rows of a question-response table
+    """
+    is_conf = df[qr_schema["is_conf"]]
+    detected = df[qr_schema["confusion"]] != "none"
+    defused = df[qr_schema["is_defused"]] == "yes"
+    return {
+        "orig" : is_conf == "no",
+        "conf" : is_conf == "yes",
+        "detected" : detected,
+        "defused" : detected & defused,
+        "undefused" : detected & ~defused
+    }
+
+def filter_undefused_confusions(df, qr_schema):
+    """
+    Select the confusing questions whose confusion was detected, but not defused by the response
+    """
+    masks = question_masks(df, qr_schema)
+    return df[masks["conf"] & masks["undefused"]]
+
+def count_metrics(df, qr_schema, by = None):
+    """
+    Count the questions of each kind (see `count_columns`), overall or for each group of rows
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Question-response table, possibly with extra columns to group by (see `load_experiments`)
+    qr_schema : dict
+        Column names of the question-response table
+    by : str | list
+        Column(s) to group by, such as "LLM_r", "doc_prompt", "doc_id" or "experiment";
+        if `None`, the metrics are computed over the whole table
+
+    Returns
+    -------
+        pandas.DataFrame with one row per group (a single row "all" if `by` is `None`)
+    """
+    masks = question_masks(df, qr_schema)
+    flags = pd.DataFrame({
+        "orig_questions" : masks["orig"],
+        "orig_detected" : masks["orig"] & masks["detected"],
+        "orig_detected_defused" : masks["orig"] & masks["defused"],
+        "conf_questions" : masks["conf"],
+        "conf_detected" : masks["conf"] & masks["detected"],
+        "conf_detected_defused" : masks["conf"] & masks["defused"],
+        "conf_detected_undefused" : masks["conf"] & masks["undefused"]
+    }, index = df.index).astype(int)
+    if by is None:
+        return flags.sum().to_frame("all").T
+    return flags.groupby([df[column] for column in ([by] if isinstance(by, str) else by)]).sum()
+
+def add_rates(metrics):
+    """
+    Add the rates of detection and defusion, for both kinds of questions, to the counts of `count_metrics`
+    """
+    metrics = metrics.copy()
+    for kind in ["orig", "conf"]:
+        questions = metrics[f"{kind}_questions"].replace(0, np.nan)
+        detected = metrics[f"{kind}_detected"].replace(0, np.nan)
+        metrics[f"{kind}_detected_rate"] = metrics[f"{kind}_detected"] / questions
+        metrics[f"{kind}_defused_rate"] = metrics[f"{kind}_detected_defused"] / questions
+        metrics[f"{kind}_defused_given_detected"] = metrics[f"{kind}_detected_defused"] / detected
+    return metrics
+
+def bootstrap_intervals(metrics, num_samples = 1000, confidence = 0.95, seed = 0):
+    """
+    Add bootstrap confidence intervals to the rates of `add_rates`, resampling the questions of each group
+
+    Resampling n questions with replacement gives multinomial counts of the outcomes
+    (detected and defused, detected but not defused, not detected), so the bootstrap
+    samples are drawn as counts directly: the cost does not grow with the number of questions.
+    Adds columns `<rate>_low` and `<rate>_high` next to each rate.
+    """
+    rng = np.random.default_rng(seed)
+    metrics = add_rates(metrics)
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    for kind in ["orig", "conf"]:
+        bounds = {f"{kind}_{rate}_{end}" : [] for rate in ["detected_rate", "defused_rate", "defused_given_detected"]
+                                              for end in ["low", "high"]}
+        for _, row in metrics.iterrows():  # One iteration per group, not per question
+            n = int(row[f"{kind}_questions"])
+            defused = int(row[f"{kind}_detected_defused"])
+            undefused = int(row[f"{kind}_detected"]) - defused
+            if n == 0:
+                for values in bounds.values():
+                    values.append(np.nan)
+                continue
+            counts = rng.multinomial(n, [defused / n, undefused / n, 1 - (defused + undefused) / n], size = num_samples)
+            detected = counts[:, 0] + counts[:, 1]
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                samples = {
+                    "detected_rate" : detected / n,
+                    "defused_rate" : counts[:, 0] / n,
+                    "defused_given_detected" : np.where(detected > 0, counts[:, 0] / detected, np.nan)
+                }
+            for rate, values in samples.items():
+                low, high = np.nanquantile(values, quantiles) if not np.isnan(values).all() else (np.nan, np.nan)
+                bounds[f"{kind}_{rate}_low"].append(low)
+                bounds[f"{kind}_{rate}_high"].append(high)
+        for column, values in bounds.items():
+            metrics[column] = values
+    return metrics
+
+def print_metrics(metrics):
+    """
+    Print the question counts of `count_metrics`, for each group
+    """
+    for group, row in metrics.iterrows():
+        if len(metrics) > 1 or group != "all":
+            print(f"Group {group}:")
+        print("Original (non-confusing) questions:")
+        print(f"    Total questions = {row["orig_questions"]}")
+        print(f"    With confusion detected = {row["orig_detected"]}")
+        print(f"    With confusion detected and defused = {row["orig_detected_defused"]}")
+        print("Confusing questions:")
+        print(f"    Total questions = {row["conf_questions"]}")
+        print(f"    With confusion detected = {row["conf_detected"]}")
+        print(f"    With confusion detected and defused = {row["conf_detected_defused"]}")
+        print(f"    With confusion detected, but not defused = {row["conf_detected_undefused"]}")
+
+def load_experiments(folder = "experiments", qr_file = "qrc_out.csv", doc_file = "docs_out.csv",
+                     doc_schema = None, doc_refs = ("doc_prompt",)):
+    """
+    Read the question-response tables of all the experiments in `folder` into one DataFrame,
+    with an "experiment" column (the subfolder name) and the `doc_refs` columns of the document
+    table joined by doc ID (empty if an experiment's document table does not have them).
+    Subfolders without the question-response table are skipped.
+    """
+    doc_schema = doc_schema or {"doc_id" : "doc_id", "doc_prompt" : "doc_prompt"}
+    frames = []
+    for experiment in sorted(os.listdir(folder)):
+        qr_path = os.path.join(folder, experiment, qr_file)
+        if not os.path.exists(qr_path):
+            continue
+        df = tablelib.read_table(qr_path, f"Read the question-response table of experiment {experiment}")
+        doc_path = os.path.join(folder, experiment, doc_file)
+        doc_columns = set(tablelib.read_columns(doc_path)) if os.path.exists(doc_path) else set()
+        joined = [doc_schema[ref] for ref in doc_refs if doc_schema[ref] in doc_columns]
+        if joined:
+            df_doc = tablelib.read_table(doc_path, f"Read the document table of experiment {experiment}",
+                                         [doc_schema["doc_id"]] + joined)
+            df = df.merge(df_doc, how = "left", on = doc_schema["doc_id"]).fillna({column : "" for column in joined})
+        for ref in doc_refs:
+            if doc_schema[ref] not in df.columns:
+                df[doc_schema[ref]] = ""
+        df["experiment"] = experiment
+        frames.append(df)
+    return pd.concat(frames, ignore_index = True)
@@ -0,0 +1,518 @@
+from llmlib import LLM
+import os, re, sys, json, time, glob, math, random, hashlib, threading, argparse, runpy, uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import tablelib, promptlib, utils
+
+def echo_responder(body):
+    """
+    Default reply of the mock server: echoes the last message (as `batchlib.LocalBatchBackend` does)
+    """
+    return "Echo: " + body["messages"][-1]["content"]
+
+def synthetic_responder(body):
+    """
+    Made-up reply of the shape each prompt of the pipeline asks for, so that all the stages
+    have work to do (parsing, further calls) as they would with a real LLM: a numbered list of
+    questions, labeled answers, "Yes" or "No" (picked by a hash of the prompt) to the checks,
+    and otherwise the sentences of the quoted document as a numbered list of facts
+    """
+    messages = body["messages"]
+    last = messages[-1]["content"]
+    digest = int(hashlib.md5(json.dumps(messages).encode("utf-8")).hexdigest(), 16)
+    if "'Yes' or 'No'" in last:
+        if body.get("response_format") or '"verdict"' in last:
+            return json.dumps({"verdict" : "yes" if digest % 2 else "no", "reason" : "The document does not say so."})
+        return "Yes, the question assumes something the document does not say." if digest % 2 else "No."
+    x = re.search(r"answer each of the (\d+) questions", last)
+    if x:
+        return "\n".join(f"Answer {i}: The document answers question {i}." for i in range(1, int(x.group(1)) + 1))
+    for message in reversed(messages):
+        x = re.search(r"numbered list of (\d+)", message.get("content") or "")
+        if x:
+            return utils.enum_list([f"What does fact {i} of document {digest % 1000} say?" for i in range(1, int(x.group(1)) + 1)])
+    x = re.search(r'"""(.*?)"""', last, re.DOTALL)
+    if x is None:
+        return "The document says so."
+    document = x.group(1).replace("(missing)", "A made-up fact.")
+    facts = []
+    for line in document.splitlines():
+        line = re.sub(r"^\d+[:\.]\s+", "", line.strip())
+        facts.extend(fact for fact in re.split(r"(?<=[.!?])\s+", line) if fact)
+    return utils.enum_list(facts[:24]) or "The document says so."
+
+responders = {"echo" : echo_responder, "synthetic" : synthetic_responder}
+
+def count_tokens(text):
+    """
+    Rough token count, ~4 characters per token (as in `LLM.estimate_tokens`)
+    """
+    return max(1, len(text) // 4)
+
+
+class ReplayMiss(Exception):
+    """
+    Raised by a strict `ReplayResponder` for a request that was not recorded
+    """
+    pass
+
+
+class MockServer:
+    """
+    Local stand-in for an OpenAI-compatible chat completion server, for tests and load tests without network
+
+    Answers POST requests to `.../chat/completions` with `responder(body)` (by default, echoes
+    the last message) after a random latency, plus the time to generate the completion at
+    `tokens_per_second`; with `"stream": true`, the completion is sent word by word as server-sent
+    events.  A share of the requests can be failed with status 500, or throttled with status 429
+    and a `Retry-After` header; requests beyond `max_in_flight` are throttled too.
+    Each request is served in its own thread, over keep-alive connections.
+    """
+    distributions = ["fixed", "uniform", "exponential", "lognormal"]
+
+    def __init__(self, responder = None, latency = 0.0, jitter = 0.0, distribution = "fixed",
+                 tokens_per_second = None, error_rate = 0.0, throttle_rate = 0.0, retry_after = 1.0,
+                 max_in_flight = None, seed = None, host = "127.0.0.1", port = 0):
+        """
+        Creates the server (call `start` to serve)
+
+        Parameters
+        ----------
+        responder : callable
+            Takes the request body (dict) and returns the reply text;
+            if it raises `ReplayMiss`, the server replies with status 404
+        latency : float
+            Mean seconds before the first token (the median, for "lognormal")
+        jitter : float
+            Spread of the latency: half-width for "uniform", sigma of the log for "lognormal"
+        distribution : str
+            One of "fixed", "uniform", "exponential", "lognormal"
+        tokens_per_second : float
+            Generation speed of the completion (if `None`, the completion takes no time)
+        error_rate : float
+            Share of the requests that fail with status 500
+        throttle_rate : float
+            Share of the requests that fail with status 429
+        retry_after : float
+            Seconds in the `Retry-After` header of the throttled requests
+        max_in_flight : int
+            Requests beyond this number in flight are throttled (if `None`, no limit)
+        seed : int
+            Seed of the random latencies and failures
+        host, port : str, int
+            Address to listen on (port 0 picks a free port)
+
+        Returns
+        -------
+        A new MockServer instance
+        """
+        if distribution not in self.distributions:
+            raise ValueError(f"Unknown latency distribution {distribution}, choose from {self.distributions}")
+        self.responder = responder or echo_responder
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_in_flight = max_in_flight
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {"requests" : 0, "ok" : 0, "errors" : 0, "throttled" : 0, "misses" : 0, "cancelled" : 0}
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target = self.httpd.serve_forever, name = "mock-llm-server", daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def sample_latency(self):
+        with self.lock:
+            if self.distribution == "uniform":
+                latency = self.random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+            elif self.distribution == "exponential":
+                latency = self.random.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            elif self.distribution == "lognormal":
+                latency = self.random.lognormvariate(math.log(self.latency), self.jitter) if self.latency > 0 else 0.0
+            else:
+                latency = self.latency
+        return max(0.0, latency)
+
+    def draw_failure(self):
+        """
+        The status of an injected failure for the next request, or `None`
+        """
+        with self.lock:
+            x = self.random.random()
+        if x < self.throttle_rate:
+            return 429
+        if x < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def handle(self, body, handler):
+        """
+        Serves one request body through the `BaseHTTPRequestHandler`
+        """
+        self.count("requests")
+        with self.lock:
+            over_limit = self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+            self.in_flight += 1
+        try:
+            failure = 429 if over_limit else self.draw_failure()
+            time.sleep(self.sample_latency())
+            if failure == 429:
+                self.count("throttled")
+                return self.send_json(handler, 429, {
+                    "error" : {"message" : "Rate limit reached (mock)", "type" : "requests", "code" : "rate_limit_exceeded"}
+                }, {"Retry-After" : str(self.retry_after)})
+            if failure == 500:
+                self.count("errors")
+                return self.send_json(handler, 500, {"error" : {"message" : "Internal error (mock)", "type" : "server_error"}})
+            try:
+                content = self.responder(body)
+            except ReplayMiss as e:
+                self.count("misses")
+                return self.send_json(handler, 404, {"error" : {"message" : str(e), "type" : "not_found"}})
+            prompt_tokens = count_tokens("".join(m.get("content") or "" for m in body["messages"]))
+            completion_tokens = count_tokens(content)
+            usage = {
+                "prompt_tokens" : prompt_tokens,
+                "completion_tokens" : completion_tokens,
+                "total_tokens" : prompt_tokens + completion_tokens,
+                "prompt_tokens_details" : {"cached_tokens" : 0}
+            }
+            if body.get("max_tokens") and completion_tokens > body["max_tokens"]:
+                content = content[: 4 * body["max_tokens"]]
+                completion_tokens = usage["completion_tokens"] = body["max_tokens"]
+                usage["total_tokens"] = prompt_tokens + completion_tokens
+            generation_time = completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+            if body.get("stream"):
+                return self.send_stream(handler, body, content, usage, generation_time)
+            time.sleep(generation_time)
+            self.count("ok")
+            self.send_json(handler, 200, {
+                "id" : "chatcmpl-" + uuid.uuid4().hex,
+                "object" : "chat.completion",
+                "created" : int(time.time()),
+                "model" : body.get("model"),
+                "choices" : [{
+                    "index" : 0,
+                    "message" : {"role" : "assistant", "content" : content},
+                    "finish_reason" : "stop"
+                }],
+                "usage" : usage
+            })
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    @staticmethod
+    def send_json(handler, status, reply, headers = None):
+        data = json.dumps(reply, ensure_ascii = False).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def send_stream(self, handler, body, content, usage, generation_time):
+        """
+        Sends the reply as server-sent events of chat completion chunks, one word at a time,
+        spread over `generation_time`; stops if the client closes the connection
+        """
+        chunk_id, created = "chatcmpl-" + uuid.uuid4().hex, int(time.time())
+        def event(delta, finish_reason = None, usage = None):
+            chunk = {
+                "id" : chunk_id, "object" : "chat.completion.chunk", "created" : created, "model" : body.get("model"),
+                "choices" : [] if usage else [{"index" : 0, "delta" : delta, "finish_reason" : finish_reason}]
+            }
+            if usage:
+                chunk["usage"] = usage
+            return "data: " + json.dumps(chunk, ensure_ascii = False) + "\n\n"
+        def send(text):
+            data = text.encode("utf-8")
+            handler.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            handler.wfile.flush()
+        pieces = re.findall(r"\s*\S+", content) or [content]
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        try:
+            send(event({"role" : "assistant", "content" : ""}))
+            for piece in pieces:
+                time.sleep(generation_time / len(pieces))
+                send(event({"content" : piece}))
+            send(event({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send(event(None, usage = usage))
+            send("data: [DONE]\n\n")
+            handler.wfile.write(b"0\r\n\r\n")
+            handler.wfile.flush()
+            self.count("ok")
+        except (BrokenPipeError, ConnectionResetError):
+            self.count("cancelled")
+            handler.close_connection = True
+
+    def handler_class(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, as with the real servers
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    server.send_json(self, 404, {"error" : {"message" : f"Unknown path {self.path}"}})
+                else:
+                    server.handle(body, self)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+class _PromptRecorder(LLM):
+    """
+    LLM that does not infer anything: it records the messages it is called with and returns a set reply,
+    so that the `promptlib` functions build the exact prompts of a past run
+    """
+    def __init__(self):
+        super().__init__("_prompt_recorder", "prompt-recorder", "", {}, {})
+        self.calls = []
+        self.reply = ""
+
+    def __call__(self, prompt, on_text = None, parameters = None):
+        self.calls.append(self.messages(prompt))
+        return self.reply
+
+
+class ReplayResponder:
+    """
+    Responder for `MockServer` that serves the responses recorded in the tables of past experiments
+
+    The prompts of a past run are rebuilt from its tables with the current prompt templates,
+    the same way `datagen2.py` builds them, and each is mapped to the LLM reply recorded for it:
+    the reduced and expanded documents and the questions in the document table,
+    and the responses, confusions and defusions in the question-response table.  Requests are
+    matched by their messages only (not by model or parameters).  The imputation calls of
+    STEP 2 cannot be replayed since their intermediate replies are not recorded; these and all
+    other unknown requests go to the `fallback` responder, or fail if there is none.
+    """
+    def __init__(self, fallback = echo_responder):
+        self.fallback = fallback
+        self.replies = {}  # hash of the messages -> recorded reply
+        self.recorder = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(messages):
+        canonical = json.dumps([[m.get("role"), m.get("content")] for m in messages],
+                               ensure_ascii = False, separators = (",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return len(self.replies)
+
+    def __call__(self, body):
+        reply = self.replies.get(self.key(body["messages"]))
+        with self.lock:
+            if reply is not None:
+                self.hits += 1
+                return reply
+            self.misses += 1
+        if self.fallback is None:
+            raise ReplayMiss("No recorded reply for this request")
+        return self.fallback(body)
+
+    def add(self, func, reply, *args):
+        """
+        Records `reply` for the prompt that the `promptlib` function `func` builds from `args`
+        (given without the LLM, which comes first)
+        """
+        if self.recorder is None:
+            self.recorder = _PromptRecorder()
+        self.recorder.calls, self.recorder.reply = [], reply
+        func(self.recorder.name, *args)
+        for messages in self.recorder.calls:
+            self.replies[self.key(messages)] = reply
+
+    def add_experiment(self, folder, doc_file = "docs_out.csv", qr_file = "qrc_out.csv",
+                       doc_schema = None, qr_schema = None, rag_prompt_key = "r02"):
+        """
+        Records the replies of the experiment in `folder` (the prompts must be read with `promptlib.read_prompts`)
+
+        Returns
+        -------
+            int : the number of replies recorded
+        """
+        doc_schema = doc_schema or {
+            "doc_id" : "doc_id", "document" : "document", "doc_prompt" : "doc_prompt", "reduce_doc" : "reduce_doc",
+            "modify_doc" : "modify_doc", "expand_doc" : "expand_doc", "orig_qs" : "orig_questions", "conf_qs" : "conf_questions"
+        }
+        qr_schema = qr_schema or {
+            "doc_id" : "doc_id", "question" : "question", "response" : "response",
+            "confusion" : "confusion", "defusion" : "defusion"
+        }
+        num_replies = len(self.replies)
+        documents = {}
+        doc_path = os.path.join(folder, doc_file)
+        if os.path.exists(doc_path):
+            df_doc = tablelib.read_table(doc_path, f"Read the document table to replay from {folder}")
+            has = lambda ref: doc_schema[ref] in df_doc.columns
+            for row in df_doc.to_dict("records"):
+                document = row[doc_schema["document"]]
+                documents[row[doc_schema["doc_id"]]] = document
+                prompt_key = row[doc_schema["doc_prompt"]] if has("doc_prompt") else None
+                if prompt_key in promptlib.document_transforms:
+                    if has("reduce_doc"):
+                        self.add(promptlib.reduce_document, row[doc_schema["reduce_doc"]],
+                                 utils.prepare_document(document), prompt_key)
+                    if has("modify_doc") and has("expand_doc"):
+                        self.add(promptlib.expand_document, row[doc_schema["expand_doc"]],
+                                 utils.prepare_document(row[doc_schema["modify_doc"]]), prompt_key)
+                for doc_ref, que_ref in [("document", "orig_qs"), ("expand_doc", "conf_qs")]:
+                    if has(doc_ref) and has(que_ref):
+                        questions = row[doc_schema[que_ref]]
+                        num_q = len(utils.parse_numbered_questions(questions))
+                        self.add(promptlib.generate_questions, questions,
+                                 utils.prepare_document(row[doc_schema[doc_ref]]), num_q)
+        qr_path = os.path.join(folder, qr_file)
+        if os.path.exists(qr_path) and documents:
+            df_qr = tablelib.read_table(qr_path, f"Read the question-response table to replay from {folder}")
+            for row in df_qr.to_dict("records"):
+                document = documents.get(row[qr_schema["doc_id"]])
+                if document is None:
+                    continue
+                question, response = row[qr_schema["question"]], row[qr_schema["response"]]
+                confusion = row[qr_schema["confusion"]]
+                self.add(promptlib.generate_response, response, document, question, rag_prompt_key)
+                self.add(promptlib.find_false_assumption, confusion, document, question, rag_prompt_key)
+                if confusion != "none":
+                    self.add(promptlib.check_response_for_defusion, row[qr_schema["defusion"]],
+                             document, question, response, confusion, rag_prompt_key)
+        return len(self.replies) - num_replies
+
+    @classmethod
+    def from_experiments(cls, folders, fallback = echo_responder, **kwargs):
+        """
+        Replays all the experiment `folders` (glob patterns, such as "experiments/*")
+        """
+        responder = cls(fallback)
+        for pattern in folders:
+            for folder in sorted(glob.glob(pattern)):
+                if os.path.isdir(folder):
+                    print(f"    Replay {responder.add_experiment(folder, **kwargs)} recorded replies from {folder}")
+        return responder
+
+
+def register(url, names = None, max_concurrency = None):
+    """
+    Points the LLMs of the registry called `names` (by default, all of them) to the server at `url`,
+    keeping their model names and parameters, so that code that calls them by name runs against it
+    """
+    names = [name for name in LLM.registry if not name.startswith("_")] if names is None else names
+    for name in names:
+        llm = LLM.get(name)
+        LLM(
+            name = name,
+            model = llm.model if llm else name,
+            url = url,
+            headers = {"Content-Type" : "application/json"},
+            parameters = dict(llm.parameters) if llm else {},
+            max_concurrency = max_concurrency or (llm.max_concurrency if llm else 8),
+            structured_output = llm.structured_output if llm else "json_schema"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description = "Run a script (such as datagen2.py) against a local mock LLM server, or just serve it"
+    )
+    parser.add_argument("--latency", type = float, default = 0.5,
+                        help = "Mean seconds per request before the first token")
+    parser.add_argument("--jitter", type = float, default = 0.0,
+                        help = "Spread of the latency (half-width for uniform, sigma of the log for lognormal)")
+    parser.add_argument("--distribution", choices = MockServer.distributions, default = "fixed",
+                        help = "Distribution of the latency")
+    parser.add_argument("--tokens-per-second", type = float,
+                        help = "Generation speed of the completions")
+    parser.add_argument("--error-rate", type = float, default = 0.0,
+                        help = "Share of the requests that fail with status 500")
+    parser.add_argument("--throttle-rate", type = float, default = 0.0,
+                        help = "Share of the requests that fail with status 429")
+    parser.add_argument("--retry-after", type = float, default = 1.0,
+                        help = "Seconds in the Retry-After header of status 429")
+    parser.add_argument("--max-in-flight", type = int,
+                        help = "Throttle the requests beyond this number in flight")
+    parser.add_argument("--responder", choices = list(responders), default = "echo",
+                        help = "How to reply: echo the last message, or make up a reply of the expected shape")
+    parser.add_argument("--replay", nargs = "+", metavar = "FOLDER",
+                        help = "Serve the replies recorded in these experiment folders (glob patterns)")
+    parser.add_argument("--replay-strict", action = "store_true",
+                        help = "Fail the requests that were not recorded, instead of passing them to the responder")
+    parser.add_argument("--prompts", nargs = "+", default = ["prompts"],
+                        help = "Folders with the prompt templates, to rebuild the recorded prompts")
+    parser.add_argument("--llm", nargs = "+",
+                        help = "Names of the LLMs to point to the mock server (by default, all)")
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--port", type = int, default = 0)
+    parser.add_argument("script", nargs = "?",
+                        help = "Python script to run (followed by its arguments); without it, " +
+                               "the server runs until interrupted")
+    # Everything from the script on belongs to the script
+    split = next((i for i, arg in enumerate(sys.argv[1:], start = 1) if arg.endswith(".py")), len(sys.argv))
+    args = parser.parse_args(sys.argv[1 : split] + ["--"] + sys.argv[split : split + 1])
+    script_args = sys.argv[split + 1:]
+
+    responder = responders[args.responder]
+    if args.replay:
+        promptlib.read_prompts(*args.prompts)
+        responder = ReplayResponder.from_experiments(args.replay, None if args.replay_strict else responder)
+
+    server = MockServer(
+        responder, args.latency, args.jitter, args.distribution, args.tokens_per_second,
+        args.error_rate, args.throttle_rate, args.retry_after, args.max_in_flight, args.seed, port = args.port
+    ).start()
+    print(f"Mock LLM server at {server.url}", flush = True)
+    try:
+        if args.script is None:
+            while True:
+                time.sleep(3600)
+        register(server.url, args.llm)
+        sys.argv = [args.script] + script_args
+        runpy.run_path(args.script, run_name = "__main__")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Mock LLM server: {server.stats}")
+        if isinstance(responder, ReplayResponder):
+            print(f"Replayed {responder.hits} recorded replies, {responder.misses} requests were not recorded")
+        server.stop()
@@ -1,76 +1,381 @@
-from llmlib import LLM
-import utils
-import os, re, json
+from llmlib import LLM, LLMException
+import utils, telemetrylib, budgetlib
+import os, re, json, threading, string, hashlib
+from collections.abc import Mapping
+from types import MappingProxyType
 
+prompt_book = None  # The `PromptBook` of `read_prompts`, parts of which follow
 document_transforms = None
 question_generation = None
 rag_confusion_check = None
 examples_of_questions = None
+few_shot_prefixes = None
+few_shot_prefix_tokens = {}  # (prompt_key, "orig" or "conf", model) -> tokens of the few-shot prefix
 
-def read_prompts(folder):
+few_shot_example_keys = ["Weywot-1", "ElDorado-1"]
+modify_strategy = "sequential"  # Or "parallel", see `modify_reduced_document`
+prompt_cache_usage = {}  # prompt_key -> counts of calls, prompt tokens and cached prompt tokens
+prompt_cache_lock = threading.Lock()
+early_verdicts = False  # Stream the replies to the yes/no checks, and stop once the verdict is clear
+keep_verdict_text = True  # With early verdicts, still read the full replies that are stored (defusions)
+structured_verdicts = False  # Ask for the replies to the yes/no checks in JSON, see `ask_for_verdict`
+verdict_max_tokens = 200  # Completion budget of a structured verdict
 
-    global document_transforms
-    with open(os.path.join(folder, "document-transforms.json"), "r") as f:
-        document_transforms_raw = json.load(f)
-    document_transforms = {}
-    for key, prompts_raw in document_transforms_raw.items():
-        assert {"system", "user_reduce", "user_expand"}.issubset(prompts_raw.keys())
-        prompts = {}
-        for p_type in prompts_raw.keys():
-            if isinstance(prompts_raw[p_type], str) or prompts_raw[p_type] is None:
-                prompts[p_type] = prompts_raw[p_type]
-            else:
-                prompts[p_type] = "".join(prompts_raw[p_type])
-        document_transforms[key] = prompts
-
-    global question_generation
-    with open(os.path.join(folder, "question-generation.json"), "r") as f:
-        question_generation_raw = json.load(f)
-    question_generation = {}
-    for key, prompts_raw in question_generation_raw.items():
-        assert {"system", "user_orig", "user_conf"}.issubset(prompts_raw.keys())
-        prompts = {}
-        for p_type in prompts_raw.keys():
-            if isinstance(prompts_raw[p_type], str) or prompts_raw[p_type] is None:
-                prompts[p_type] = prompts_raw[p_type]
-            else:
-                prompts[p_type] = "".join(prompts_raw[p_type])
-        question_generation[key] = prompts
-
-    global rag_confusion_check
-    with open(os.path.join(folder, "rag-confusion-check.json"), "r") as f:
-        rag_confusion_check_raw = json.load(f)
-    rag_confusion_check = {}
-    for key, prompts_raw in rag_confusion_check_raw.items():
-        assert {"system", "user_rag", "user_conf_rag", "user_conf_check", "user_def_check"}.issubset(prompts_raw.keys())
+verdict_schema = {
+    "type" : "object",
+    "properties" : {
+        "verdict" : {"type" : "string", "enum" : ["yes", "no"]},
+        "reason" : {"type" : "string"}
+    },
+    "required" : ["verdict", "reason"],
+    "additionalProperties" : False
+}
+verdict_instruction = (
+    "\n\nReply in JSON only, as {\"verdict\": \"yes\" or \"no\", \"reason\": \"...\"}, " +
+    "with the rest of your reply as the reason."
+)
+no_confusion_prefixes = [
+    "no", "answer: no", "the answer is: no", "the answer is \"no\"",
+    "the answer to the question is: no", "the answer to the question is \"no\""
+]
+no_defusion_prefixes = ["no", "answer: no", "the answer is: no", "the answer is \"no\""]
+yes_defusion_prefixes = ["yes", "answer: yes", "the answer is: yes", "the answer is \"yes\""]
+
+class PromptException(Exception):
+    pass
+
+
+# Placeholders that each kind of prompt may have, as filled in by the functions below (`None` if the prompt
+# is used verbatim), the placeholders it must have, and the kinds of prompts each prompt set must have
+prompt_fields = {
+    "document-transforms.json" : {
+        "system" : None,
+        "user_reduce" : {"document"},
+        "user_modify" : {"document"},
+        "user_expand" : {"document"}
+    },
+    "question-generation.json" : {
+        "system" : None,
+        "user_orig" : {"num_q", "document"},
+        "user_conf" : {"num_q", "document"}
+    },
+    "rag-confusion-check.json" : {
+        "system" : None,
+        "user_rag" : {"document", "question"},
+        "user_rag_multi" : {"num_q", "document", "questions"},
+        "user_conf_rag" : {"document", "question"},
+        "user_conf_check" : None,
+        "user_def_check" : None
+    }
+}
+required_fields = {
+    "document-transforms.json" : {"user_reduce" : {"document"}, "user_modify" : {"document"}, "user_expand" : {"document"}},
+    "question-generation.json" : {"user_orig" : {"document"}},
+    "rag-confusion-check.json" : {
+        "user_rag" : {"document", "question"},
+        "user_rag_multi" : {"document", "questions"},
+        "user_conf_rag" : {"document", "question"}
+    }
+}
+required_prompts = {
+    "document-transforms.json" : {"system", "user_reduce", "user_expand"},
+    "question-generation.json" : {"system", "user_orig", "user_conf"},
+    "rag-confusion-check.json" : {"system", "user_rag", "user_conf_rag", "user_conf_check", "user_def_check"}
+}
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys = True, ensure_ascii = False).encode("utf-8")).hexdigest()
+
+
+class PromptTemplate(str):
+    """
+    Prompt text whose placeholders are parsed and validated once, when the prompts are read
+
+    It is a `str`, so it goes into the messages as-is; its `format` checks that all the placeholders
+    are given before filling them in, and `sha256` is the hash of its content.
+    """
+    def __new__(cls, text, where, fields = None, required = frozenset()):
+        template = super().__new__(cls, text)
+        names = set()
+        if fields is not None:
+            try:
+                parsed = list(string.Formatter().parse(text))
+            except ValueError as e:
+                raise PromptException(f"Prompt {where} is not a valid template: {e}")
+            for _, name, _, _ in parsed:
+                if name is None:
+                    continue
+                if not name.isidentifier():
+                    raise PromptException(f"Prompt {where} has placeholder {{{name}}}, only plain names are allowed")
+                if name not in fields:
+                    raise PromptException(f"Prompt {where} has placeholder {{{name}}}, but is filled in with {sorted(fields)}")
+                names.add(name)
+            if not names.issuperset(required):
+                raise PromptException(f"Prompt {where} lacks placeholders {sorted(set(required) - names)}")
+        object.__setattr__(template, "where", where)
+        object.__setattr__(template, "fields", frozenset(names))
+        object.__setattr__(template, "verbatim", fields is None)
+        object.__setattr__(template, "sha256", hashlib.sha256(text.encode("utf-8")).hexdigest())
+        return template
+
+    def __reduce__(self):
+        # Rebuilt from the text and the placeholders it has, so that prompts and messages can be pickled and copied
+        return (PromptTemplate, (str(self), self.where, None if self.verbatim else self.fields))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Prompt templates are immutable")
+
+    def format(self, **values):
+        if self.verbatim:
+            return str(self)
+        missing = self.fields.difference(values)
+        if missing:
+            raise PromptException(f"Prompt {self.where} needs values for {sorted(missing)}")
+        return str.format_map(self, values)
+
+
+class PromptSet(Mapping):
+    """
+    Immutable mapping of the kinds of prompts under one prompt key (such as "system" or "user_rag")
+    to their templates (or `None`), with the hash of their content
+    """
+    def __init__(self, prompts):
+        self._prompts = dict(prompts)
+        self.sha256 = content_hash({kind : prompt and str(prompt) for kind, prompt in self._prompts.items()})
+
+    def __getitem__(self, kind):
+        return self._prompts[kind]
+
+    def __iter__(self):
+        return iter(self._prompts)
+
+    def __len__(self):
+        return len(self._prompts)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "sha256"):
+            raise AttributeError("Prompt sets are immutable")
+        super().__setattr__(name, value)
+
+
+class PromptBook:
+    """
+    All the prompts read from one or more prompt folders, validated and immutable
+
+    `document_transforms`, `question_generation` and `rag_confusion_check` map prompt keys to `PromptSet`s;
+    `examples_of_questions` maps example keys to the few-shot examples; `few_shot_prefixes` holds the static
+    beginnings of the question prompts (see `build_few_shot_prefixes`); and `sha256` is the hash of it all,
+    which changes whenever any prompt does.
+    """
+    def __init__(self, folders, document_transforms, question_generation, rag_confusion_check, examples_of_questions):
+        self.folders = tuple(folders)
+        self.document_transforms = MappingProxyType(document_transforms)
+        self.question_generation = MappingProxyType(question_generation)
+        self.rag_confusion_check = MappingProxyType(rag_confusion_check)
+        self.examples_of_questions = MappingProxyType(examples_of_questions)
+        for key in few_shot_example_keys:
+            if key not in examples_of_questions:
+                raise PromptException(f"Few-shot example {key} is not in examples-of-questions.json of {folders}")
+        self.few_shot_prefixes = MappingProxyType({
+            prompt_key : build_few_shot_prefixes(prompts, examples_of_questions)
+                for prompt_key, prompts in question_generation.items()
+        })
+        self.sha256 = content_hash({
+            "document_transforms" : {key : prompts.sha256 for key, prompts in document_transforms.items()},
+            "question_generation" : {key : prompts.sha256 for key, prompts in question_generation.items()},
+            "rag_confusion_check" : {key : prompts.sha256 for key, prompts in rag_confusion_check.items()},
+            "examples_of_questions" : {key : dict(example) for key, example in examples_of_questions.items()},
+            "few_shot_example_keys" : few_shot_example_keys
+        })
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "sha256"):
+            raise AttributeError("Prompt books are immutable")
+        super().__setattr__(name, value)
+
+    def __repr__(self):
+        return (
+            f"PromptBook(folders = {list(self.folders)}, document_transforms = {list(self.document_transforms)}, " +
+            f"question_generation = {list(self.question_generation)}, " +
+            f"rag_confusion_check = {list(self.rag_confusion_check)}, sha256 = {self.sha256[:12]})"
+        )
+
+
+def join_text(value):
+    """
+    Prompt text from the JSON files, which may be split into a list of strings
+    """
+    return value if isinstance(value, str) or value is None else "".join(value)
+
+def read_prompt_sets(folder, file_name):
+    with open(os.path.join(folder, file_name), "r") as f:
+        prompt_sets_raw = json.load(f)
+    prompt_sets = {}
+    for key, prompts_raw in prompt_sets_raw.items():
+        missing = required_prompts[file_name] - prompts_raw.keys()
+        if missing:
+            raise PromptException(f"Prompts {key} in {os.path.join(folder, file_name)} lack {sorted(missing)}")
         prompts = {}
-        for p_type in prompts_raw.keys():
-            if isinstance(prompts_raw[p_type], str) or prompts_raw[p_type] is None:
-                prompts[p_type] = prompts_raw[p_type]
-            else:
-                prompts[p_type] = "".join(prompts_raw[p_type])
-        rag_confusion_check[key] = prompts
+        for p_type, text in prompts_raw.items():
+            text = join_text(text)
+            where = f"{key}/{p_type} in {os.path.join(folder, file_name)}"
+            prompts[p_type] = None if text is None else PromptTemplate(
+                text, where, prompt_fields[file_name].get(p_type), required_fields[file_name].get(p_type, set())
+            )
+        prompt_sets[key] = PromptSet(prompts)
+    return prompt_sets
 
-    global examples_of_questions
-    with open(os.path.join(folder, "examples-of-questions.json"), "r") as f:
+def read_examples(folder):
+    path = os.path.join(folder, "examples-of-questions.json")
+    with open(path, "r") as f:
         examples_of_questions_raw = json.load(f)
     examples_of_questions = {}
     for key, example_raw in examples_of_questions_raw.items():
-        assert {"document", "source", "orig_questions", "conf_questions"}.issubset(example_raw.keys())
-        example = {}
-        if isinstance(example_raw["document"], str):
-            example["document"] = example_raw["document"]
-        else:
-            example["document"] = "".join(example_raw["document"])
-        assert isinstance(example_raw["orig_questions"], list)
-        assert isinstance(example_raw["conf_questions"], list)
-        example["num_q"] = len(example_raw["orig_questions"])
-        assert example["num_q"] == len(example_raw["conf_questions"])
-        example["orig_questions"] = example_raw["orig_questions"]
-        example["conf_questions"] = example_raw["conf_questions"]
-        examples_of_questions[key] = example
+        missing = {"document", "source", "orig_questions", "conf_questions"} - example_raw.keys()
+        if missing:
+            raise PromptException(f"Example {key} in {path} lacks {sorted(missing)}")
+        if not isinstance(example_raw["orig_questions"], list) or not isinstance(example_raw["conf_questions"], list):
+            raise PromptException(f"Example {key} in {path} must have lists of questions")
+        if len(example_raw["orig_questions"]) != len(example_raw["conf_questions"]):
+            raise PromptException(f"Example {key} in {path} must have as many confusing questions as original ones")
+        examples_of_questions[key] = MappingProxyType({
+            "document" : join_text(example_raw["document"]),
+            "num_q" : len(example_raw["orig_questions"]),
+            "orig_questions" : tuple(example_raw["orig_questions"]),
+            "conf_questions" : tuple(example_raw["conf_questions"])
+        })
+    return examples_of_questions
+
+def merge_prompts(merged, new, folder, kind):
+    for key, value in new.items():
+        if key in merged and merged[key] != value:
+            raise PromptException(f"{kind} {key} in {folder} differs from the one read before")
+        merged[key] = value
+
+def read_prompts(*folders):
+    """
+    Reads the prompts from one or more folders into a `PromptBook`, checking their placeholders
+
+    The folders are read side by side, and their prompt keys are merged: a folder may have only some of
+    the JSON files, and a key may appear in several folders only with the same prompts.  Any problem
+    with the prompts raises `PromptException` here, before any LLM call.  The prompts are also set as
+    the module's `prompt_book` (and its parts, as `document_transforms` and so on), used by the functions below.
+
+    Returns
+    -------
+        PromptBook
+    """
+    sets = {file_name : {} for file_name in prompt_fields}
+    examples = {}
+    for folder in folders:
+        for file_name in prompt_fields:
+            if os.path.exists(os.path.join(folder, file_name)):
+                merge_prompts(sets[file_name], read_prompt_sets(folder, file_name), folder, "Prompts")
+        if os.path.exists(os.path.join(folder, "examples-of-questions.json")):
+            merge_prompts(examples, read_examples(folder), folder, "Example")
+    for file_name in list(prompt_fields) + ["examples-of-questions.json"]:
+        if not any(os.path.exists(os.path.join(folder, file_name)) for folder in folders):
+            raise PromptException(f"None of the prompt folders {list(folders)} has {file_name}")
+    book = PromptBook(
+        folders, sets["document-transforms.json"], sets["question-generation.json"],
+        sets["rag-confusion-check.json"], examples
+    )
+    global prompt_book, document_transforms, question_generation, rag_confusion_check
+    global examples_of_questions, few_shot_prefixes
+    prompt_book = book
+    document_transforms = book.document_transforms
+    question_generation = book.question_generation
+    rag_confusion_check = book.rag_confusion_check
+    examples_of_questions = book.examples_of_questions
+    few_shot_prefixes = book.few_shot_prefixes
+    few_shot_prefix_tokens.clear()
+    return book
+
+
+def build_few_shot_prefixes(prompts, examples):
+    """
+    Build the static beginning of the `generate_questions` ("orig") and `confuse_questions` ("conf")
+    prompts: the system message and the few-shot examples.  These are built once per prompt key,
+    and every call reuses them as-is, so the prefix stays byte-for-byte identical across calls
+    (which lets the provider's prompt caching hit).
+    """
+    orig_prefix = []
+    conf_prefix = []
+    if prompts["system"]:
+        message = {
+            "role" : "system",
+            "content" : prompts["system"]
+        }
+        orig_prefix.append(message)
+        conf_prefix.append(message)
+    for key in few_shot_example_keys:
+        ex_document = examples[key]["document"]
+        ex_num_q = examples[key]["num_q"]
+        orig_messages = [
+            {
+                "role" : "user",
+                "content" : prompts["user_orig"].format(num_q = ex_num_q, document = ex_document)
+            },
+            {
+                "role" : "assistant",
+                "content" : utils.enum_list(examples[key]["orig_questions"])
+            }
+        ]
+        orig_prefix.extend(orig_messages)
+        conf_prefix.extend(orig_messages)
+        conf_prefix.extend([
+            {
+                "role" : "user",
+                "content" : prompts["user_conf"].format(num_q = ex_num_q, document = ex_document)
+            },
+            {
+                "role" : "assistant",
+                "content" : utils.enum_list(examples[key]["conf_questions"])
+            }
+        ])
+    return {"orig" : tuple(orig_prefix), "conf" : tuple(conf_prefix)}
 
 
+def count_few_shot_prefix_tokens(llm, prompt_key, kind):
+    """
+    Number of tokens of a few-shot prefix ("orig" or "conf") for the LLM's model, counted once
+    per prompt key and model, since the prefix is the same for every call
+    """
+    model = LLM.get(llm).model
+    key = (prompt_key, kind, model)
+    if key not in few_shot_prefix_tokens:
+        few_shot_prefix_tokens[key] = budgetlib.count_message_tokens(few_shot_prefixes[prompt_key][kind], model)
+    return few_shot_prefix_tokens[key]
+
+
+def record_prompt_cache_usage(llm, prompt_key):
+    """
+    Add the prompt tokens of this thread's last call to `llm`, cached or not, to the report for `prompt_key`
+    """
+    usage = LLM.get(llm).last_usage
+    if not usage:
+        return
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    with prompt_cache_lock:
+        counts = prompt_cache_usage.setdefault(prompt_key, {"calls" : 0, "prompt_tokens" : 0, "cached_tokens" : 0})
+        counts["calls"] += 1
+        counts["prompt_tokens"] += prompt_tokens
+        counts["cached_tokens"] += cached_tokens
+
+
+def print_prompt_cache_report():
+    with prompt_cache_lock:
+        for prompt_key, counts in prompt_cache_usage.items():
+            uncached_tokens = counts["prompt_tokens"] - counts["cached_tokens"]
+            cached_share = counts["cached_tokens"] / counts["prompt_tokens"] if counts["prompt_tokens"] else 0.0
+            print(
+                f"Prompt tokens for {prompt_key}: {counts['calls']} calls, " +
+                f"{counts['cached_tokens']} cached + {uncached_tokens} uncached ({cached_share:.1%} cached)"
+            )
+
+
+@telemetrylib.labeled
 def reduce_document(llm, document, prompt_key):
     prompt = []
     if document_transforms[prompt_key]["system"]:
@@ -86,9 +391,20 @@ def reduce_document(llm, document, prompt_key):
     return reduce_doc
 
 
-def modify_reduced_document(llm, reduce_doc, prompt_key):
+@telemetrylib.labeled
+def modify_reduced_document(llm, reduce_doc, prompt_key, strategy = None):
+    """
+    Suppress and re-impute every fact of the reduced document, one third of the facts at a time.
+    With the "sequential" strategy, each round works on the output of the previous one (three
+    round-trips); with "parallel", the three rounds all start from the reduced document and run
+    concurrently, and the imputed facts are merged by index (about one round-trip).
+    """
     if prompt_key in ["dt01", "dt02"]:
         return reduce_doc  
+    strategy = strategy or modify_strategy
+    if strategy == "parallel":
+        return modify_reduced_document_in_parallel(llm, reduce_doc, prompt_key)
+    assert strategy == "sequential", f"Unknown strategy {strategy}"
     doc_0 = reduce_doc
     doc_1 = suppress_facts(doc_0, lambda i: (i % 3 == 2))
     doc_2 = impute_facts(llm, doc_1, prompt_key)
@@ -99,7 +415,21 @@ def modify_reduced_document(llm, reduce_doc, prompt_key):
     modify_doc = doc_6
     return modify_doc
 
-def impute_facts(llm, missing_facts_doc, prompt_key):
+def modify_reduced_document_in_parallel(llm, reduce_doc, prompt_key):
+    facts = split_facts(reduce_doc)
+    residues = [2, 1, 0]  # Same order as the sequential rounds
+    prompts = [
+        impute_facts_prompt(suppress_facts(reduce_doc, lambda i, r = r: (i % 3 == r)), prompt_key)
+            for r in residues
+    ]
+    imputed_docs = LLM.get(llm).call_all(prompts)
+    for r, imputed_facts_doc in zip(residues, imputed_docs):
+        imputed_facts = split_facts(strip_list_of_facts_header(imputed_facts_doc))
+        for i in range(r, min(len(facts), len(imputed_facts)), 3):
+            facts[i] = imputed_facts[i]  # If the LLM dropped some facts, the original ones remain
+    return utils.enum_list(facts)
+
+def impute_facts_prompt(missing_facts_doc, prompt_key):
     prompt = []
     if document_transforms[prompt_key]["system"]:
         prompt.append({
@@ -110,13 +440,19 @@ def impute_facts(llm, missing_facts_doc, prompt_key):
         "role" : "user",
         "content" : document_transforms[prompt_key]["user_modify"].format(document = missing_facts_doc)
     })
-    imputed_facts_doc = LLM.get(llm)(prompt)
+    return prompt
+
+def strip_list_of_facts_header(imputed_facts_doc):
     lines = imputed_facts_doc.splitlines()
     if "list of facts" in lines[0].lower():
         imputed_facts_doc = "\n".join(lines[1:])
     return imputed_facts_doc
 
-def suppress_facts(text, suppress):
+def impute_facts(llm, missing_facts_doc, prompt_key):
+    imputed_facts_doc = LLM.get(llm)(impute_facts_prompt(missing_facts_doc, prompt_key))
+    return strip_list_of_facts_header(imputed_facts_doc)
+
+def split_facts(text):
     raw_lines = text.splitlines()
     lines = [line.strip() for line in raw_lines]
     facts = []
@@ -131,6 +467,10 @@ def suppress_facts(text, suppress):
                     facts.append(line[x.span()[1]:])
                 else:
                     facts.append(line)
+    return facts
+
+def suppress_facts(text, suppress):
+    facts = split_facts(text)
     # print(f"\n\n{utils.enum_list(facts)}\n\n")
     for i in range(len(facts)):
         if suppress(i):
@@ -138,6 +478,7 @@ def suppress_facts(text, suppress):
     # print(f"\n\n{utils.enum_list(facts)}\n\n")
     return utils.enum_list(facts)
 
+@telemetrylib.labeled
 def expand_document(llm, reduce_doc, prompt_key):
     prompt = []
     if document_transforms[prompt_key]["system"]:
@@ -154,62 +495,80 @@ def expand_document(llm, reduce_doc, prompt_key):
 
 
 
+@telemetrylib.labeled
 def generate_questions(llm, document, num_q, prompt_key = "q01"):
-    example_keys = ["Weywot-1", "ElDorado-1"]
-    prompt = []
-    if question_generation[prompt_key]["system"]:
-        prompt.append({
-            "role" : "system",
-            "content" : question_generation[prompt_key]["system"]
-        })
-    for key in example_keys:
-        ex_document = examples_of_questions[key]["document"]
-        ex_num_q = examples_of_questions[key]["num_q"]
-        prompt.append({
-            "role" : "user",
-            "content" : question_generation[prompt_key]["user_orig"].format(num_q = ex_num_q, document = ex_document)
-        })
-        prompt.append({
-            "role" : "assistant",
-            "content" : utils.enum_list(examples_of_questions[key]["orig_questions"])
-        })
+    """
+    Asks for `num_q` questions about the document; a document too long for the prompt
+    (see `budgetlib`) is split into chunks, with questions about each chunk by its share of the document
+    """
+    chunks = budgetlib.split_to_fit(llm, document, [{
+        "role" : "user",
+        "content" : question_generation[prompt_key]["user_orig"].format(num_q = num_q, document = "")
+    }], count_few_shot_prefix_tokens(llm, prompt_key, "orig"))
+    if len(chunks) > 1:
+        counts = budgetlib.share(num_q, [len(chunk) for chunk in chunks])
+        return [
+            question for chunk, count in zip(chunks, counts) if count > 0
+                for question in generate_questions(llm, chunk, count, prompt_key)
+        ]
+    prompt = list(few_shot_prefixes[prompt_key]["orig"])
     prompt.append({
         "role" : "user",
         "content" : question_generation[prompt_key]["user_orig"].format(num_q = num_q, document = document)
     })
     # print("\n\n" + str(prompt) + "\n\n")
     raw_questions = LLM.get(llm)(prompt)
+    record_prompt_cache_usage(llm, prompt_key)
     questions = utils.parse_numbered_questions(raw_questions)
     return questions
 
 
+@telemetrylib.labeled
 def confuse_questions(llm, document, questions, prompt_key = "q01"):
-    example_keys = ["Weywot-1", "ElDorado-1"]
-    prompt = []
-    if question_generation[prompt_key]["system"]:
-        prompt.append({
-            "role" : "system",
-            "content" : question_generation[prompt_key]["system"]
-        })
-    for key in example_keys:
-        ex_document = examples_of_questions[key]["document"]
-        ex_num_q = examples_of_questions[key]["num_q"]
-        prompt.append({
+    """
+    Asks to modify the questions about the document so that they make false assumptions; for a document
+    too long for the prompt, each question goes with the chunk it matches best (see `budgetlib`), and
+    the confusing questions still come back in the order of the questions
+    """
+    chunks = budgetlib.split_to_fit(llm, document, [
+        {
             "role" : "user",
-            "content" : question_generation[prompt_key]["user_orig"].format(num_q = ex_num_q, document = ex_document)
-        })
-        prompt.append({
+            "content" : question_generation[prompt_key]["user_orig"].format(num_q = len(questions), document = "")
+        },
+        {
             "role" : "assistant",
-            "content" : utils.enum_list(examples_of_questions[key]["orig_questions"])
-        })
-        prompt.append({
+            "content" : utils.enum_list(questions)
+        },
+        {
             "role" : "user",
-            "content" : question_generation[prompt_key]["user_conf"].format(num_q = ex_num_q, document = ex_document)
-        })
-        prompt.append({
-            "role" : "assistant",
-            "content" : utils.enum_list(examples_of_questions[key]["conf_questions"])
-        })
+            "content" : question_generation[prompt_key]["user_conf"].format(num_q = len(questions), document = "")
+        }
+    ], count_few_shot_prefix_tokens(llm, prompt_key, "conf"))
+    if len(chunks) > 1:
+        groups = [[] for _ in chunks]  # Indexes of the questions that go with each chunk
+        for i, question in enumerate(questions):
+            scores = budgetlib.rank_passages(question, chunks)
+            groups[scores.index(max(scores))].append(i)
+        conf_questions = [None] * len(questions)
+        for chunk, group in zip(chunks, groups):
+            if not group:
+                continue
+            group_questions = [questions[i] for i in group]
+            results = confuse_questions(llm, chunk, group_questions, prompt_key)
+            if len(results) != len(group) and len(group) > 1:  # Cannot tell which is which: one call per question
+                results = [
+                    result for question in group_questions
+                        for result in confuse_questions(llm, chunk, [question], prompt_key)
+                ]
+            if len(results) != len(group):
+                raise LLMException(
+                    f"Model = {llm}, Error = {len(results)} confusing questions for {len(group)} questions\n" +
+                    f"Questions: {group_questions}"
+                )
+            for i, result in zip(group, results):
+                conf_questions[i] = result
+        return conf_questions
+    prompt = list(few_shot_prefixes[prompt_key]["conf"])
     prompt.append({
         "role" : "user",
         "content" : question_generation[prompt_key]["user_orig"].format(num_q = len(questions), document = document)
@@ -224,11 +583,29 @@ def confuse_questions(llm, document, questions, prompt_key = "q01"):
     })
     # print("\n\n" + str(prompt) + "\n\n")
     raw_questions = LLM.get(llm)(prompt)
+    record_prompt_cache_usage(llm, prompt_key)
     questions = utils.parse_numbered_questions(raw_questions)
     return questions
 
 
+def fit_rag_document(llm, document, question, prompt_key, p_type, rest = ()):
+    """
+    The document, or only its chunks most relevant to the question if it does not fit in the prompt
+    of kind `p_type` followed by the messages `rest` (see `budgetlib.fit_document`)
+    """
+    messages = [{
+        "role" : "system",
+        "content" : rag_confusion_check[prompt_key]["system"] or ""
+    }, {
+        "role" : "user",
+        "content" : rag_confusion_check[prompt_key][p_type].format(document = "", question = question)
+    }]
+    return budgetlib.fit_document(llm, document, question, messages + list(rest))
+
+
+@telemetrylib.labeled
 def generate_response(llm, document, question, prompt_key = "r02"):
+    document = fit_rag_document(llm, document, question, prompt_key, "user_rag")
     prompt = []
     if rag_confusion_check[prompt_key]["system"]:
         prompt.append({
@@ -243,7 +620,127 @@ def generate_response(llm, document, question, prompt_key = "r02"):
     return response
 
 
+@telemetrylib.labeled
+def generate_responses(llm, document, questions, prompt_key = "r02"):
+    """
+    Answer several questions about the same document with one LLM call, so that the
+    document is sent once rather than once per question.  Falls back to one call per
+    question if the prompts have no "user_rag_multi" template, or if the labeled
+    answers cannot be parsed.
+    """
+    if len(questions) <= 1 or not rag_confusion_check[prompt_key].get("user_rag_multi"):
+        return [generate_response(llm, document, question, prompt_key) for question in questions]
+    budget = budgetlib.document_budget(llm, [{
+        "role" : "system",
+        "content" : rag_confusion_check[prompt_key]["system"] or ""
+    }, {
+        "role" : "user",
+        "content" : rag_confusion_check[prompt_key]["user_rag_multi"].format(
+            num_q = len(questions), document = "", questions = utils.enum_list(questions)
+        )
+    }])
+    if budgetlib.count_tokens(document, LLM.get(llm).model) > budget:
+        # Each question gets the chunks of the document relevant to it
+        return [generate_response(llm, document, question, prompt_key) for question in questions]
+    prompt = []
+    if rag_confusion_check[prompt_key]["system"]:
+        prompt.append({
+            "role" : "system",
+            "content" : rag_confusion_check[prompt_key]["system"]
+        })
+    prompt.append({
+        "role" : "user",
+        "content" : rag_confusion_check[prompt_key]["user_rag_multi"].format(
+            num_q = len(questions), document = document, questions = utils.enum_list(questions)
+        )
+    })
+    raw_responses = LLM.get(llm)(prompt)
+    responses = utils.parse_numbered_answers(raw_responses, len(questions))
+    if responses is None:
+        responses = [generate_response(llm, document, question, prompt_key) for question in questions]
+    return responses
+
+
+def normalize_reply(text):
+    """
+    The reply in lowercase, without leading spaces and markup (as in "**No**, ...")
+    """
+    return text.lstrip(" \t\n*_#>\"'`").lower()
+
+def starts_with_any(text, prefixes):
+    text = normalize_reply(text)
+    return any(text.startswith(prefix) for prefix in prefixes)
+
+def partial_verdict(text, no_prefixes, yes_prefixes):
+    """
+    The verdict that the start of a reply already shows: "yes", "no", "other" (if it cannot
+    start with any of the prefixes anymore), or `None` if it is too early to tell
+    """
+    if structured_verdicts:
+        x = re.search(r'"verdict"\s*:\s*"(yes|no)"', text, re.IGNORECASE)
+        return x.group(1).lower() if x else None
+    text = normalize_reply(text)
+    if any(text.startswith(prefix) for prefix in no_prefixes):
+        return "no"
+    if any(text.startswith(prefix) for prefix in yes_prefixes):
+        return "yes"
+    if any(prefix.startswith(text) for prefix in no_prefixes + yes_prefixes):
+        return None
+    return "other"
+
+def parse_verdict(reply, no_prefixes, yes_prefixes):
+    """
+    The verdict of a reply to a yes/no check ("yes", "no" or `None` if unclear), and the text to store
+
+    A JSON reply (also inside other text or a code block) that has a valid "verdict" is stored
+    as "Yes. <reason>" or "No. <reason>"; a JSON reply cut short still gives its verdict, if it got
+    that far; any other reply is kept as it is, and judged by how it starts.
+    """
+    x = re.search(r"\{.*\}", reply, re.DOTALL)
+    if x:
+        try:
+            parsed = json.loads(x.group(0))
+        except json.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, dict) and str(parsed.get("verdict")).strip().lower() in ["yes", "no"]:
+            verdict = str(parsed["verdict"]).strip().lower()
+            return verdict, (verdict.capitalize() + ". " + str(parsed.get("reason") or "")).strip()
+    x = re.search(r'^\s*(?:```(?:json)?\s*)?\{\s*"verdict"\s*:\s*"(yes|no)"', reply, re.IGNORECASE)
+    if x:
+        return x.group(1).lower(), reply
+    if starts_with_any(reply, no_prefixes):
+        return "no", reply
+    if starts_with_any(reply, yes_prefixes):
+        return "yes", reply
+    return None, reply
+
+def ask_for_verdict(llm, prompt, stop = None):
+    """
+    Calls the LLM for a yes/no check
+
+    With `structured_verdicts`, asks for a JSON reply of `verdict_schema` within `verdict_max_tokens`,
+    enforced by the server if the LLM supports it, and only by the instruction otherwise
+    (see `parse_verdict`).  With `early_verdicts`, streams the reply and stops reading it
+    as soon as `stop(text so far)` is true, returning only the start of the reply.
+    """
+    model = LLM.get(llm)
+    parameters = None
+    if structured_verdicts:
+        prompt = prompt[:-1] + [{**prompt[-1], "content" : prompt[-1]["content"] + verdict_instruction}]
+        parameters = {"max_tokens" : verdict_max_tokens}
+        if model.structured_output == "json_schema":
+            parameters["response_format"] = {
+                "type" : "json_schema",
+                "json_schema" : {"name" : "verdict", "strict" : True, "schema" : verdict_schema}
+            }
+        elif model.structured_output == "json_object":
+            parameters["response_format"] = {"type" : "json_object"}
+    return model(prompt, on_text = stop if early_verdicts else None, parameters = parameters)
+
+
+@telemetrylib.labeled
 def find_false_assumption(llm, document, question, prompt_key = "r02"):
+    document = fit_rag_document(llm, document, question, prompt_key, "user_conf_rag")
     prompt = []
     if rag_confusion_check[prompt_key]["system"]:
         prompt.append({
@@ -254,22 +751,21 @@ def find_false_assumption(llm, document, question, prompt_key = "r02"):
         "role" : "user",
         "content" : rag_confusion_check[prompt_key]["user_conf_rag"].format(document = document, question = question)
     })
-    confusion = LLM.get(llm)(prompt)
-    if (
-            confusion.lower().startswith("no") or
-            confusion.lower().startswith("answer: no") or
-            confusion.lower().startswith("the answer is: no") or
-            confusion.lower().startswith("the answer is \"no\"") or
-            confusion.lower().startswith("The answer to the question is: no") or
-            confusion.lower().startswith("The answer to the question is \"no\"") or
-            "the question does not contain a confusing part" in confusion.lower()
-        ):
+    # The reply is only stored if it finds a confusion, so it can be cut short once it says "no"
+    reply = ask_for_verdict(llm, prompt, lambda text: partial_verdict(text, no_confusion_prefixes, []) == "no")
+    verdict, confusion = parse_verdict(reply, no_confusion_prefixes, [])
+    if verdict == "no" or "the question does not contain a confusing part" in confusion.lower():
         return "none"
     else:
         return confusion
 
 
+@telemetrylib.labeled
 def check_response_for_defusion(llm, document, question, response, confusion, prompt_key = "r02"):
+    document = fit_rag_document(llm, document, question, prompt_key, "user_rag", [
+        {"role" : "assistant", "content" : response},
+        {"role" : "user", "content" : rag_confusion_check[prompt_key]["user_def_check"]}
+    ])
     prompt = []
     if rag_confusion_check[prompt_key]["system"]:
         prompt.append({
@@ -298,21 +794,10 @@ def check_response_for_defusion(llm, document, question, response, confusion, pr
         "role" : "user",
         "content" : rag_confusion_check[prompt_key]["user_def_check"]
     })
-    defusion = LLM.get(llm)(prompt)
-    if (
-            defusion.lower().startswith("no") or
-            defusion.lower().startswith("answer: no") or
-            defusion.lower().startswith("the answer is: no") or
-            defusion.lower().startswith("the answer is \"no\"")
-        ):
-        is_defused = "no"
-    elif (
-            defusion.lower().startswith("yes") or
-            defusion.lower().startswith("answer: yes") or
-            defusion.lower().startswith("the answer is: yes") or
-            defusion.lower().startswith("the answer is \"yes\"")
-        ):
-        is_defused = "yes"
-    else:
-        is_defused = "unsure"
+    stop = None if keep_verdict_text else (
+        lambda text: partial_verdict(text, no_defusion_prefixes, yes_defusion_prefixes) is not None
+    )
+    reply = ask_for_verdict(llm, prompt, stop)
+    verdict, defusion = parse_verdict(reply, no_defusion_prefixes, yes_defusion_prefixes)
+    is_defused = verdict or "unsure"
     return defusion, is_defused
@@ -0,0 +1,195 @@
+import asyncio, time, random, re
+from email.utils import parsedate_to_datetime
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def parse_duration(value):
+    """
+    Parses a rate-limit reset time in seconds, such as "20", "1.5", "20ms", "1s" or "6m0s"
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms" : 0.001, "s" : 1.0, "m" : 60.0, "h" : 3600.0}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def parse_retry_after(headers):
+    """
+    Returns the delay in seconds requested by the server, or `None` if there is none
+    """
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        delay = parse_duration(value)
+        return None if delay is None else delay / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    delay = parse_duration(value)
+    if delay is None:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, delay)
+
+def backoff_delay(attempt, base = 1.0, maximum = 60.0):
+    """
+    Exponential backoff with "equal jitter": a random delay in [d/2, d], where d = base * 2^attempt
+    """
+    delay = min(maximum, base * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+
+class TokenBucket:
+    """
+    Continuously refilled budget of `per_minute` units (requests or tokens);
+    `per_minute = None` means unlimited
+    """
+    def __init__(self, per_minute = None):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until `amount` units are available (an amount above capacity waits for a full bucket)
+        """
+        if self.capacity is None:
+            return 0.0
+        self.refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def observe(self, limit, remaining):
+        """
+        Syncs the bucket with the server's view of the limit and of what remains of it
+        """
+        if limit is not None and limit > 0:
+            if self.capacity is None:
+                self.level = limit
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            self.refill(time.monotonic())
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """
+    Paces the requests to one model with two token buckets, for requests/min and tokens/min
+
+    The buckets start from the configured limits (if any), then follow what the server
+    reports in its `x-ratelimit-*` headers.  When the server asks to back off with
+    `Retry-After`, or reports an exhausted limit, all requests to the model pause.
+    Must be used on a single event loop.
+    """
+    def __init__(self, requests_per_minute = None, tokens_per_minute = None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        """
+        Waits until the model can take one more request of about `tokens` tokens
+        """
+        async with self.lock:  # Waiters are served one by one, in order
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self.paused_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(tokens, now)
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """
+        Corrects the token budget once the actual usage of a request is known
+        """
+        self.tokens.take(actual_tokens - estimated_tokens)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe(self, headers):
+        """
+        Updates the buckets from the `x-ratelimit-*` response headers
+
+        Returns
+        -------
+            float | None : the remaining fraction of the tighter limit, if the server reported it
+        """
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, ValueError):
+                return None
+        headroom = None
+        for bucket, kind in [(self.requests, "requests"), (self.tokens, "tokens")]:
+            limit = number(f"x-ratelimit-limit-{kind}")
+            remaining = number(f"x-ratelimit-remaining-{kind}")
+            bucket.observe(limit, remaining)
+            if remaining is not None and remaining <= 0:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                self.pause(reset if reset is not None else 1.0)
+            if limit and remaining is not None:
+                fraction = max(0.0, remaining / limit)
+                headroom = fraction if headroom is None else min(headroom, fraction)
+        return headroom
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit (like a semaphore) that adapts to the observed rate-limit headroom:
+    it halves when the server throttles, shrinks when headroom is low,
+    and grows back up to `maximum` while headroom is plenty.  Must be used on a single event loop.
+    """
+    def __init__(self, maximum, low_headroom = 0.1, high_headroom = 0.5):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.low_headroom = low_headroom
+        self.high_headroom = high_headroom
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def throttled(self):
+        self.limit = max(1, self.limit // 2)
+
+    def observe(self, headroom):
+        """
+        Adjusts the limit after a successful request (`headroom = None` if the server did not report it)
+        """
+        if headroom is not None and headroom < self.low_headroom:
+            self.limit = max(1, self.limit - 1)
+        elif headroom is None or headroom > self.high_headroom:
+            self.limit = min(self.maximum, self.limit + 1)
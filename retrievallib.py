@@ -0,0 +1,153 @@
+import numpy as np
+import os, pickle, threading, argparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+import tablelib, budgetlib
+
+class PassageIndex:
+    """
+    Lexical retrieval index over the passages of all the documents of a document table,
+    stored in a file next to it
+
+    The documents are split into passages of about `passage_tokens` tokens along lines and sentences
+    (see `budgetlib.chunk_document`), and the passages are weighted by BM25 (as in `budgetlib.rank_passages`)
+    or by TF-IDF, with the term statistics of the whole corpus.  A search ranks the passages of one
+    document (for the questions about it) or of the whole corpus.  Like the document store, the index is built once,
+    and rebuilt only when the table or the settings change.
+    """
+    scorings = ["bm25", "tfidf"]
+
+    def __init__(self, doc_path, doc_schema, passage_tokens = 128, scoring = "bm25", k1 = 1.5, b = 0.75):
+        """
+        Opens the index of the document table, building it if needed
+
+        Parameters
+        ----------
+        doc_path : str
+            Path to the document table (any format supported by `tablelib`)
+        doc_schema : dict
+            Column names of the document table, the index uses "doc_id" and "document"
+        passage_tokens : int
+            Approximate size of the passages
+        scoring : str
+            "bm25" (Okapi BM25 with parameters `k1` and `b`) or "tfidf" (cosine similarity of TF-IDF vectors)
+
+        Returns
+        -------
+        A new PassageIndex instance
+        """
+        if scoring not in self.scorings:
+            raise ValueError(f"Unknown scoring {scoring}, choose from {self.scorings}")
+        self.doc_path = doc_path
+        self.path = doc_path + f".passages.{scoring}.pkl"
+        self.settings = {"passage_tokens" : passage_tokens, "scoring" : scoring, "k1" : k1, "b" : b}
+        self.lock = threading.Lock()
+        source = (os.path.abspath(doc_path),) + tablelib.file_stat(doc_path)
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+        if state is None or state["source"] != source or state["settings"] != self.settings:
+            state = self.build(doc_schema, source)
+        self.source = source
+        self.vectorizer = state["vectorizer"]
+        self.matrix = state["matrix"]
+        self.passages = state["passages"]
+        self.doc_ids = state["doc_ids"]
+        self.spans = state["spans"]
+
+    def build(self, doc_schema, source):
+        df_doc = tablelib.read_table(self.doc_path, "Index the passages of the document table",
+                                     [doc_schema["doc_id"], doc_schema["document"]])
+        passages, doc_ids, spans = [], [], {}
+        for doc_id, document in zip(df_doc[doc_schema["doc_id"]], df_doc[doc_schema["document"]]):
+            doc_passages = budgetlib.chunk_document(document, self.settings["passage_tokens"]) or [document]
+            spans[doc_id] = (len(passages), len(passages) + len(doc_passages))
+            passages.extend(doc_passages)
+            doc_ids.extend([doc_id] * len(doc_passages))
+        if self.settings["scoring"] == "tfidf":
+            vectorizer = TfidfVectorizer(sublinear_tf = True)
+            matrix = vectorizer.fit_transform(passages)
+        else:
+            vectorizer = budgetlib.passage_vectorizer()
+            matrix = budgetlib.bm25_weights(vectorizer.fit_transform(passages), self.settings["k1"], self.settings["b"])
+        state = {
+            "source" : source, "settings" : self.settings, "vectorizer" : vectorizer, "matrix" : matrix.tocsr(),
+            "passages" : passages, "doc_ids" : doc_ids, "spans" : spans
+        }
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+        print(f"    Indexed {len(passages)} passages of {len(spans)} documents in {self.path}")
+        return state
+
+    def scores(self, query, rows):
+        if self.settings["scoring"] == "bm25":
+            return budgetlib.bm25_scores(self.vectorizer, self.matrix[rows], query)
+        query_vector = self.vectorizer.transform([query])
+        return (self.matrix[rows] @ query_vector.T).toarray().ravel()
+
+    def search(self, query, doc_id = None, k = 3):
+        """
+        The `k` passages most relevant to the query, of the document `doc_id` or (if `None`) of the whole corpus
+
+        Returns
+        -------
+            list of (doc_id, passage, score), best first
+        """
+        with self.lock:
+            start, end = self.spans[doc_id] if doc_id is not None else (0, len(self.passages))
+            scores = self.scores(query, slice(start, end))
+        top = np.argsort(-scores, kind = "stable")[:k]
+        return [(self.doc_ids[start + i], self.passages[start + i], float(scores[i])) for i in top]
+
+    def context(self, doc_id, questions, k = 3):
+        """
+        The text to answer the questions about the document from: the top `k` passages for each question,
+        in the order of the document
+        """
+        with self.lock:
+            start, end = self.spans[doc_id]
+            chosen = set()
+            for question in questions:
+                scores = self.scores(question, slice(start, end))
+                chosen.update(int(i) for i in np.argsort(-scores, kind = "stable")[:k])
+        return "\n".join(self.passages[start + i] for i in sorted(chosen))
+
+
+indexes = {}  # (document table path, settings) -> PassageIndex, shared by the stages of a run
+indexes_lock = threading.Lock()
+
+def open_index(doc_schema, doc_path, **settings):
+    """
+    The shared passage index of the document table at `doc_path`, opened (or built) on first use;
+    `settings` are passed to `PassageIndex`
+    """
+    with indexes_lock:
+        key = (os.path.abspath(doc_path), tuple(sorted(settings.items())))
+        index = indexes.get(key)
+        if index is None or index.source != (key[0],) + tablelib.file_stat(doc_path):
+            index = indexes[key] = PassageIndex(doc_path, doc_schema, **settings)
+        return index
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Search the passages of a document table")
+    parser.add_argument("doc_path",
+                        help = "Document table, with columns doc_id and document")
+    parser.add_argument("query",
+                        help = "Text to search for")
+    parser.add_argument("--doc-id",
+                        help = "Search only the passages of this document")
+    parser.add_argument("-k", type = int, default = 3,
+                        help = "Number of passages to show")
+    parser.add_argument("--scoring", choices = PassageIndex.scorings, default = "bm25",
+                        help = "Weighting of the terms")
+    parser.add_argument("--passage-tokens", type = int, default = 128,
+                        help = "Approximate size of the passages")
+    args = parser.parse_args()
+
+    index = open_index({"doc_id" : "doc_id", "document" : "document"}, args.doc_path,
+                       passage_tokens = args.passage_tokens, scoring = args.scoring)
+    for doc_id, passage, score in index.search(args.query, args.doc_id, args.k):
+        print(f"[{doc_id}] {score:.3f}  {passage}\n")
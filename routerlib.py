@@ -0,0 +1,287 @@
+from llmlib import LLM, LLMException, _engine
+import os, time, json, asyncio
+import httpx
+from ratelimitlib import RETRY_STATUS_CODES
+
+class Endpoint:
+    """
+    One server (or API key) behind a routed LLM, with its load and health
+
+    The circuit breaker opens after `failure_threshold` consecutive failed calls: the endpoint
+    then gets no calls for `cooldown` seconds, after which one call (or health check) probes it;
+    if that succeeds the circuit closes again, otherwise it stays open for another cooldown.
+    The state is only updated on the engine loop, so it needs no lock.
+    """
+    def __init__(self, llm, failure_threshold = 3, cooldown = 30.0):
+        self.llm = llm
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.outstanding = 0  # Calls in flight, including the waits for rate limits and retries
+        self.latency = None  # Moving average of the seconds per successful call
+        self.failures = 0  # Consecutive failed calls
+        self.opened_at = None  # When the circuit opened, `None` while it is closed
+        self.probing = False  # Whether a call is probing the open circuit
+        self.calls = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return f"Endpoint(llm = '{self.llm.name}', url = {self.llm.url}, state = {self.state()})"
+
+    def state(self, now = None):
+        """
+        "closed" (healthy), "open" (skipped until the cooldown ends) or "half-open" (ready for a probe)
+        """
+        if self.opened_at is None:
+            return "closed"
+        if (now or time.monotonic()) - self.opened_at < self.cooldown or self.probing:
+            return "open"
+        return "half-open"
+
+    def succeeded(self, latency):
+        self.calls += 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        self.calls += 1
+        self.errors += 1
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def load(self, policy):
+        """
+        Sort key of the endpoint for routing the next call (lower is better)
+        """
+        paused = self.llm.rate_limiter.paused_until > time.monotonic()
+        if policy == "latency":
+            # Expected wait: the calls ahead of it, spread over its concurrency, at its latency;
+            # an endpoint without a measured latency yet goes first, to measure it
+            return (paused, (self.outstanding + 1) * (self.latency or 0.0) / self.llm.concurrency.limit)
+        return (paused, self.outstanding / self.llm.concurrency.limit)
+
+
+class RoutedLLM(LLM):
+    """
+    LLM whose calls are spread over several endpoints (servers or API keys) of the same model
+
+    Each call goes to the healthy endpoint with the fewest calls outstanding (relative to its
+    concurrency limit) or, with `policy = "latency"`, with the shortest expected wait; an endpoint
+    paused by its rate limits is only chosen if all of them are.  If the call fails on an endpoint
+    (a connection error or a retryable status after the endpoint's own retries), it transparently
+    fails over to the next endpoint, and the call only fails once every endpoint has failed it.
+    Endpoints that keep failing are skipped for a while (see `Endpoint`).
+
+    The response cache, batch jobs and streaming work as for any LLM; the calls are recorded in
+    `LLM.metrics` under the names of the endpoints, so the summaries show the load of each.
+    """
+    policies = ["least-outstanding", "latency"]
+
+    def __init__(self, name, endpoints, policy = "least-outstanding", failure_threshold = 3, cooldown = 30.0,
+                 health_check_interval = None):
+        """
+        Creates a routed LLM over existing LLM instances (also available through the registry)
+
+        Parameters
+        ----------
+        name : str
+            Short name, to use in CSV tables and as key in the registry
+        endpoints : list
+            LLM instances (or their names in the registry) serving the same model; the first one
+            provides the model name, parameters, and the URL and headers of the cache key and batch jobs
+        policy : str
+            "least-outstanding" or "latency" (see above)
+        failure_threshold : int
+            Number of consecutive failed calls that opens the circuit of an endpoint
+        cooldown : float
+            Seconds an open circuit stays open before the endpoint is probed again
+        health_check_interval : float
+            If given, every so many seconds the endpoints with an open circuit are probed with a
+            one-token request, so that they come back without risking a real call
+
+        Returns
+        -------
+        A new RoutedLLM instance
+        """
+        endpoints = [LLM.get(llm) if isinstance(llm, str) else llm for llm in endpoints]
+        if not endpoints or None in endpoints:
+            raise LLMException(f"Routed LLM {name} needs existing LLMs as endpoints, got {endpoints}")
+        if policy not in self.policies:
+            raise LLMException(f"Unknown routing policy {policy}, choose from {self.policies}")
+        first = endpoints[0]
+        super().__init__(
+            name = name,
+            model = first.model,
+            url = first.url,
+            headers = first.headers,
+            parameters = dict(first.parameters),
+            max_concurrency = sum(llm.max_concurrency for llm in endpoints),
+            max_retries = first.max_retries,
+            structured_output = first.structured_output
+        )
+        self.endpoints = [Endpoint(llm, failure_threshold, cooldown) for llm in endpoints]
+        self.policy = policy
+        self.health_check_interval = health_check_interval
+        self.health_task = None
+        self.turn = 0  # Rotates the ties between equally loaded endpoints
+
+    def __repr__(self):
+        return (
+            f"RoutedLLM(name = '{self.name}', policy = '{self.policy}', " +
+            f"endpoints = {[endpoint.llm.name for endpoint in self.endpoints]})"
+        )
+
+    def choose(self, tried):
+        """
+        The endpoint for the next attempt of a call, among those it has not `tried` yet (`None` if none is left)
+        """
+        now = time.monotonic()
+        untried = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+        if not untried:
+            return None
+        healthy = [endpoint for endpoint in untried if endpoint.state(now) != "open"]
+        if not healthy:  # All circuits are open: rather try the one that opened first than fail the call
+            return min(untried, key = lambda endpoint: endpoint.opened_at)
+        self.turn += 1
+        order = {endpoint : (i - self.turn) % len(self.endpoints) for i, endpoint in enumerate(self.endpoints)}
+        return min(healthy, key = lambda endpoint: (endpoint.load(self.policy), order[endpoint]))
+
+    async def _send(self, json_data, messages, parameters, prompt, labels, call_start_time, on_text = None):
+        """
+        Sends the request to the chosen endpoint, failing over to the others (see `LLM._send`)
+        """
+        if self.health_check_interval is not None and self.health_task is None:
+            self.health_task = asyncio.create_task(self.run_health_checks())
+        tried, error = set(), None
+        while (endpoint := self.choose(tried)) is not None:
+            tried.add(endpoint)
+            probe = endpoint.state() == "half-open"
+            endpoint.outstanding += 1
+            endpoint.probing = endpoint.probing or probe
+            start_time = time.time()
+            try:
+                result = await endpoint.llm._send(
+                    {**json_data, "model" : endpoint.llm.model}, messages, parameters,
+                    prompt, labels, call_start_time, on_text
+                )
+            except LLMException as e:
+                if e.status is not None and e.status not in RETRY_STATUS_CODES:
+                    endpoint.succeeded(time.time() - start_time)  # The server is fine, the request is not
+                    raise
+                endpoint.failed()
+                error = e
+                continue
+            finally:
+                endpoint.outstanding -= 1
+                if probe:
+                    endpoint.probing = False
+            endpoint.succeeded(time.time() - start_time)
+            return result
+        raise LLMException(f"Routed LLM {self.name}: all {len(self.endpoints)} endpoints failed, the last with:\n{error}")
+
+    async def probe(self, endpoint):
+        """
+        Sends a one-token request to the endpoint and updates its health
+        """
+        json_data = {
+            "model" : endpoint.llm.model,
+            "messages" : [{"role" : "user", "content" : "Reply with OK."}],
+            "max_tokens" : 1
+        }
+        start_time = time.time()
+        endpoint.probing = True
+        try:
+            response = await _engine.client(endpoint.llm.url).post(
+                endpoint.llm.url, headers = endpoint.llm.headers, json = json_data
+            )
+            healthy = response.status_code == 200
+        except httpx.TransportError:
+            healthy = False
+        finally:
+            endpoint.probing = False
+        if healthy:
+            endpoint.succeeded(time.time() - start_time)
+        else:
+            endpoint.failed()
+        return healthy
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            now = time.monotonic()
+            await asyncio.gather(*[
+                self.probe(endpoint) for endpoint in self.endpoints if endpoint.state(now) == "half-open"
+            ])
+
+    def check_health(self):
+        """
+        Probes all the endpoints now, and returns whether each one is healthy, by name
+        """
+        async def probe_all():
+            return await asyncio.gather(*[self.probe(endpoint) for endpoint in self.endpoints])
+        healthy = _engine.submit(probe_all()).result()
+        return {endpoint.llm.name : ok for endpoint, ok in zip(self.endpoints, healthy)}
+
+    def status(self):
+        """
+        Load and health of the endpoints, one dict per endpoint
+        """
+        return [
+            {
+                "name" : endpoint.llm.name, "url" : endpoint.llm.url, "state" : endpoint.state(),
+                "outstanding" : endpoint.outstanding, "latency" : endpoint.latency,
+                "calls" : endpoint.calls, "errors" : endpoint.errors
+            } for endpoint in self.endpoints
+        ]
+
+
+def read_routes(path):
+    """
+    Registers the routed LLMs described in a JSON file, such as:
+
+        {
+            "llama3-8B-in" : {
+                "policy" : "latency",
+                "endpoints" : [
+                    {"url" : "https://api.runpod.ai/v2/<id-1>/openai/v1/chat/completions", "api_key_env" : "RUNPOD_API_KEY"},
+                    {"url" : "https://api.runpod.ai/v2/<id-2>/openai/v1/chat/completions", "api_key_env" : "RUNPOD_API_KEY"}
+                ]
+            }
+        }
+
+    Each endpoint starts from the LLM of that name in the registry (model, URL, headers, parameters),
+    overridden by its "model", "url", "api_key_env" (the variable with its API key), "max_concurrency",
+    "requests_per_minute", "tokens_per_minute" and "max_retries" (by default 1, since the routed LLM
+    fails over instead); the endpoints are registered as "<name>@1", "<name>@2", and so on.
+    The other keys of a route ("policy", "failure_threshold", "cooldown", "health_check_interval")
+    are passed to `RoutedLLM`.
+
+    Returns
+    -------
+        list of RoutedLLM
+    """
+    with open(path, "r", encoding = "utf-8") as f:
+        routes = json.load(f)
+    routed = []
+    for name, route in routes.items():
+        base = LLM.get(name)
+        endpoints = []
+        for i, spec in enumerate(route.pop("endpoints"), start = 1):
+            headers = dict(base.headers) if base else {"Content-Type" : "application/json"}
+            if "api_key_env" in spec:
+                headers["Authorization"] = "Bearer " + os.getenv(spec["api_key_env"], "")
+            endpoints.append(LLM(
+                name = f"{name}@{i}",
+                model = spec.get("model", base.model if base else name),
+                url = spec.get("url", base.url if base else None),
+                headers = headers,
+                parameters = dict(base.parameters) if base else {},
+                max_concurrency = spec.get("max_concurrency", base.max_concurrency if base else 8),
+                requests_per_minute = spec.get("requests_per_minute"),
+                tokens_per_minute = spec.get("tokens_per_minute"),
+                max_retries = spec.get("max_retries", 1),
+                structured_output = base.structured_output if base else None
+            ))
+        routed.append(RoutedLLM(name, endpoints, **route))
+    return routed
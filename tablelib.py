@@ -0,0 +1,137 @@
+import pandas as pd
+import os, shutil
+
+class CSVStore:
+    """
+    Table in one CSV file, all values read as strings.  Adding columns rewrites the whole file.
+    """
+    def columns(self, path):
+        return pd.read_csv(path, dtype = str, na_filter = False, nrows = 0).columns.tolist()
+
+    def read(self, path, columns = None):
+        df = pd.read_csv(path, dtype = str, na_filter = False, usecols = columns)
+        return df if columns is None else df[columns]
+
+    def write(self, df, path):
+        df.to_csv(path, index = False)
+
+    def append_columns(self, path_in, path_out, new_columns):
+        df = self.read(path_in)
+        df = pd.concat([df, new_columns.set_axis(df.index)], axis = 1)
+        self.write(df, path_out)
+
+
+class ParquetStore:
+    """
+    Table in a folder of Parquet files, each holding a group of columns for all the rows, in order
+
+    New columns go into a new file of the folder, so adding them does not re-encode the existing ones;
+    a table derived from another one links to its files (or copies them if links are not possible).
+    Reading a subset of the columns only opens the files that hold them.  Requires `pyarrow`.
+    """
+    def parts(self, path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".parquet"))
+
+    def part_columns(self, path):
+        import pyarrow.parquet as pq
+        return [(part, pq.read_schema(part).names) for part in self.parts(path)]
+
+    def columns(self, path):
+        return [column for _, part_columns in self.part_columns(path) for column in part_columns]
+
+    def read(self, path, columns = None):
+        import pyarrow.parquet as pq
+        frames = []
+        for part, part_columns in self.part_columns(path):
+            wanted = part_columns if columns is None else [c for c in part_columns if c in columns]
+            if wanted:
+                frames.append(pq.read_table(part, columns = wanted).to_pandas())
+        missing = set(columns or []) - {c for df in frames for c in df.columns}
+        if missing:
+            raise KeyError(f"Columns {sorted(missing)} are not in table {path}")
+        df = pd.concat(frames, axis = 1) if frames else pd.DataFrame()
+        return df if columns is None else df[columns]
+
+    def write(self, df, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.write_part(df, os.path.join(path, "part-000.parquet"))
+
+    def write_part(self, df, part):
+        import pyarrow as pa, pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df.astype(str).reset_index(drop = True), preserve_index = False)
+        pq.write_table(table, part)
+
+    def append_columns(self, path_in, path_out, new_columns):
+        import pyarrow.parquet as pq
+        parts = self.parts(path_in)
+        num_rows = pq.read_metadata(parts[0]).num_rows if parts else 0
+        if len(new_columns) != num_rows:
+            raise ValueError(f"Table {path_in} has {num_rows} rows, but {len(new_columns)} values are added")
+        if os.path.abspath(path_in) != os.path.abspath(path_out):
+            if os.path.isdir(path_out):
+                shutil.rmtree(path_out)
+            os.makedirs(path_out)
+            for part in parts:
+                target = os.path.join(path_out, os.path.basename(part))
+                try:
+                    os.link(part, target)
+                except OSError:
+                    shutil.copyfile(part, target)
+        self.write_part(new_columns, os.path.join(path_out, f"part-{len(parts):03d}.parquet"))
+
+
+stores = {  # File extension -> table store, add more to support other formats
+    ".csv" : CSVStore(),
+    ".parquet" : ParquetStore()
+}
+
+def get_store(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in stores:
+        raise ValueError(f"No table store for extension \"{extension}\" of {path}")
+    return stores[extension]
+
+def read_columns(path):
+    """
+    The names of the table's columns, without reading its rows
+    """
+    return get_store(path).columns(path)
+
+def file_stat(path):
+    """
+    Total size and latest modification time of a table file or folder
+    """
+    paths = [path] if os.path.isfile(path) else [os.path.join(path, name) for name in os.listdir(path)]
+    stats = [os.stat(file_path) for file_path in paths]
+    return sum(s.st_size for s in stats), max((s.st_mtime for s in stats), default = 0.0)
+
+def read_table(path, comment, columns = None):
+    """
+    Read the table (all of it, or only the given `columns`) into a DataFrame of strings
+    """
+    print(comment + ":\n    " + path)
+    df = get_store(path).read(path, columns)
+    print("    Rows: " + str(len(df)) + ",  Cols: " + str(len(df.columns)))
+    print("    " + str(df.columns))
+    return df
+
+def write_table(df, path, comment):
+    print(comment + ":\n    " + path)
+    print("    Rows: " + str(len(df)) + ",  Cols: " + str(len(df.columns)))
+    print("    " + str(df.columns))
+    get_store(path).write(df, path)
+
+def append_columns(path_in, path_out, new_columns, comment):
+    """
+    Write the table at `path_in` with the `new_columns` (dictionary of column name -> list of values,
+    one per row) added to it, to `path_out`; both paths must have the same format
+    """
+    store = get_store(path_in)
+    if get_store(path_out) is not store:
+        raise ValueError(f"Tables {path_in} and {path_out} have different formats")
+    new_columns = pd.DataFrame(new_columns, dtype = str)
+    print(comment + ":\n    " + path_out)
+    print("    Rows: " + str(len(new_columns)) + ",  New cols: " + str(new_columns.columns))
+    store.append_columns(path_in, path_out, new_columns)
@@ -0,0 +1,204 @@
+import pandas as pd
+import json, time, threading, contextvars, functools, inspect
+from contextlib import contextmanager
+
+_labels = contextvars.ContextVar("telemetry_labels", default = {})
+
+@contextmanager
+def labels(**new_labels):
+    """
+    Labels the LLM calls made inside the `with` block, such as `stage = "STEP 1"` or `prompt_key = "dt03"`
+    """
+    token = _labels.set({**_labels.get(), **new_labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+def current_labels():
+    return _labels.get()
+
+def labeled(func):
+    """
+    Decorator for the functions that make LLM calls: labels the calls with the function name
+    (as "task") and its `prompt_key` argument, if any
+    """
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        with labels(task = func.__name__, prompt_key = bound.arguments.get("prompt_key")):
+            return func(*args, **kwargs)
+    return wrapper
+
+def prometheus_label(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+class CallMetrics:
+    """
+    Sink for the latency and token usage of every LLM call
+
+    Each call is aggregated in memory under its labels (stage, task, prompt key) and model;
+    with `jsonl_path`, every call is also appended to a JSONL file as one record,
+    and with `prometheus_path`, the aggregates can be exported in Prometheus text format.
+    """
+    counters = ["calls", "api_calls", "cache_hits", "batch_calls", "errors", "retries",
+                "prompt_tokens", "completion_tokens", "cached_tokens", "latency"]
+
+    def __init__(self, jsonl_path = None, prometheus_path = None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.groups = {}  # (stage, task, prompt_key, model) -> counters and latencies
+        self.lock = threading.Lock()
+        self.file = None
+
+    def record(self, model, labels, source, latency, status = None, attempts = 0, usage = None, error = None):
+        """
+        Records one LLM call
+
+        Parameters
+        ----------
+        model : str
+            Name of the LLM (as in the registry)
+        labels : dict
+            Labels of the call, see `labels`
+        source : str
+            "api" if the call went to the server, "cache" or "batch" if served from there
+        latency : float
+            Seconds from the start of the call until the response, including retries
+        status : int
+            HTTP status of the last attempt (`None` if there was no response)
+        attempts : int
+            Number of HTTP requests made
+        usage : dict
+            The `usage` block of the response
+        error : str
+            Error message, if the call failed
+        """
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        key = (labels.get("stage"), labels.get("task"), labels.get("prompt_key"), model)
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {counter : 0 for counter in self.counters}
+                group["latencies"] = []
+            group["calls"] += 1
+            group["api_calls"] += (source == "api")
+            group["cache_hits"] += (source == "cache")
+            group["batch_calls"] += (source == "batch")
+            group["errors"] += (error is not None)
+            group["retries"] += max(0, attempts - 1)
+            group["prompt_tokens"] += prompt_tokens
+            group["completion_tokens"] += completion_tokens
+            group["cached_tokens"] += cached_tokens
+            group["latency"] += latency
+            if source == "api":
+                group["latencies"].append(latency)
+            if self.jsonl_path is not None:
+                if self.file is None:
+                    self.file = open(self.jsonl_path, "a", encoding = "utf-8")
+                self.file.write(json.dumps({
+                    "time" : time.time(), "model" : model, **labels, "source" : source,
+                    "latency" : round(latency, 4), "status" : status, "attempts" : attempts,
+                    "prompt_tokens" : prompt_tokens, "completion_tokens" : completion_tokens,
+                    "cached_tokens" : cached_tokens, "error" : error
+                }, ensure_ascii = False) + "\n")
+
+    def summary(self, stage = None, by = ("stage", "task", "prompt_key")):
+        """
+        Aggregates of the recorded calls (only of `stage`, if given) for each group of `by` labels
+        (any of "stage", "task", "prompt_key", "model"), as a DataFrame
+        """
+        with self.lock:
+            rows = [
+                {"stage" : s, "task" : t, "prompt_key" : p, "model" : m, **group}
+                    for (s, t, p, m), group in self.groups.items() if stage is None or s == stage
+            ]
+        if not rows:
+            return pd.DataFrame()
+        df = pd.DataFrame(rows).fillna({"stage" : "", "task" : "", "prompt_key" : "", "model" : ""})
+        df = df.groupby(list(by)).agg({
+            **{counter : "sum" for counter in self.counters},
+            "latencies" : lambda values: [latency for latencies in values for latency in latencies]
+        })
+        df["mean_latency"] = df["latency"] / df["calls"]
+        df["p95_api_latency"] = df["latencies"].map(lambda values: pd.Series(values).quantile(0.95) if values else None)
+        return df.drop(columns = ["latencies"])
+
+    def latencies(self, stage = None):
+        """
+        Latencies of the calls sent to the server (only of `stage`, if given), for percentiles
+        """
+        with self.lock:
+            return [
+                latency for (s, _, _, _), group in self.groups.items() if stage is None or s == stage
+                    for latency in group["latencies"]
+            ]
+
+    def print_summary(self, stage = None):
+        df = self.summary(stage)
+        if df.empty:
+            return
+        print(f"LLM calls in {stage}:" if stage else "LLM calls:")
+        with pd.option_context("display.max_columns", None, "display.width", 200, "display.precision", 3):
+            print(df.drop(columns = ["latency"]))
+
+    def prometheus_text(self):
+        """
+        The aggregates in Prometheus text exposition format
+        """
+        metrics = [
+            ("llm_calls_total", "counter", "LLM calls", "calls"),
+            ("llm_api_calls_total", "counter", "LLM calls sent to the server", "api_calls"),
+            ("llm_cache_hits_total", "counter", "LLM calls served from the response cache", "cache_hits"),
+            ("llm_batch_calls_total", "counter", "LLM calls served from batch jobs", "batch_calls"),
+            ("llm_errors_total", "counter", "Failed LLM calls", "errors"),
+            ("llm_retries_total", "counter", "Retried HTTP requests", "retries"),
+            ("llm_prompt_tokens_total", "counter", "Prompt tokens", "prompt_tokens"),
+            ("llm_completion_tokens_total", "counter", "Completion tokens", "completion_tokens"),
+            ("llm_cached_tokens_total", "counter", "Prompt tokens served from the prompt cache", "cached_tokens"),
+            ("llm_latency_seconds_total", "counter", "Total latency of LLM calls", "latency")
+        ]
+        with self.lock:
+            groups = list(self.groups.items())
+        lines = []
+        for name, kind, help_text, counter in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (stage, task, prompt_key, model), group in groups:
+                label_values = {"stage" : stage, "task" : task, "prompt_key" : prompt_key, "model" : model}
+                label_text = ",".join(
+                    f"{k}={prometheus_label(v)}" for k, v in label_values.items() if v is not None
+                )
+                lines.append(f"{name}{{{label_text}}} {group[counter]}")
+        return "\n".join(lines) + "\n"
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Labels the LLM calls inside the `with` block with stage `name`, and prints their summary at the end
+        """
+        with labels(stage = name):
+            yield
+        self.print_summary(name)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+        if self.prometheus_path is not None:
+            with open(self.prometheus_path, "w", encoding = "utf-8") as f:
+                f.write(self.prometheus_text())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -1,5 +1,8 @@
 import pandas as pd
-import re
+import re, csv, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
 def read_csv(path, comment):
     print(comment + ":\n    " + path)
@@ -14,6 +17,107 @@ def write_csv(df, path, comment):
     print("    " + str(df.columns))
     df.to_csv(path, index = False)
 
+def iter_csv(path, comment, chunksize = 1000):
+    """
+    Read the CSV file in chunks of `chunksize` rows, yielding one row at a time as a dictionary
+    """
+    print(comment + ":\n    " + path)
+    for df in pd.read_csv(path, dtype = str, na_filter = False, chunksize = chunksize):
+        yield from df.to_dict("records")
+
+class CSVWriter:
+    """
+    Writes row dictionaries to a CSV file one by one, in the same format as `write_csv`;
+    the columns are taken from the first row
+    """
+    def __init__(self, path, comment):
+        self.path = path
+        self.comment = comment
+        self.file = open(path, "w", encoding = "utf-8", newline = "")
+        self.writer = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, row):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames = list(row.keys()), lineterminator = "\n")
+            self.writer.writeheader()
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            print(self.comment + ":\n    " + self.path)
+            print("    Rows: " + str(self.rows) + ",  Cols: " + str(len(self.writer.fieldnames) if self.writer else 0))
+
+def tee_rows(rows, writer = None):
+    """
+    Pass the rows through, also writing each one with `writer` (a `CSVWriter`) if given
+    """
+    for row in rows:
+        if writer is not None:
+            writer.write(row)
+        yield row
+
+def map_concurrently(func, items, workers = 1, checkpoint = None, key = None, batch = None):
+    """
+    Apply `func` to every item, with up to `workers` calls running at once in threads.
+    The results are returned as a list in the same order as `items`.
+    If a `checkpoint` is given, every result is recorded under `key(item)`,
+    and the items whose keys are already in the checkpoint are not recomputed.
+    If a `batch` backend is given, the LLM calls are submitted as batch jobs instead
+    (see `batchlib.map_batched`).
+    """
+    items = list(items)
+    if checkpoint is not None:
+        compute = func
+        func = lambda item: checkpoint.get_or_compute(key(item), lambda: compute(item))
+    if batch is not None:
+        import batchlib
+        return batchlib.map_batched(func, items, batch)
+    if workers <= 1:
+        return [func(item) for item in tqdm(items)]
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        # Each call runs in a copy of the caller's context, to keep its `telemetrylib` labels
+        futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+        try:
+            return [future.result() for future in tqdm(futures)]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def imap_concurrently(func, items, workers = 1):
+    """
+    Lazy version of `map_concurrently`: a generator that applies `func` to the items
+    as they are pulled from the `items` iterator, and yields the results in the same order.
+    Up to `workers` calls run at once in threads, with at most `2 * workers` items taken ahead
+    of the results consumed, so memory stays bounded however long `items` is.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = deque()
+        try:
+            for item in items:
+                futures.append(executor.submit(contextvars.copy_context().run, func, item))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
 
     # text_output = text_output.strip()
     # if (len(text_output) >= 2 and
@@ -52,4 +156,37 @@ def parse_numbered_questions(text): # , min_number_of_items = 2):
     # print(questions)
     return questions
 
+def parse_numbered_answers(text, num_a):
+    """
+    Parse a list of exactly `num_a` answers, labeled "Answer 1:", "Answer 2:", ..., or else numbered
+    1, 2, ..., `num_a`.  An answer may span multiple lines.  With labels, an answer may contain its
+    own numbered lists; without them, a numbered line inside an answer could as well start the next
+    answer, so such text is rejected rather than guessed at.
+    Returns `None` if the text does not contain the expected answers.
+    """
+    lines = [raw_line.strip() for raw_line in text.splitlines()]
+    labeled = any(re.search(r"^(?:\*\*)?answer\s+\d+\s*[:\.\)]", line, re.IGNORECASE) for line in lines)
+    if labeled:
+        pattern = r"^(?:\*\*)?answer\s+(\d+)\s*[:\.\)](?:\*\*)?\s*"
+    else:
+        pattern = r"^(?:\*\*)?(\d+)[:\.\)](?:\*\*)?\s+"
+    answers = []
+    chunks = [] # One answer could span multiple lines
+    for line in lines:
+        x = re.search(pattern, line, re.IGNORECASE)
+        if x and int(x.group(1)) == len(answers) + 1:
+            if answers:
+                answers[-1] = "\n".join(chunks).strip()
+            answers.append("")
+            chunks = [line[x.span()[1]:]]
+        elif x:
+            return None  # A label out of sequence, or an inner list that could be mistaken for the answers
+        elif answers:
+            chunks.append(line)
+    if answers:
+        answers[-1] = "\n".join(chunks).strip()
+    if len(answers) != num_a or not all(answers):
+        return None
+    return answers
+
 
@@ -0,0 +1,230 @@
+import pandas as pd
+import os, re, sqlite3, hashlib, time, argparse
+import tablelib, metricslib
+
+default_doc_schema = {
+    "doc_id" : "doc_id",
+    "source" : "source",
+    "LLM_q" : "LLM_q",
+    "doc_prompt" : "doc_prompt"
+}
+default_qr_schema = {
+    "doc_id" : "doc_id",
+    "q_id" : "q_id",
+    "is_conf" : "is_confusing",
+    "question" : "question",
+    "LLM_r" : "LLM_r",
+    "response" : "response",
+    "confusion" : "confusion",
+    "defusion" : "defusion",
+    "is_defused" : "is_defused"
+}
+
+def file_hash(path):
+    """
+    SHA-256 of a table file, or of all the files of a table folder (such as a Parquet table)
+    """
+    sha = hashlib.sha256()
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))
+    )
+    for file_path in paths:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+class Warehouse:
+    """
+    SQLite file with the results of all experiments, for queries across runs
+
+    Each experiment folder contributes its document table (doc ID, source, LLM_q, doc_prompt)
+    and its question-response table.  Ingestion is incremental and idempotent: a table
+    is re-loaded only if its content hash changed since the last scan, and the hash is only
+    computed if the file's size or modification time changed.
+    """
+    group_columns = ["experiment", "date", "doc_id", "LLM_q", "doc_prompt", "LLM_r"]
+
+    def __init__(self, path):
+        """
+        Opens (or creates) the warehouse file
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite file
+
+        Returns
+        -------
+        A new Warehouse instance
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs (" +
+                "experiment TEXT PRIMARY KEY, folder TEXT, date TEXT, ingested REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (" +
+                "experiment TEXT, kind TEXT, path TEXT, sha256 TEXT, size INTEGER, mtime REAL, " +
+                "rows INTEGER, ingested REAL, PRIMARY KEY (experiment, kind))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (" +
+                "experiment TEXT, doc_id TEXT, source TEXT, LLM_q TEXT, doc_prompt TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS questions (" +
+                "experiment TEXT, doc_id TEXT, q_id TEXT, is_conf TEXT, question TEXT, LLM_r TEXT, " +
+                "response TEXT, confusion TEXT, defusion TEXT, is_defused TEXT, " +
+                "detected INTEGER, defused INTEGER)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS documents_id ON documents (experiment, doc_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS questions_doc ON questions (experiment, doc_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS questions_llm ON questions (LLM_r)")
+            self.conn.execute(
+                "CREATE VIEW IF NOT EXISTS question_facts AS " +
+                "SELECT q.*, d.LLM_q, d.doc_prompt, r.date FROM questions q " +
+                "JOIN runs r ON r.experiment = q.experiment " +
+                "LEFT JOIN documents d ON d.experiment = q.experiment AND d.doc_id = q.doc_id"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def ingest(self, folder = "experiments", doc_file = "docs_out.csv", qr_file = "qrc_out.csv",
+               doc_schema = None, qr_schema = None):
+        """
+        Scans the experiment subfolders of `folder` and loads the new or changed tables
+
+        Returns
+        -------
+            (int, int) : the numbers of tables loaded and of tables skipped as unchanged
+        """
+        doc_schema = doc_schema or default_doc_schema
+        qr_schema = qr_schema or default_qr_schema
+        loaded, skipped = 0, 0
+        for experiment in sorted(os.listdir(folder)):
+            experiment_folder = os.path.join(folder, experiment)
+            if not os.path.isdir(experiment_folder):
+                continue
+            for kind, file_name in [("docs", doc_file), ("qrc", qr_file)]:
+                path = os.path.join(experiment_folder, file_name)
+                if not os.path.exists(path):
+                    continue
+                if self.ingest_table(experiment, experiment_folder, kind, path, doc_schema, qr_schema):
+                    loaded += 1
+                else:
+                    skipped += 1
+        print(f"Warehouse {self.path}: loaded {loaded} tables, skipped {skipped} unchanged tables")
+        return loaded, skipped
+
+    def ingest_table(self, experiment, experiment_folder, kind, path, doc_schema, qr_schema):
+        size, mtime = tablelib.file_stat(path)
+        known = self.conn.execute(
+            "SELECT sha256, size, mtime FROM files WHERE experiment = ? AND kind = ?", (experiment, kind)
+        ).fetchone()
+        if known is not None and (known[1], known[2]) == (size, mtime):
+            return False
+        sha256 = file_hash(path)
+        if known is not None and known[0] == sha256:
+            with self.conn:  # Touched, but not changed
+                self.conn.execute(
+                    "UPDATE files SET size = ?, mtime = ? WHERE experiment = ? AND kind = ?",
+                    (size, mtime, experiment, kind)
+                )
+            return False
+        if kind == "docs":
+            rows = self.document_rows(experiment, path, doc_schema)
+        else:
+            rows = self.question_rows(experiment, path, qr_schema)
+        x = re.search(r"^(\d{4}-\d{2}-\d{2})", experiment)
+        now = time.time()
+        with self.conn:  # Replace the experiment's rows from this table in one transaction
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)",
+                (experiment, experiment_folder, x.group(1) if x else None, now)
+            )
+            if kind == "docs":
+                self.conn.execute("DELETE FROM documents WHERE experiment = ?", (experiment,))
+                self.conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?)", rows)
+            else:
+                self.conn.execute("DELETE FROM questions WHERE experiment = ?", (experiment,))
+                self.conn.executemany("INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (experiment, kind, path, sha256, size, mtime, len(rows), now)
+            )
+        return True
+
+    @staticmethod
+    def document_rows(experiment, path, doc_schema):
+        columns = set(tablelib.read_columns(path))
+        refs = ["doc_id", "source", "LLM_q", "doc_prompt"]
+        df = tablelib.read_table(path, f"Read the document table of experiment {experiment}",
+                                 [doc_schema[ref] for ref in refs if doc_schema[ref] in columns])
+        values = [df[doc_schema[ref]] if doc_schema[ref] in columns else [None] * len(df) for ref in refs]
+        return [(experiment,) + row for row in zip(*values)]
+
+    @staticmethod
+    def question_rows(experiment, path, qr_schema):
+        df = tablelib.read_table(path, f"Read the question-response table of experiment {experiment}")
+        masks = metricslib.question_masks(df, qr_schema)
+        refs = ["doc_id", "q_id", "is_conf", "question", "LLM_r", "response", "confusion", "defusion", "is_defused"]
+        values = [df[qr_schema[ref]] for ref in refs]
+        values += [masks["detected"].astype(int), masks["defused"].astype(int)]
+        return [(experiment,) + row for row in zip(*values)]
+
+    def query(self, sql, params = ()):
+        """
+        Runs a SQL query (for example, over the `question_facts` view) and returns a DataFrame
+        """
+        return pd.read_sql_query(sql, self.conn, params = params)
+
+    def count_metrics(self, by = ("LLM_r", "doc_prompt", "date")):
+        """
+        The question counts of `metricslib.count_metrics`, with rates, for each group of
+        `by` columns (any of `Warehouse.group_columns`) across all ingested experiments
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        for column in by:
+            if column not in self.group_columns:
+                raise ValueError(f"Cannot group by {column}, choose from {self.group_columns}")
+        sums = []
+        for kind, is_conf in [("orig", "no"), ("conf", "yes")]:
+            sums += [
+                f"SUM(is_conf = '{is_conf}') AS {kind}_questions",
+                f"SUM(is_conf = '{is_conf}' AND detected) AS {kind}_detected",
+                f"SUM(is_conf = '{is_conf}' AND defused) AS {kind}_detected_defused"
+            ]
+        sums.append("SUM(is_conf = 'yes' AND detected AND NOT defused) AS conf_detected_undefused")
+        group, sums = ", ".join(by), ", ".join(sums)
+        metrics = self.query(
+            f"SELECT {group}, {sums} FROM question_facts GROUP BY {group} ORDER BY {group}"
+        ).set_index(by)
+        return metricslib.add_rates(metrics[metricslib.count_columns])
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Ingest the experiment results and compare them across runs")
+    parser.add_argument("folder", nargs = "?", default = "experiments",
+                        help = "Folder with one subfolder per experiment")
+    parser.add_argument("--db", default = "warehouse.sqlite",
+                        help = "SQLite file of the warehouse")
+    parser.add_argument("--by", nargs = "+", default = ["LLM_r", "doc_prompt", "date"],
+                        help = f"Columns to group the metrics by, from {Warehouse.group_columns}")
+    args = parser.parse_args()
+
+    with Warehouse(args.db) as warehouse:
+        warehouse.ingest(args.folder)
+        with pd.option_context("display.max_columns", None, "display.width", 200):
+            print(warehouse.count_metrics(args.by))